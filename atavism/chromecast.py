@@ -12,6 +12,8 @@ try:
 except ImportError:
     from Queue import Queue, Empty
 
+from atavism.http11.sockets import DEFAULT_OPTIONS
+
 
 CONNECTION_NS = "urn:x-cast:com.google.cast.tp.connection"
 HEARTBEAT_NS = 'urn:x-cast:com.google.cast.tp.heartbeat'
@@ -171,7 +173,7 @@ class ChromecastClient(object):
     DEFAULT_MEDIA_APP = 'CC1AD845'
 
     def __init__(self, host, port=8009):
-        self.logger = logging.getLogger()
+        self.logger = logging.getLogger(__name__)
         self.req_id = None
         self.volume = 0
         self.muted = False
@@ -205,7 +207,9 @@ class ChromecastClient(object):
         if self.running is True:
             return
 
-        self.socket = ssl.wrap_socket(socket.socket())
+        sock = socket.socket()
+        DEFAULT_OPTIONS.connection(sock, connected=False)
+        self.socket = ssl.wrap_socket(sock)
         self.socket.settimeout(10)
         try:
             self.socket.connect((str(self.host), self.port))
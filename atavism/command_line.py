@@ -6,6 +6,10 @@ import sys
 from atavism.devices import AirplayDevice, Chromecast, DeviceError
 from atavism.dnssd import MDNSServiceDiscovery
 from atavism.http import HLSServer
+from atavism.http11.access import AccessLog
+from atavism.http11.compression import CompressionPolicy
+from atavism.http11.pacing import Pacer, rate_for_bitrate
+from atavism.http11.sockets import SocketOptions
 from atavism.video import find_ffmpeg, HLSVideo, SimpleVideo
 from atavism import __version__
 
@@ -21,9 +25,45 @@ def main():
     parser.add_argument('--ffmpeg-search-paths', help='Path(s) to search for ffmpeg binary')
     parser.add_argument('--hls-only', action='store_true', help='Just create an HLS stream')
     parser.add_argument('--chromecast', action='store_true', help='If an IP is supplied, is it for a Chromecast?')
+    parser.add_argument('--loop-threads', type=int, default=0,
+                        help='Serve connections from this many event loop threads rather than a thread each')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Number of worker processes to serve the video from, metrics are not served with workers')
+    parser.add_argument('--cache-size', type=int, default=0,
+                        help='Megabytes of memory to use for caching the files being served')
+    parser.add_argument('--mmap', action='store_true', help='Serve files from shared memory maps')
+    parser.add_argument('--blocking-handler', action='store_true',
+                        help='Handle requests in a pool of threads, so reading files never holds up sending')
+    parser.add_argument('--asyncio', action='store_true', help='Serve the video using asyncio')
+    parser.add_argument('--compress-level', type=int, default=6,
+                        help='zlib level used to compress playlists and text (0 to disable)')
+    parser.add_argument('--idle-timeout', type=float,
+                        help='Seconds an idle connection is kept open (0 to keep them open)')
+    parser.add_argument('--max-connections', type=int, default=0,
+                        help='Maximum number of connections to serve at once')
+    parser.add_argument('--max-per-ip', type=int, default=0,
+                        help='Maximum number of connections to serve from each address')
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help='Kilobytes per second to send in total (0 for no limit)')
+    parser.add_argument('--rate-per-ip', type=int, default=0,
+                        help='Kilobytes per second to send to each address (0 for no limit)')
+    parser.add_argument('--pace-factor', type=float, default=0,
+                        help='Limit each connection to this many times the bitrate of the video')
+    parser.add_argument('--readahead', type=int, default=HLSServer.READAHEAD,
+                        help='Number of segments to read into the page cache ahead of playback (0 to disable)')
+    parser.add_argument('--backlog', type=int, default=128, help='Length of the queue of connections to accept')
+    parser.add_argument('--sndbuf', type=int, help='Kilobytes of kernel send buffer for each connection')
+    parser.add_argument('--rcvbuf', type=int, help='Kilobytes of kernel receive buffer for each connection')
+    parser.add_argument('--no-nodelay', action='store_true', help="Don't disable Nagle's algorithm")
+    parser.add_argument('--no-cork', action='store_true', help="Don't send headers with MSG_MORE before a file")
+    parser.add_argument('--keepalive-idle', type=int, help='Seconds before TCP keepalives are sent')
     parser.add_argument('-v', nargs='*', help='Additional debug information')
     parser.add_argument('--version', action='store_true', help='Show version and exit')
     parser.add_argument('--log', help='Logfile to save output into')
+    parser.add_argument('--access-log', help='File to append a JSON record of every request to')
+    parser.add_argument('--no-metrics', action='store_true',
+                        help='Don\'t serve metrics at {}'.format(HLSServer.METRICS_PATH))
+    parser.add_argument('--server-timing', action='store_true', help='Add a Server-Timing header to responses')
     parser.add_argument('video', nargs='?', help="Video to stream")
 
     args = parser.parse_args()
@@ -33,6 +73,9 @@ def main():
         print("https://github.com/zathras777/atavism")
         sys.exit(0)
 
+    if args.asyncio and (args.workers or args.loop_threads):
+        parser.error("--asyncio can't be used with --workers or --loop-threads")
+
     if args.video is None and args.find_devices is False:
         print("You must supply a video filename unless --find-devices is used.")
         sys.exit(0)
@@ -139,7 +182,27 @@ def main():
         print("    done")
 
     print("Duration: {} seconds\n".format(video.info.get('duration')))
-    srv = HLSServer(video=video)
+    options = {'cache_size': args.cache_size * 1024 * 1024, 'use_mmap': args.mmap,
+               'idle_timeout': args.idle_timeout, 'max_connections': args.max_connections,
+               'max_per_ip': args.max_per_ip, 'readahead': args.readahead, 'server_timing': args.server_timing,
+               'blocking_handler': args.blocking_handler,
+               'metrics_path': '' if args.no_metrics else None, 'compression': CompressionPolicy(level=args.compress_level)}
+    per_connection = 0
+    if args.pace_factor > 0 and video.bitrate:
+        per_connection = rate_for_bitrate(video.bitrate, args.pace_factor)
+    options['socket_options'] = SocketOptions(backlog=args.backlog, nodelay=not args.no_nodelay,
+                                              sndbuf=args.sndbuf * 1024 if args.sndbuf else None,
+                                              rcvbuf=args.rcvbuf * 1024 if args.rcvbuf else None,
+                                              cork=not args.no_cork, keepidle=args.keepalive_idle)
+    if args.access_log is not None:
+        options['access_log'] = AccessLog(args.access_log)
+    options['pacing'] = Pacer(rate=args.rate_limit * 1024, per_ip=args.rate_per_ip * 1024,
+                              per_connection=per_connection)
+    if args.asyncio:
+        from atavism.http_aio import AsyncHLSServer
+        srv = AsyncHLSServer(video=video, **options)
+    else:
+        srv = HLSServer(video=video, loop_threads=args.loop_threads, workers=args.workers, **options)
     srv.start()
     try:
         active_device.play_video(srv)
@@ -49,7 +49,6 @@ class AirplayDevice:
         self.http = HttpClient(self.host, self.port)
 
         self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(logging.getLogger().level)
 
         if self.ptr is not None:
             self.name = self.ptr.split('.')[0]
@@ -398,7 +398,6 @@ class MDNSServiceDiscovery(object):
         self.query = MDNSQuery()
 
         self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(logging.getLogger().level)
 
         for qname in args:
             self.query.add_question(qname.strip(), self.qtype)
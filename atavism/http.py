@@ -1,25 +1,116 @@
 from mimetypes import guess_type
 import random
 import socket
-from atavism.http11.content import FileContent
+import threading
+from atavism.http11.cache import CompressedCache, SegmentCache, StatCache
+from atavism.http11.content import Content, FileContent, MappedFileContent
+from atavism.http11.headers import HeaderBlock
 from atavism.http11.objects import HttpResponse
+from atavism.http11.pacing import Pacer, rate_for_bitrate
+from atavism.http11.readahead import Readahead, can_advise
 from atavism.http11.server import HttpServer
 
 from atavism import __version__
 
 
+STATIC_HEADERS = HeaderBlock({'Accept-Ranges': 'bytes',
+                              'Server': 'atavism/{}'.format(__version__)})
+
+
 class HLSServerError(Exception):
     pass
 
 
+class Title(object):
+    """ A video served by an HLSServer, under a URL prefix, e.g. '/film'. The root title has a
+        prefix of ''. When readahead is given and the video is served as a playlist, that many
+        segments after the one requested are read into the page cache ahead of time.
+    """
+    def __init__(self, prefix, video, readahead=0):
+        self.prefix = prefix
+        self.video = video
+        self.counters = {'requests': 0, 'bytes': 0}
+        self.readahead = None
+        if readahead > 0 and can_advise() and video.url.endswith('.m3u8'):
+            self.readahead = Readahead(video.find_file, readahead)
+
+    @property
+    def url(self):
+        return self.prefix + self.video.url
+
+    def find_file(self, path):
+        return self.video.find_file(path[len(self.prefix):] or '/')
+
+    def file_info(self, path, files):
+        """ Get the details of the file for a path.
+        :param files: The StatCache to use when the video has no index of it's files.
+        :return: FileInfo or None.
+        """
+        if hasattr(self.video, 'file_info'):
+            return self.video.file_info(path[len(self.prefix):] or '/')
+        rfn = self.find_file(path)
+        return files.get(rfn) if rfn is not None else None
+
+    def advise(self, path, files):
+        """ Hint the kernel about the segments that will be wanted after path, using the
+            list in the current playlist.
+        """
+        if self.readahead is None:
+            return
+        info = self.file_info(self.url, files)
+        if info is not None:
+            self.readahead.load(self.video.url, info.filename, info.stat)
+            self.readahead.requested(path[len(self.prefix):] or '/')
+
+    def matches(self, path):
+        return self.prefix == '' or path == self.prefix or path.startswith(self.prefix + '/')
+
+
 class HLSServer(HttpServer):
     """ Class that serves an HLSVideo via HTTP.
+        Any number of videos can be served, each as a title with a URL prefix of it's own, see
+        add_title(). The video given when the server is created is served without a prefix.
+        Titles can be added and removed while the server is running, but workers only serve
+        the titles there were when they were started.
+        If cache_size is given, up to that many bytes of the files served are kept in memory
+        so repeated requests for the same segments don't need to read them from disk.
+        If use_mmap is set, files are served from memory maps shared between responses.
+        Responses carry an ETag and Last-Modified, taken from the video's index of it's files
+        (or a short lived cache of file details), and conditional requests are answered with a
+        304 without opening the file.
+        Small files that are worth compressing, such as playlists, are compressed once and the
+        result kept for later requests.
+        If pace_factor is given and no pacing, each connection is limited to that many times
+        the bitrate of the video.
+        The segments after each one requested, up to readahead of them, are read into the page
+        cache while the current one plays, and those played by every client are dropped.
+        If blocking_handler is set, requests are handled in the handler pool, so reading files
+        into the caches and opening them doesn't hold up the threads doing socket I/O.
+        Unless a host is given, the server listens on the interface used to reach the network.
     """
 
-    def __init__(self, video=None):
-        HttpServer.__init__(self)
+    READAHEAD = 2
+
+    def __init__(self, video=None, cache_size=0, use_mmap=False, pace_factor=0, readahead=None,
+                 blocking_handler=False, **kwargs):
+        HttpServer.__init__(self, **kwargs)
+        self.blocking_handler = blocking_handler
+        self.readahead = self.READAHEAD if readahead is None else readahead
+        if pace_factor > 0 and kwargs.get('pacing') is None and getattr(video, 'bitrate', None):
+            self.pacer = Pacer(per_connection=rate_for_bitrate(video.bitrate, pace_factor))
         self.video = video
-        self.find_interface()
+        self.titles = []
+        self._titles_lock = threading.Lock()
+        if video is not None:
+            self.add_title('', video)
+        self.cache = SegmentCache(cache_size) if cache_size > 0 else None
+        self.use_mmap = use_mmap
+        self.files = StatCache()
+        self.compressed = CompressedCache(self.compression)
+        self.counters['not_modified'] = 0
+        self.metrics.gauges.update(['cache_entries', 'cache_bytes', 'compressed_entries', 'compressed_bytes'])
+        if self.host is None:
+            self.find_interface()
 
     def make_socket(self):
         failed = []
@@ -27,25 +118,100 @@ class HLSServer(HttpServer):
             port = random.randint(8100, 20000)
             try:
                 sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                sock.setblocking(0)
-                sock.settimeout(5)
+                self.set_socket_options(sock)
                 sock.bind((self.host, port))
-                sock.listen(self.backlog)
+                self.listen(sock)
                 self.socket = sock
                 self.port = port
                 return
             except socket.error:
-                pass
+                failed.append(str(port))
         raise HLSServerError("Unable to fid a suitable open port. Tried {}".format(",".join(failed)))
 
+    def blocks(self, request):
+        if self.blocking_handler:
+            return request.path != self.metrics_path
+        return HttpServer.blocks(self, request)
+
     @property
     def url(self):
-        return "http://{}:{}{}".format(self.host, self.port, self.video.url)
+        """ The URL of the root title. """
+        return self.title_url('')
+
+    def title_url(self, prefix):
+        """ The URL for the title with the prefix. """
+        title = self.find_title(self._prefix(prefix))
+        if title is None:
+            raise HLSServerError("No title is served as '{}'".format(prefix))
+        return "http://{}:{}{}".format(self.host, self.port, title.url)
+
+    @staticmethod
+    def _prefix(prefix):
+        prefix = (prefix or '').strip('/')
+        return '/' + prefix if prefix else ''
+
+    def add_title(self, prefix, video):
+        """ Serve a video under a URL prefix, replacing any already served with it. The video
+            of the root title is the server's video.
+        :param prefix: The URL prefix, e.g. '/film'. '' or '/' to serve it without one.
+        :param video: The BaseVideo to serve.
+        :return: The Title.
+        """
+        title = Title(self._prefix(prefix), video, self.readahead)
+        with self._titles_lock:
+            titles = [t for t in self.titles if t.prefix != title.prefix]
+            titles.append(title)
+            # The longest prefix that matches is used. A new list is created, so requests
+            # being handled aren't affected by changes.
+            self.titles = sorted(titles, key=lambda t: len(t.prefix), reverse=True)
+            if title.prefix == '':
+                self.video = video
+        return title
+
+    def remove_title(self, prefix):
+        """ Stop serving the title with the prefix.
+        :return: The Title removed or None.
+        """
+        prefix = self._prefix(prefix)
+        with self._titles_lock:
+            title = self.find_title(prefix)
+            self.titles = [t for t in self.titles if t.prefix != prefix]
+            if prefix == '':
+                self.video = None
+        return title
+
+    def find_title(self, prefix):
+        for t in self.titles:
+            if t.prefix == prefix:
+                return t
+        return None
+
+    def route(self, path):
+        """ Find the title that serves a path.
+        :return: The Title or None.
+        """
+        for t in self.titles:
+            if t.matches(path):
+                return t
+        return None
+
+    def count_title(self, title, resp, size):
+        """ Add a response of size bytes to the counters for the title. """
+        if resp.headers_only or resp.code == 304:
+            size = 0
+        elif resp.has_ranges():
+            size = sum(max(0, end - st + 1) for st, end in (r.absolutes(size) for r in resp.ranges))
+        with self._stats_lock:
+            title.counters['requests'] += 1
+            title.counters['bytes'] += size
 
     @property
     def content_type(self):
-        return guess_type(self.video.url)[0]
+        """ The MIME type of the root title. """
+        title = self.find_title('')
+        if title is None:
+            raise HLSServerError("No title is served as '/'")
+        return guess_type(title.video.url)[0]
 
     def find_interface(self):
         """ Find the local interface(s) that we will send via.
@@ -64,27 +230,80 @@ class HLSServer(HttpServer):
     def join(self):
         self.accept_thread.join(1.0)
 
+    def stats(self):
+        rv = HttpServer.stats(self)
+        if self.cache is not None and (self.workers == 0 or self.worker_id is not None):
+            rv.update(self.cache.stats())
+        if self.workers == 0 or self.worker_id is not None:
+            rv.update(self.compressed.stats())
+            with self._stats_lock:
+                for t in self.titles:
+                    for k, v in t.counters.items():
+                        rv['title:{}:{}'.format(t.prefix or '/', k)] = v
+            for t in self.titles:
+                if t.readahead is not None:
+                    for k, v in t.readahead.stats().items():
+                        rv[k] = rv.get(k, 0) + v
+        return rv
+
     def handler(self, request):
         """ Create an HttpResponseObject from the request received. The server will call complete().
         :param request: The HttpRequest object to process.
         :return: The HttpResponse object.
         """
-        self.logger.debug("Processing request for '%s'", request.path)
         resp = request.make_response()
-        resp.add_headers({'Accept-Ranges': 'bytes',
-                          'Server': 'atavism/{}'.format(__version__)})
+        resp.add_headers(STATIC_HEADERS)
 
         if request.method not in ('GET', 'HEAD'):
             resp.set_code(405)
             return resp
 
-        rfn = self.video.find_file(request.path)
-        if rfn is None:
+        title = self.route(request.path)
+        info = title.file_info(request.path, self.files) if title is not None else None
+        if info is None:
             self.logger.info("Failed to find '%s'", request.path)
             resp.set_code(404)
             resp.set_content_type('text/html')
             resp.add_content("{} does not exist on this server.".format(request.path))
             return resp
+        title.advise(request.path, self.files)
+
+        # Ranges are always of the file itself, so If-Range is checked against it's own tag.
+        if not request.if_range_matches(info.etag, info.mtime):
+            resp.ranges = []
+        rfn = info.filename
+        content_type = info.content_type
+        method = resp.compression
+        if not method or resp.has_ranges() or not self.compression.applies(content_type, info.size):
+            method = None
+
+        etag = info.etag_for(method)
+        resp.add_headers({'ETag': etag, 'Last-Modified': info.last_modified})
+        if request.not_modified(etag, info.mtime):
+            self.count('not_modified')
+            resp.set_code(304)
+            self.count_title(title, resp, 0)
+            return resp
+
+        if method:
+            data = self.compressed.get(rfn, method, info.stat)
+            if data is not None:
+                content = Content(data=data, content_type=content_type)
+                content.compression = method
+                content.is_compressed = True
+                resp.set_content(content)
+                self.count_title(title, resp, len(data))
+                return resp
+
+        self.count_title(title, resp, info.size)
+        if self.cache is not None:
+            data = self.cache.get(rfn, info.stat)
+            if data is not None:
+                resp.set_content(Content(data=data, content_type=content_type))
+                return resp
 
-        resp.set_content(FileContent(rfn))
+        if self.use_mmap:
+            resp.set_content(MappedFileContent(rfn, info.stat, content_type))
+        else:
+            resp.set_content(FileContent(rfn, info.stat, content_type))
         return resp
@@ -0,0 +1,157 @@
+""" Logging a record of every request served, written in batches by a background thread.
+"""
+from collections import deque
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+
+class AccessRecord(object):
+    """ The details of one request and the response sent for it. Times are from monotonic(),
+        the first byte is when the start of the response was queued to be sent. bytes counts
+        what has been written to the socket for the response, headers included. A response
+        the connection closed before sending in full is marked as aborted.
+    """
+    __slots__ = ('client', 'method', 'path', 'range', 'started', 'first_byte', 'finished', 'status', 'bytes',
+                 'aborted')
+
+    def __init__(self, client, request, started=None):
+        self.client = client[0] if isinstance(client, tuple) else client
+        self.method = request.method if request is not None else None
+        self.path = request.path if request is not None else None
+        self.range = request.get('range') if request is not None else None
+        self.started = started or monotonic()
+        self.first_byte = None
+        self.finished = None
+        self.status = None
+        self.bytes = 0
+        self.aborted = False
+
+    def sending(self):
+        if self.first_byte is None:
+            self.first_byte = monotonic()
+
+    def written(self, n):
+        self.bytes += n
+
+    def finish(self, resp):
+        """ Record the outcome once the response has been sent. """
+        self.finished = monotonic()
+        self.status = resp.code
+
+    def abort(self):
+        """ Record that the connection closed before the response was sent in full. """
+        self.finished = monotonic()
+        self.aborted = True
+
+    def as_dict(self, now, wall):
+        """ The record as a dict, with times converted into milliseconds.
+        :param now: The current time from monotonic().
+        :param wall: The current time from time(), to find when the request started.
+        """
+        first = self.first_byte or self.finished
+        return {'time': round(wall - (now - self.started), 3),
+                'client': self.client,
+                'method': self.method,
+                'path': self.path,
+                'status': self.status,
+                'bytes': self.bytes,
+                'range': self.range,
+                'aborted': self.aborted,
+                'ttfb_ms': round((first - self.started) * 1000, 3) if first else None,
+                'total_ms': round((self.finished - self.started) * 1000, 3) if self.finished else None}
+
+
+class AccessLog(object):
+    """ Append a JSON line for every request to filename. Records are queued by add(), which
+        doesn't block or format anything, and written by a background thread every interval
+        seconds, or sooner once batch records are waiting. If the writer falls behind by more
+        than max_queue records, new records are counted as dropped rather than queued.
+        The thread is started by the first record added in each process.
+    """
+    BATCH = 256
+    INTERVAL = 1.0
+    MAX_QUEUE = 65536
+
+    def __init__(self, filename, batch=None, interval=None, max_queue=None):
+        self.filename = filename
+        self.batch = batch or self.BATCH
+        self.interval = interval or self.INTERVAL
+        self.max_queue = max_queue or self.MAX_QUEUE
+        self.queue = deque()
+        self.wanted = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.running = False
+        self.counters = {'access_logged': 0, 'access_dropped': 0}
+        self.logger = logging.getLogger(__name__)
+
+    def add(self, record):
+        if self.pid != os.getpid():
+            self._start()
+        if len(self.queue) >= self.max_queue:
+            self.counters['access_dropped'] += 1
+            return
+        self.queue.append(record)
+        if len(self.queue) >= self.batch:
+            self.wanted.set()
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # After a fork the parent's records and thread are left behind.
+            self.queue.clear()
+            self.pid = os.getpid()
+            self.running = True
+            self.thread = threading.Thread(target=self._run, name='AccessLog')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while self.running:
+            self.wanted.wait(self.interval)
+            self.wanted.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        """ Write the records waiting. """
+        records = []
+        while len(records) < self.max_queue:
+            try:
+                records.append(self.queue.popleft())
+            except IndexError:
+                break
+        if len(records) == 0:
+            return
+        now, wall = monotonic(), time.time()
+        data = ''.join(json.dumps(r.as_dict(now, wall), sort_keys=True) + '\n' for r in records)
+        try:
+            with open(self.filename, 'a') as fh:
+                fh.write(data)
+        except (IOError, OSError) as e:
+            self.logger.warning("Unable to write to the access log '%s': %s", self.filename, e)
+            self.counters['access_dropped'] += len(records)
+            return
+        self.counters['access_logged'] += len(records)
+
+    def close(self):
+        """ Stop the writer, once the records waiting have been written. """
+        self.running = False
+        self.wanted.set()
+        if self.thread is not None and self.pid == os.getpid():
+            self.thread.join(5.0)
+        self.thread = None
+        self.pid = None
+
+    def stats(self):
+        return dict(self.counters)
@@ -0,0 +1,346 @@
+""" An asyncio version of the HttpServer. Connections are served using asyncio streams, so the
+    server can share an event loop with other code. The same handler(request) API is used, but
+    handlers may also be coroutines, allowing slow work to be done without blocking other
+    clients.
+    Requires Python 3.7 or later.
+"""
+import asyncio
+import inspect
+import os
+import threading
+import time
+
+from atavism.http11.access import AccessRecord
+from atavism.http11.buffers import ReceiveBuffer
+from atavism.http11.headers import HeaderError
+from atavism.http11.objects import HttpRequest
+from atavism.http11.server import HttpServer, HttpServerError
+
+
+class _Descriptor(object):
+    """ Just enough of a file object for loop.sendfile() to use a file descriptor. The fd is
+        shared with other responses, so the position is kept here and reads use preadv()
+        rather than moving the file offset.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self.position = 0
+
+    def fileno(self):
+        return self.fd
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += os.fstat(self.fd).st_size
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buf):
+        if hasattr(os, 'preadv'):
+            n = os.preadv(self.fd, [buf], self.position)
+        else:
+            data = os.pread(self.fd, len(buf), self.position)
+            n = len(data)
+            memoryview(buf)[:n] = data
+        self.position += n
+        return n
+
+
+class AsyncHttpServer(HttpServer):
+    """ HttpServer that serves connections from an asyncio event loop.
+        If a running loop is supplied the server is started on that loop, otherwise start()
+        runs a new loop in a thread of it's own. From a coroutine, use start_serving() and
+        stop_serving() instead of start() and stop().
+        Connections are all served by the one loop, so workers and loop_threads can't be used.
+    """
+    loop = None
+    server = None
+
+    def __init__(self, host=None, port=80, handler=None, loop=None, **kwargs):
+        HttpServer.__init__(self, host, port, handler, **kwargs)
+        self.loop = loop
+        self.check_options()
+
+    def check_options(self):
+        """ Reject the HttpServer options the asyncio server doesn't support. """
+        if self.workers or self.loop_threads:
+            raise HttpServerError("The asyncio server can't use workers or loop_threads.")
+
+    async def start_serving(self):
+        """ Start accepting connections on the currently running loop. """
+        if self.socket is None:
+            self.make_socket()
+        self.socket.setblocking(False)
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self._client_connected, sock=self.socket, backlog=self.backlog)
+        self.running = True
+        self.logger.info("Serving connections for {}:{} via asyncio".format(self.host, self.port))
+
+    async def stop_serving(self):
+        self.running = False
+        if self.server is not None:
+            self.server.close()
+        connections = list(self.connections)
+        for c in connections:
+            c.stop()
+        await asyncio.gather(*[c.task for c in connections], return_exceptions=True)
+        if self.server is not None:
+            await self.server.wait_closed()
+            self.server = None
+        # The server closes the listening socket.
+        self.socket = None
+        if self.access_log is not None:
+            self.access_log.close()
+
+    def start(self):
+        self.logger.info("AsyncHttpServer starting up")
+        if self.socket is None:
+            self.make_socket()
+        if self.loop is not None and self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.start_serving(), self.loop).result()
+            return
+
+        started = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        self.accept_thread = threading.Thread(target=self._run_loop, args=(started,))
+        self.accept_thread.name = 'AsyncHttpServer'
+        self.accept_thread.daemon = True
+        self.accept_thread.start()
+        started.wait()
+
+    def _run_loop(self, started):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.start_serving())
+        started.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    def stop(self):
+        if self.loop is None or self.server is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.stop_serving(), self.loop).result()
+        if self.accept_thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.accept_thread.join()
+            self.accept_thread = None
+
+    def join(self):
+        if self.accept_thread is not None:
+            self.accept_thread.join(1.0)
+        else:
+            time.sleep(1.0)
+
+    async def _client_connected(self, reader, writer):
+        address = writer.get_extra_info('peername')
+        if not self.admit(address):
+            writer.write(self.REFUSED)
+            writer.close()
+            return
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            self.socket_options.connection(sock)
+        conn = AsyncHttpConnection(self, reader, writer)
+        self.connections.append(conn)
+        self.count('connections')
+        self.logger.info("Accepted a connection from %s.", conn.address)
+        try:
+            await conn.run()
+        finally:
+            self.connections.remove(conn)
+            self.release(address)
+            if conn.pacing is not None:
+                self.pacer.detach(address)
+            writer.close()
+
+
+class AsyncHttpConnection(object):
+    """ A single client connection served via asyncio streams. """
+    READ_SIZE = 65536
+    WRITE_SIZE = 65536
+
+    def __init__(self, parent, reader, writer):
+        self.parent = parent
+        self.reader = reader
+        self.writer = writer
+        self.address = writer.get_extra_info('peername')
+        self.logger = parent.logger
+        self.running = True
+        self.use_sendfile = hasattr(os, 'sendfile')
+        self.request_started = None
+        self.waiting = None
+        self.task = asyncio.current_task()
+        self.pacing = parent.pacer.attach(self.address)
+
+    def timeout(self, request):
+        """ The time allowed for the next read, which is the remaining header timeout while a
+            request is partially received and the idle timeout otherwise.
+        """
+        if request is not None and self.parent.header_timeout:
+            return max(0, self.request_started + self.parent.header_timeout - self.parent.loop.time())
+        return self.parent.idle_timeout or None
+
+    async def run(self):
+        request = None
+        inp = ReceiveBuffer(self.READ_SIZE)
+        while self.running:
+            try:
+                data = await asyncio.wait_for(self.reader.read(self.READ_SIZE), self.timeout(request))
+            except asyncio.TimeoutError:
+                self.logger.info("Closing connection from %s as it has timed out.", self.address)
+                self.parent.count('timeouts')
+                break
+            except (ConnectionError, OSError) as e:
+                self.logger.warning("Socket error: %s", e)
+                break
+            if len(data) == 0:
+                break
+
+            inp.append(data)
+            while self.running and len(inp) > 0:
+                if request is None:
+                    request = HttpRequest()
+                    self.request_started = self.parent.loop.time()
+                try:
+                    read = request.read_content(inp.view())
+                except HeaderError as e:
+                    self.logger.warning("Bad request from %s: %s", self.address, e)
+                    resp = self.parent.error_response(e.code)
+                    resp.complete()
+                    self.record(resp, None)
+                    try:
+                        await self.send_response(resp)
+                        await self.linger()
+                    except (ConnectionError, OSError, asyncio.TimeoutError):
+                        pass
+                    return
+                else:
+                    inp.consume(read)
+                    if not request.is_complete():
+                        break
+                if self.parent.blocks(request):
+                    resp = await asyncio.wrap_future(self.parent.submit_handler(request))
+                else:
+                    started = time.monotonic()
+                    resp = self.parent.call_handler(request)
+                    if inspect.isawaitable(resp):
+                        try:
+                            resp = await resp
+                        except Exception:
+                            resp = self.parent.handler_failed(request)
+                    self.parent.finish_response(resp, started)
+                self.parent.count('requests')
+                self.record(resp, request)
+                request = None
+                try:
+                    await self.send_response(resp)
+                except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+                    if self.running:
+                        self.logger.warning("Unable to send via socket. Closing it. %s", e)
+                    return
+                finally:
+                    resp.close()
+                if not resp.is_keepalive:
+                    return
+
+    def record(self, resp, request):
+        """ Start the record of a response for the metrics and access log. """
+        # The loop's clock may not be the one the record uses.
+        started = time.monotonic() - (self.parent.loop.time() - self.request_started)
+        resp.access = AccessRecord(self.address, request, started)
+
+    async def send_response(self, resp):
+        """ Send a response, recording the bytes written once the transport has taken them. """
+        record = resp.access
+        if record is not None:
+            record.sending()
+        try:
+            await self._send(resp, record)
+        except BaseException:
+            if record is not None:
+                record.abort()
+                self.parent.finished(record)
+            raise
+        if record is not None:
+            record.finish(resp)
+            self.parent.finished(record)
+
+    async def _send(self, resp, record):
+        while not resp.send_complete():
+            region = resp.file_region() if self.use_sendfile else None
+            if region is not None:
+                fd, offset, count = region
+                await self.writer.drain()
+                count = await self.pace(count)
+                sent = await self.parent.loop.sendfile(self.writer.transport, _Descriptor(fd), offset, count)
+                if sent == 0:
+                    raise ConnectionError("File is shorter than expected.")
+                resp.advance(sent)
+                self.paced(sent)
+                if record is not None:
+                    record.written(sent)
+                continue
+            if not resp.ready():
+                await asyncio.wait_for(self.wait_ready(resp), self.parent.idle_timeout or None)
+            sent = 0
+            for block in resp.next_blocks(await self.pace(self.WRITE_SIZE)):
+                self.writer.write(block)
+                sent += len(block)
+            self.paced(sent)
+            await asyncio.wait_for(self.writer.drain(), self.parent.idle_timeout or None)
+            if record is not None:
+                record.written(sent)
+
+    async def pace(self, wanted):
+        """ Wait until some data may be sent.
+        :param wanted: The number of bytes waiting to be sent.
+        :return: The number of bytes that may be sent now.
+        """
+        if self.pacing is None:
+            return wanted
+        while True:
+            n, delay = self.parent.pacer.allowance(self.pacing)
+            if n > 0:
+                return min(n, wanted)
+            await asyncio.sleep(delay)
+
+    def paced(self, sent):
+        if self.pacing is not None:
+            self.parent.pacer.consume(self.pacing, sent)
+
+    async def linger(self):
+        """ Stop sending and discard anything else the client sends until it closes, or the
+            header timeout passes. Closing with data unread would reset the connection and
+            could lose the response.
+        """
+        if self.writer.can_write_eof():
+            self.writer.write_eof()
+        timeout = self.parent.header_timeout or None
+        while self.running:
+            data = await asyncio.wait_for(self.reader.read(self.READ_SIZE), timeout)
+            if len(data) == 0:
+                break
+
+    async def wait_ready(self, resp):
+        """ Wait for a streamed response to have more data. """
+        loop = self.parent.loop
+        self.waiting = ready = loop.create_future()
+
+        def set_ready():
+            if not ready.done():
+                ready.set_result(True)
+        resp.when_ready(lambda: loop.call_soon_threadsafe(set_ready))
+        try:
+            await ready
+        finally:
+            self.waiting = None
+
+    def stop(self):
+        self.running = False
+        if self.waiting is not None:
+            self.waiting.cancel()
+        self.writer.close()
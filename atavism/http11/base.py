@@ -42,21 +42,68 @@ class BaseHttp(object):
         ct = self._content
         while ct._next is not None:
             ct = ct._next
-        if self.headers_sent and ct.send_complete:
+        if self.headers_sent and (self.headers_only or ct.send_complete):
             return True
         return False
 
-    def next_output(self):
-        data = b''
+    def next_output(self, max_size=None):
+        """ Get the next block of output to send.
+        :param max_size: The most data to return, Content.MAX_SEND if not given.
+        :return: The data.
+        """
+        return b''.join(self.next_blocks(max_size))
+
+    def next_blocks(self, max_size=None):
+        """ Get the next output to send as a list of blocks, so that content (which may be a
+            memoryview) doesn't need to be copied to join it to the headers.
+        :param max_size: The most data to return, Content.MAX_SEND if not given.
+        :return: List of blocks.
+        """
+        blocks = []
         if not self.headers_sent:
-            data += str(self.header).encode()
+            blocks.append(self.header.encode())
             self.headers_sent = True
+            if self.file_region() is not None:
+                # the body will be sent directly from the file
+                return blocks
         if self.headers_only:
             self._content.finished = True
-            return data
+            return blocks
+
+        blocks.append(self._content.next(sum(len(b) for b in blocks), max_size))
+        return blocks
+
+    def file_region(self):
+        """ Once the headers have been sent, can the rest of the content be sent directly
+            from a file?
+        :return: Tuple of (file descriptor, offset, length) or None.
+        """
+        if not self.headers_sent or self.headers_only:
+            return None
+        return self._content.file_region()
+
+    def ready(self):
+        """ Can the next output be produced without waiting for the content? """
+        return not self.headers_sent or self.headers_only or self._content.ready()
+
+    def when_ready(self, callback):
+        """ Call callback(), possibly from another thread, once ready() would return True. """
+        if self.ready():
+            callback()
+        else:
+            self._content.when_ready(callback)
+
+    def wait_ready(self, timeout=None):
+        """ Wait up to timeout seconds for ready() to be True. """
+        return self.ready() or self._content.wait_ready(timeout)
+
+    def advance(self, n):
+        """ Record that n bytes of content have been sent directly from the file. """
+        self._content.advance(n)
 
-        data += self._content.next(len(data))
-        return data
+    def close(self):
+        """ Release any resources held by the content. """
+        self._content.close()
 
     ### Ranges
     def parse_ranges(self, key):
@@ -92,6 +139,9 @@ class BaseHttp(object):
         return self._content.decoded_content()
 
     def set_content(self, cntnt_obj):
+        """ Replace the content, keeping any compression that has been asked for. """
+        if not cntnt_obj.compression and not cntnt_obj.is_compressed:
+            cntnt_obj.compression = self._content.compression
         self._content = cntnt_obj
 
     def set_content_type(self, ct):
@@ -129,10 +179,17 @@ class BaseHttp(object):
     def set_compression(self, method):
         self._content.set_compression(method)
 
-    def _complete(self):
-        """ Record that the creation of a response/request is complete. """
+    @property
+    def compression(self):
+        """ The compression asked for, which may not be used if the content isn't suitable. """
+        return self._content.compression
+
+    def _complete(self, policy=None):
+        """ Record that the creation of a response/request is complete.
+        :param policy: The CompressionPolicy to apply to the content.
+        """
         self._content.finished = True
-        self._content.compress()
+        self._content.compress(policy)
         self.header.add_headers(self._content.header_lines())
 
     def is_complete(self):
@@ -0,0 +1,126 @@
+""" Buffers used for sending and receiving data via sockets.
+"""
+from collections import deque
+from itertools import islice
+
+
+class OutputBuffer(object):
+    """ Data waiting to be written to a socket. Buffers are queued without being joined and are
+        written together using sendmsg() where it's available. Partial writes are tracked, so
+        data the socket doesn't accept is sent by the next call to write().
+    """
+    MAX_IOV = 64
+
+    def __init__(self):
+        self.buffers = deque()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        if len(data) == 0:
+            return
+        self.buffers.append(memoryview(data))
+        self.size += len(data)
+
+    def write(self, sock, flags=0, limit=None):
+        """ Write as much of the buffer as the socket will accept. Socket errors are not caught.
+        :param sock: The socket to write to.
+        :param flags: Flags for the send call, e.g. MSG_MORE.
+        :param limit: The most bytes to write, or None for no limit.
+        :return: The number of bytes written.
+        """
+        if self.size == 0:
+            return 0
+        if limit is not None and limit < self.size:
+            iov = []
+            for buf in islice(self.buffers, self.MAX_IOV):
+                iov.append(buf[:limit])
+                limit -= len(iov[-1])
+                if limit == 0:
+                    break
+        else:
+            iov = list(islice(self.buffers, self.MAX_IOV))
+        if len(iov) > 1 and hasattr(sock, 'sendmsg'):
+            sent = sock.sendmsg(iov, [], flags)
+        else:
+            sent = sock.send(iov[0], flags)
+        self.consume(sent)
+        return sent
+
+    def consume(self, n):
+        """ Remove n bytes from the start of the buffer. """
+        self.size -= n
+        while n > 0:
+            buf = self.buffers[0]
+            if len(buf) > n:
+                self.buffers[0] = buf[n:]
+                break
+            n -= len(buf)
+            self.buffers.popleft()
+
+    def clear(self):
+        self.buffers.clear()
+        self.size = 0
+
+
+class ReceiveBuffer(object):
+    """ Data read from a socket that hasn't been used yet. Data is read with recv_into() straight
+        into a bytearray and used data is tracked with an offset, so what remains is only moved
+        when space is needed. Parsers are given a memoryview of the unused data by view(), which
+        is only valid until the next recv() or append().
+    """
+    READ_SIZE = 65536
+
+    def __init__(self, read_size=None):
+        self.read_size = read_size or self.READ_SIZE
+        self.buffer = bytearray()
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def view(self):
+        return memoryview(self.buffer)[self.start:self.end]
+
+    def recv(self, sock, flags=0):
+        """ Read up to read_size bytes from the socket. Socket errors are not caught.
+        :param sock: The socket to read from.
+        :param flags: Flags for the recv call.
+        :return: The number of bytes read, 0 at the end of the stream.
+        """
+        self._reserve(self.read_size)
+        n = sock.recv_into(memoryview(self.buffer)[self.end:], self.read_size, flags)
+        self.end += n
+        return n
+
+    def append(self, data):
+        """ Add data that has already been read. """
+        self._reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def consume(self, n):
+        """ Mark n bytes from the start of the buffer as used. """
+        self.start += n
+        if self.start >= self.end:
+            self.start = self.end = 0
+
+    def clear(self):
+        self.start = self.end = 0
+
+    def _reserve(self, n):
+        """ Make sure there is space for n more bytes after the data held. """
+        if len(self.buffer) - self.end >= n:
+            return
+        size = self.end - self.start
+        if len(self.buffer) - size >= n:
+            self.buffer[:size] = self.buffer[self.start:self.end]
+        else:
+            # A new buffer is used, as a bytearray can't be resized while views of it exist.
+            buf = bytearray(max(2 * len(self.buffer), size + n))
+            buf[:size] = self.buffer[self.start:self.end]
+            self.buffer = buf
+        self.start, self.end = 0, size
@@ -0,0 +1,410 @@
+""" Caches used by the servers to avoid repeated disk access.
+"""
+from collections import OrderedDict
+from email.utils import formatdate
+import mimetypes
+import os
+import threading
+
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
+
+from atavism.http11.compression import compress
+from atavism.http11.content import FileHandle
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+
+class SegmentCache(object):
+    """ A least recently used cache of file contents, limited to max_bytes in total. Entries are
+        keyed by the path, modification time and size of the file, so a file that has changed
+        is never served from the cache. Files larger than max_item are never cached.
+    """
+    name = 'cache'
+
+    def __init__(self, max_bytes, max_item=None):
+        self.max_bytes = max_bytes
+        self.max_item = max_item or max_bytes // 4
+        self.size = 0
+        self.entries = OrderedDict()
+        self.paths = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, filename, st=None):
+        """ Get the contents of a file, reading it into the cache if required.
+        :param filename: The file to get.
+        :param st: The result of os.stat() for the file, if already known.
+        :return: The contents of the file or None if it shouldn't be cached.
+        """
+        if st is None:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                return None
+        return self._get((filename, st.st_mtime, st.st_size), st)
+
+    def _get(self, key, st):
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is not None:
+                self.entries[key] = data
+                self.hits += 1
+                return data
+            self.misses += 1
+
+        if st.st_size > self.max_item:
+            return None
+        try:
+            with open(key[0], 'rb') as fh:
+                data = fh.read()
+        except (IOError, OSError):
+            return None
+        if len(data) != st.st_size:
+            # The file is being written, so don't keep it.
+            return self.transform(key, data)
+        data = self.transform(key, data)
+        self.add(key, data)
+        return data
+
+    def transform(self, key, data):
+        """ Change the contents of a file before they are cached. """
+        return data
+
+    def add(self, key, data):
+        with self.lock:
+            old = self.paths.get(self._variant(key))
+            if old is not None:
+                self._remove(old)
+            self.entries[key] = data
+            self.paths[self._variant(key)] = key
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        data = self.entries.pop(key, None)
+        if data is not None:
+            self.size -= len(data)
+        if self.paths.get(self._variant(key)) == key:
+            del self.paths[self._variant(key)]
+
+    def _variant(self, key):
+        """ The part of the key that identifies an entry replaced when the file changes. """
+        return key[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.paths.clear()
+            self.size = 0
+
+    def stats(self):
+        return {self.name + '_hits': self.hits,
+                self.name + '_misses': self.misses,
+                self.name + '_evictions': self.evictions,
+                self.name + '_entries': len(self.entries),
+                self.name + '_bytes': self.size}
+
+
+class CompressedCache(SegmentCache):
+    """ Cache the compressed versions of small files, such as static playlists, so repeated
+        requests never compress them twice. Files larger than max_item are never compressed
+        in advance.
+    """
+    name = 'compressed'
+
+    def __init__(self, policy, max_bytes=1024 * 1024, max_item=65536):
+        SegmentCache.__init__(self, max_bytes, max_item)
+        self.policy = policy
+
+    def get(self, filename, method, st=None):
+        """ Get the contents of a file compressed using method.
+        :return: The compressed data or None if it shouldn't be cached.
+        """
+        if st is None:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                return None
+        return self._get((filename, st.st_mtime, st.st_size, method, self.policy.level), st)
+
+    def _variant(self, key):
+        return key[0], key[3]
+
+    def transform(self, key, data):
+        return compress(data, key[3], key[4])
+
+
+class FileInfo(object):
+    """ The details of a file needed to serve it and to validate conditional requests. """
+    __slots__ = ('filename', 'stat', 'etag', 'last_modified', 'mtime', 'content_type')
+
+    def __init__(self, filename, st):
+        self.filename = filename
+        self.stat = st
+        self.content_type = mimetypes.guess_type(filename)[0]
+        self.mtime = int(st.st_mtime)
+        self.etag = '"{:x}-{:x}-{:x}"'.format(st.st_ino, st.st_size, int(st.st_mtime * 1000000))
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+
+    @property
+    def size(self):
+        return self.stat.st_size
+
+    def etag_for(self, coding=None):
+        """ The strong ETag for the file sent with a content-coding, e.g. 'gzip'. Each coding
+            needs a tag of it's own, as the bytes sent differ.
+        """
+        if not coding:
+            return self.etag
+        return '{}-{}"'.format(self.etag[:-1], coding)
+
+
+class StatCache(object):
+    """ Cache the result of os.stat() for files being served, so repeated requests for the same
+        file within ttl seconds don't need to touch the filesystem. Files that don't exist are
+        also remembered. The strong ETag is built from the inode, size and modification time.
+    """
+    def __init__(self, ttl=1.0, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, filename):
+        """ Get the details of a file.
+        :param filename: The file to check.
+        :return: FileInfo or None if the file doesn't exist.
+        """
+        now = monotonic()
+        with self.lock:
+            info = self.entries.get(filename)
+        if info is not None and now - info[0] < self.ttl:
+            return info[1]
+
+        try:
+            st = os.stat(filename)
+            fi = FileInfo(filename, st)
+        except OSError:
+            fi = None
+        with self.lock:
+            self.entries.pop(filename, None)
+            self.entries[filename] = (now, fi)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return fi
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DirectoryIndex(object):
+    """ The details of every file in a directory, so requests can be served without touching
+        the filesystem. The directory itself is checked at most every ttl seconds and is only
+        scanned again when it's modification time has changed, or max_age seconds have passed.
+        A file that is looked up is stat'ed again once it's details are more than ttl seconds
+        old, so changes made in place are noticed. Writers can also call update() for a file.
+        Files in subdirectories are found using an index of each subdirectory, made when it is
+        first needed. Only files in an index are ever returned, so a path can't reach outside
+        the directory.
+        A FileHandle is kept open for the max_open files most recently looked up.
+    """
+    def __init__(self, directory, ttl=1.0, max_age=30.0, max_open=64):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_age = max_age
+        self.max_open = max_open
+        self.entries = {}
+        self.verified = {}
+        self.subdirs = {}
+        self.indexes = {}
+        self.handles = OrderedDict()
+        self.checked = None
+        self.scanned = None
+        self.dir_mtime = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        self._check()
+        return len(self.entries)
+
+    @staticmethod
+    def names(path):
+        """ The names of the directories and file a URL path refers to, or None if it could
+            refer to something outside the directory.
+        """
+        path = unquote(path.split('?', 1)[0])
+        parts = [p for p in path.split('/') if p not in ('', '.')]
+        if len(parts) == 0 or any(p == '..' or '\0' in p or os.sep in p for p in parts):
+            return None
+        return parts
+
+    def lookup(self, path):
+        """ Find the file for a URL path.
+        :param path: The path, relative to the directory.
+        :return: FileInfo or None if there is no such file.
+        """
+        names = self.names(path)
+        if names is None:
+            return None
+        return self._lookup(names)
+
+    def _lookup(self, names):
+        self._check()
+        if len(names) > 1:
+            index = self._subindex(names[0])
+            return index._lookup(names[1:]) if index is not None else None
+        name = names[0]
+        info = self.entries.get(name)
+        if info is not None and monotonic() - self.verified.get(name, 0) >= self.ttl:
+            info = self._verify(name, info)
+        if info is not None and self.max_open > 0:
+            self._keep(info)
+        return info
+
+    def _verify(self, name, info):
+        """ Check a file hasn't changed since it's details were found. """
+        try:
+            st = os.stat(info.filename)
+        except OSError:
+            return self.update(name)
+        if st.st_mtime != info.stat.st_mtime or st.st_size != info.stat.st_size or st.st_ino != info.stat.st_ino:
+            return self.update(name)
+        self.verified[name] = monotonic()
+        return info
+
+    def _subindex(self, name):
+        """ The index of a subdirectory, or None if there is no such subdirectory. """
+        with self.lock:
+            if name not in self.subdirs:
+                return None
+            index = self.indexes.get(name)
+            if index is None:
+                index = self.indexes[name] = DirectoryIndex(os.path.join(self.directory, name), self.ttl,
+                                                            self.max_age, self.max_open)
+            return index
+
+    def update(self, filename):
+        """ Update the details of one file, after it has been written or removed.
+        :param filename: The name of the file, or it's path.
+        :return: The FileInfo for the file, or None if it no longer exists.
+        """
+        name = os.path.basename(filename)
+        fn = os.path.join(self.directory, name)
+        now = monotonic()
+        try:
+            info = FileInfo(fn, os.stat(fn))
+        except OSError:
+            info = None
+        with self.lock:
+            entries = dict(self.entries)
+            if info is not None:
+                entries[name] = info
+                self.verified[name] = now
+            else:
+                entries.pop(name, None)
+                self.verified.pop(name, None)
+            self.entries = entries
+            self._release_stale()
+        return info
+
+    def refresh(self):
+        """ Scan the directory now. """
+        with self.lock:
+            self._scan(monotonic())
+
+    def close(self):
+        with self.lock:
+            for fh in self.handles.values():
+                fh.release()
+            self.handles.clear()
+            indexes = list(self.indexes.values())
+            self.indexes.clear()
+        for index in indexes:
+            index.close()
+
+    def _check(self):
+        now = monotonic()
+        if self.checked is not None and now - self.checked < self.ttl:
+            return
+        with self.lock:
+            if self.checked is not None and now - self.checked < self.ttl:
+                return
+            self.checked = now
+            try:
+                mtime = os.stat(self.directory).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != self.dir_mtime or self.scanned is None or now - self.scanned >= self.max_age:
+                self.dir_mtime = mtime
+                self._scan(now)
+
+    def _scan(self, now):
+        self.checked = self.scanned = now
+        root = os.path.realpath(self.directory)
+        entries = {}
+        subdirs = set()
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+        for name in names:
+            fn = os.path.join(self.directory, name)
+            try:
+                if os.path.islink(fn) and not os.path.realpath(fn).startswith(root + os.sep):
+                    continue
+                st = os.stat(fn)
+            except OSError:
+                continue
+            if os.path.isdir(fn):
+                subdirs.add(name)
+                continue
+            if not os.path.isfile(fn):
+                continue
+            info = self.entries.get(name)
+            if info is None or info.stat.st_mtime != st.st_mtime or info.stat.st_size != st.st_size or \
+                    info.stat.st_ino != st.st_ino:
+                info = FileInfo(fn, st)
+            entries[name] = info
+        self.entries = entries
+        self.verified = dict.fromkeys(entries, now)
+        self.subdirs = subdirs
+        for name in [n for n in self.indexes if n not in subdirs]:
+            self.indexes.pop(name).close()
+        self._release_stale()
+
+    def _keep(self, info):
+        key = (info.filename, info.stat.st_mtime, info.stat.st_size)
+        with self.lock:
+            if key in self.handles:
+                # Move it to the end, OrderedDict.move_to_end() isn't in Python 2.
+                self.handles[key] = self.handles.pop(key)
+                return
+            try:
+                self.handles[key] = FileHandle.acquire(info.filename, info.stat)
+            except OSError:
+                return
+            while len(self.handles) > self.max_open:
+                self.handles.popitem(last=False)[1].release()
+
+    def _release_stale(self):
+        """ Release the handles of files that have changed or gone. """
+        current = set((i.filename, i.stat.st_mtime, i.stat.st_size) for i in self.entries.values())
+        for key in [k for k in self.handles if k not in current]:
+            self.handles.pop(key).release()
@@ -1,6 +1,7 @@
 """ A multithreaded, keep-alive HTTP/1.1 client object that can handle multiple
     connections.
 """
+from collections import OrderedDict
 import socket
 import select
 
@@ -10,7 +11,9 @@ except ImportError:
     from urllib import urlencode, quote
 
 from atavism import __version__
+from atavism.http11.buffers import ReceiveBuffer
 from atavism.http11.objects import HttpRequest, HttpResponse
+from atavism.http11.sockets import SocketOptions
 from atavism.http11.cookies import CookieJar
 
 
@@ -21,19 +24,26 @@ class HttpClientError(Exception):
 class HttpClient(object):
     """ Http Client class. Implements an HTTP 1.1 client which uses keepalive by default.
         Requests can always be made, but may block if another request is being processed.
+        The socket is set up using socket_options, a SocketOptions.
+        Responses to request() that carry an ETag or Last-Modified are kept, so when the same
+        URL is fetched again the validators are sent and a 304 returns the kept response.
     """
     TIMEOUT = 5.0
+    CACHE_ENTRIES = 32
+    READ_SIZE = 65536
 
-    def __init__(self, host, port=80):
+    def __init__(self, host, port=80, socket_options=None):
         self.host = host
         self.port = port
         self.socket = None
+        self.socket_options = socket_options or SocketOptions()
 
         self.cookies = CookieJar()
         self.user_agent = 'atavism/{}'.format(__version__)
 
         self.timeout = self.TIMEOUT
-        self._buffer = b''
+        self._buffer = ReceiveBuffer(self.READ_SIZE)
+        self.cached = OrderedDict()
 
         if isinstance(self.host, bytes):
             self.host = self.host.decode()
@@ -79,7 +89,23 @@ class HttpClient(object):
         return True
 
     def request(self, uri, qry=None):
-        return self._make_send_request('GET', uri, qry=qry)
+        url = self._make_url(uri, qry)
+        cached = self.cached.get(url)
+        hdrs = {}
+        if cached is not None:
+            if cached.get('etag') is not None:
+                hdrs['If-None-Match'] = cached.get('etag')
+            if cached.get('last-modified') is not None:
+                hdrs['If-Modified-Since'] = cached.get('last-modified')
+        resp = self._make_send_request('GET', uri, qry=qry, hdrs=hdrs)
+        if resp.code == 304 and cached is not None:
+            return cached
+        self.cached.pop(url, None)
+        if resp.code == 200 and (resp.get('etag') is not None or resp.get('last-modified') is not None):
+            self.cached[url] = resp
+            while len(self.cached) > self.CACHE_ENTRIES:
+                self.cached.popitem(last=False)
+        return resp
 
     def post_data(self, uri, qry=None, data=None, ct=None):
         """ Submit a POST request with the supplied data. """
@@ -143,7 +169,7 @@ class HttpClient(object):
         """
         if self.socket is None:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self.socket_options.connection(sock, connected=False)
             sock.settimeout(5)
             try:
                 sock.connect((str(self.host), self.port))
@@ -160,7 +186,7 @@ class HttpClient(object):
         if self.socket is not None:
             self.socket.close()
             self.socket = None
-        self._buffer = b''
+        self._buffer.clear()
 
     def _process_request(self, request):
         """ Process a single request.
@@ -195,7 +221,10 @@ class HttpClient(object):
             raise HttpClientError("Unable to send the request.")
 
         # Receive the whole response...
-        response = HttpResponse(self._buffer)
+        response = HttpResponse()
+        # The response to a HEAD request has no body.
+        response.headers_only = request.method.upper() == 'HEAD'
+        self._buffer.consume(response.read_content(self._buffer.view()))
         while not response.is_complete():
             r, w, e = select.select([self.socket], [], [self.socket], self.timeout)
             if len(e):
@@ -203,14 +232,10 @@ class HttpClient(object):
                 break
 
             if len(r):
-                data = self.socket.recv(2048)
-                if len(data) == 0:
+                if self._buffer.recv(self.socket) == 0:
                     response.mark_complete()
                     break
-                self._buffer += data
-#                print(self._buffer)
-                r = response.read_content(self._buffer)
-                self._buffer = self._buffer[r:]
+                self._buffer.consume(response.read_content(self._buffer.view()))
 
             if response.is_complete():
                 break
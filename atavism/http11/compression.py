@@ -0,0 +1,78 @@
+""" Deciding what should be compressed, and how.
+"""
+import zlib
+
+
+def accepted_encoding(accept, methods=('gzip', 'deflate')):
+    """ Choose the encoding to use for a response from an Accept-Encoding header.
+    :param accept: The value of the header, or None.
+    :param methods: The encodings available, in order of preference.
+    :return: The encoding to use or None.
+    """
+    if not accept:
+        return None
+    quality = {}
+    for part in accept.split(','):
+        bits = [b.strip() for b in part.split(';')]
+        q = 1.0
+        for param in bits[1:]:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        quality[bits[0].lower()] = q
+
+    best = None
+    for method in methods:
+        q = quality.get(method, quality.get('*', 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (method, q)
+    return best[0] if best is not None else None
+
+
+def compressor(method, level):
+    """ Create a zlib compressor object for the encoding.
+    :param method: 'gzip' or 'deflate'
+    :param level: The compression level, 1-9.
+    :return: The compressor.
+    """
+    # gzip needs the gzip header and trailer, HTTP deflate is the zlib format.
+    wbits = 16 + zlib.MAX_WBITS if method == 'gzip' else zlib.MAX_WBITS
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+
+def compress(data, method, level):
+    """ Compress all of the data in one go. """
+    zobj = compressor(method, level)
+    return zobj.compress(data) + zobj.flush()
+
+
+class CompressionPolicy(object):
+    """ Which content is worth compressing. Media such as MPEG-TS and MP4 is already compressed,
+        so only types in COMPRESSIBLE (and text/*) are compressed, and only when there is at
+        least min_size bytes of it.
+    """
+    COMPRESSIBLE = frozenset(['application/vnd.apple.mpegurl', 'application/x-mpegurl', 'audio/mpegurl',
+                              'audio/x-mpegurl', 'application/dash+xml', 'application/json',
+                              'application/javascript', 'application/xml', 'image/svg+xml'])
+
+    def __init__(self, level=6, min_size=256):
+        self.level = level
+        self.min_size = min_size
+
+    def applies(self, content_type, size=None):
+        """ Should content of this type and size be compressed?
+        :param content_type: The MIME type of the content.
+        :param size: The length of the content, if known.
+        :return: True or False
+        """
+        if self.level == 0 or content_type is None:
+            return False
+        if size is not None and size < self.min_size:
+            return False
+        content_type = content_type.split(';')[0].strip().lower()
+        return content_type.startswith('text/') or content_type in self.COMPRESSIBLE
+
+
+DEFAULT_POLICY = CompressionPolicy()
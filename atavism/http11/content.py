@@ -1,9 +1,15 @@
+import errno
 import gzip
 import json
 from lxml import etree
 import mimetypes
+import mmap
 import os
+import threading
 import zlib
+from collections import deque
+
+from atavism.http11.compression import DEFAULT_POLICY, compressor
 
 try:
     from cStringIO import StringIO as GzipIO
@@ -15,6 +21,16 @@ try:
 except ImportError:
     from plistlib import readPlistFromString as plist_loads
 
+# Some systems map .ts to Qt translation files.
+mimetypes.add_type('video/mp2t', '.ts')
+
+LAST_CHUNK = b'0\r\n\r\n'
+
+
+def chunk(data):
+    """ Frame data as a single chunk for chunked transfer encoding. """
+    return b'%X\r\n' % len(data) + data + b'\r\n'
+
 
 class Content(object):
     """ Class to manage content for an HTTP transaction (i.e. a Request or a Response).
@@ -32,6 +48,7 @@ class Content(object):
     CRLF = b'\r\n'
     RANGE_BOUNDARY = 'One_At_A_Time_Please'
     MAX_SEND = 2048
+    MAX_CHUNK_LINE = 1024
 
     def __init__(self, data=None, content_sz=None, content_type=None, charset=None):
         self._buffer = b''
@@ -69,6 +86,14 @@ class Content(object):
             return self._next.__getitem__(item)
         return self._buffer.__getitem__(item)
 
+    def _read(self, start, stop):
+        """ Read data held by this instance, ignoring any chained content.
+        :param start: Offset of the first byte.
+        :param stop: Offset after the last byte.
+        :return: The data.
+        """
+        return self._buffer[start:stop]
+
     def reset(self):
         self.compression = None
         self.content_type = None
@@ -86,23 +111,22 @@ class Content(object):
         else:
             self.compression = method
 
-    def compress(self):
+    def compress(self, policy=None):
+        """ Arrange for the content to be compressed as it's sent, if the policy says it's
+            worth doing.
+        :param policy: The CompressionPolicy to use, DEFAULT_POLICY if not given.
+        :return: None
+        """
         if self._next is not None:
-            self._next.compress()
-        if self.is_compressed:
+            return self._next.compress(policy)
+        if self.is_compressed or not self.compression:
             return
-        elif self.compression == 'gzip':
-            zbuf = GzipIO()
-            zfile = gzip.GzipFile(mode='wb',  fileobj=zbuf, compresslevel=9)
-            zfile.write(self._buffer)
-            zfile.close()
-            ct = self._add_next(zbuf.getvalue())
-            ct.is_compressed = True
-            ct.compression = 'gzip'
-        elif self.compression == 'deflate':
-            ct = self._add_next(zlib.compress(self._buffer))
-            ct.is_compressed = True
-            ct.compression = 'deflate'
+        policy = policy or DEFAULT_POLICY
+        self.check_content_type()
+        if not policy.applies(self.content_type, len(self)):
+            self.compression = False
+            return
+        self._next = CompressedContent(self, self.compression, policy.level)
 
     def decompress(self):
         if self._next is not None:
@@ -129,17 +153,21 @@ class Content(object):
         if self.finished:
             return consumed
 
+        if not isinstance(self._buffer, bytearray):
+            # Appending to bytes copies everything held each time, a bytearray doesn't.
+            self._buffer = bytearray(self._buffer)
         if self.content_sz == 'chunked':
-            if self.CRLF not in cntnt:
-                return 0
             pos = 0
             while True:
-                if self.CRLF not in cntnt[pos:]:
+                # The data may be a memoryview, so only the size line is copied to search it.
+                line = bytes(cntnt[pos:pos + self.MAX_CHUNK_LINE])
+                idx = line.find(self.CRLF)
+                if idx < 0:
                     return pos
 
-                chunk_len, ignored = cntnt[pos:].split(self.CRLF, 1)
-                cr = len(chunk_len) + 2
-                chunk_len = int(chunk_len, 16)
+                cr = idx + 2
+                # ignore any chunk extensions
+                chunk_len = int(line[:idx].split(b';')[0], 16)
 
                 if pos + cr + chunk_len + 2 > len(cntnt):
                     break
@@ -164,9 +192,16 @@ class Content(object):
                 self.finished = True
 
         if self.finished:
-            self.decompress()
+            self.mark_complete()
         return consumed
 
+    def mark_complete(self):
+        """ Record that all the content has been read. """
+        self.finished = True
+        if isinstance(self._buffer, bytearray):
+            self._buffer = bytes(self._buffer)
+        self.decompress()
+
     def add_content(self, cntnt):
         """ Add content to the buffer. If the data is from a network stream, read_content() should be used instead.
         :param data: The data to be added.
@@ -190,15 +225,16 @@ class Content(object):
             return self._next.decoded_content()
 
         self.check_content_type()
-        if self.content_type is None or self.content_type in ('text/plain', 'text/html'):
+        media = self.content_type.split(';')[0] if self.content_type is not None else None
+        if media is None or media in ('text/plain', 'text/html'):
             if self.charset is not None:
                 return self._buffer.decode(self.charset)
             return self._buffer.decode()
 
         try:
-            if self.content_type in ['text/x-apple-plist+xml', 'application/x-apple-binary-plist']:
+            if media in ['text/x-apple-plist+xml', 'application/x-apple-binary-plist']:
                 return plist_loads(self._buffer)
-            elif self.content_type == 'text/parameters':
+            elif media == 'text/parameters':
                 dd = {}
                 for line in self._buffer.split(b'\n'):
                     if line == b'':
@@ -206,12 +242,12 @@ class Content(object):
                     k, v = line.split(b':', 1)
                     dd[k] = v.strip()
                 return dd
-            elif self.content_type == 'application/json':
+            elif media == 'application/json':
                 return json.loads(self._buffer.decode())
-            elif self.content_type == 'application/xml':
+            elif media == 'application/xml':
                 return etree.fromstring(self._buffer.decode())
-            elif self.content_type == 'multipart/byteranges':
-                boundary = self.charset.split('=', 1)[1]
+            elif media == 'multipart/byteranges':
+                boundary = self.content_type.split('boundary=', 1)[1].split(';')[0].strip()
                 start = self._buffer.find(b'--')
                 if start == -1:
                     return []
@@ -234,9 +270,18 @@ class Content(object):
         return obj
 
     def check_content_type(self):
+        """ Move any charset parameter of the content type into charset. Other parameters are
+            kept in the content type.
+        """
         if self.content_type is not None and ';' in self.content_type:
-            self.content_type, self.charset = [p.strip() for p in self.content_type.split(';')]
-            self.charset = self.charset.replace('charset=', '').strip()
+            parts = [p.strip() for p in self.content_type.split(';')]
+            params = []
+            for p in parts[1:]:
+                if p.lower().startswith('charset='):
+                    self.charset = p[8:].strip()
+                elif p:
+                    params.append(p)
+            self.content_type = '; '.join(parts[:1] + params)
 
     def header_lines(self):
         if self._next is not None:
@@ -254,60 +299,110 @@ class Content(object):
             rv["Content-Length"] = "{}".format(len(self))
         if self.compression:
             rv["Content-Encoding"] = self.compression
-            rv["Vary"] = 'Content-Encoding'
+            rv["Vary"] = 'Accept-Encoding'
         return rv
 
-    def next(self, pkt_len):
+    def next(self, pkt_len, max_send=None):
+        """ Get the next block of content to send.
+        :param pkt_len: Length of data already in the packet being sent.
+        :param max_send: Maximum size of the packet, MAX_SEND if not given.
+        :return: The data.
+        """
         if self._next is not None:
-            return self._next.next(pkt_len)
-        if len(self) == 0:
-            self.send_complete = True
-            return b''
-        avail = min(self.MAX_SEND - pkt_len, len(self) - self.send_position)
-        if avail == 0:
+            return self._next.next(pkt_len, max_send)
+        chunked = self.content_sz == 'chunked'
+        remaining = len(self) - self.send_position
+        if remaining <= 0:
+            if self.send_complete:
+                return b''
             self.send_complete = True
+            return LAST_CHUNK if chunked else b''
+        avail = min((max_send or self.MAX_SEND) - pkt_len - (16 if chunked else 0), remaining)
+        if avail <= 0:
             return b''
-        if self.content_sz == 'chunked':
-            avail -= 8
         rv = self[self.send_position: self.send_position + avail]
         self.send_position += len(rv)
-        if self.content_sz == 'chunked':
-            return "{:4X}\r\n{}\r\n".format(len(rv), rv)
+        if chunked:
+            return chunk(rv)
         return rv
 
+    def ready(self):
+        """ Can next() return data without waiting? Only content read from a stream ever waits.
+        :return: True or False
+        """
+        if self._next is not None:
+            return self._next.ready()
+        return True
+
+    def when_ready(self, callback):
+        """ Arrange for callback() to be called, from any thread, once the content is ready.
+            If it's ready now, callback() is called immediately.
+        """
+        if self._next is not None:
+            return self._next.when_ready(callback)
+        callback()
+
+    def wait_ready(self, timeout=None):
+        """ Wait up to timeout seconds for the content to be ready.
+        :return: True if the content is ready.
+        """
+        if self._next is not None:
+            return self._next.wait_ready(timeout)
+        return True
+
+    def file_region(self):
+        """ If the data still to be sent can be sent directly from a file, return the details
+            needed to do so.
+        :return: Tuple of (file descriptor, offset, length) or None.
+        """
+        if self._next is not None:
+            return self._next.file_region()
+        return None
+
+    def _fileno(self):
+        """ The file descriptor that holds the data for this instance, if there is one. """
+        return None
+
+    def close(self):
+        """ Release any resources held once the content is no longer needed. """
+        if self._next is not None:
+            self._next.close()
+
+    def advance(self, n):
+        """ Record that n bytes have been sent without using next().
+        :param n: Number of bytes sent.
+        :return: None
+        """
+        if self._next is not None:
+            return self._next.advance(n)
+        self.send_position += n
+        if self.send_position >= len(self):
+            self.send_complete = True
+
     def create_ranged_output(self, ranges):
-        """ If we have been asked for byte ranges, then we create them in a new Content object with
-            the appropriate formatting. We need to use the current content for the ranges, but as that
-            content could have been manipulated already (or be a file object), we need to access it
-            correctly.
+        """ If we have been asked for byte ranges, then we create a new Content object that provides
+            a view of the ranges with the appropriate formatting. The data for the ranges is read from
+            this content as it's sent, so it's never copied. As the current content could have been
+            manipulated already (or be a file object), we need to access it correctly.
         :param ranges: List of the ranges to be processed.
-        :return: None.
+        :return: Dict of headers to add to the response.
         """
-        hdrs = {}
         if self._next is not None:
             return self._next.create_ranged_output(ranges)
 
         if len(ranges) == 0:
             return
 
-        self.check_content_type()
-        ct = self.content_type if len(ranges) == 1 else 'multipart/byteranges; boundary={}'.format(self.RANGE_BOUNDARY)
-        cntnt = Content(content_type=ct, charset=self.charset)
+        # Ranges are of the content as it is, so we don't compress them.
+        self.compression = False
         content_len = len(self)
-
         if len(ranges) > 1:
-            for r in ranges:
-                cntnt.add_content("--{}\r\nContent-Type: {}\r\nContent-Range: bytes={}\r\n\r\n".format(
-                    self.RANGE_BOUNDARY, self.content_type, r.absolute_range(content_len)))
-                start, end = r.absolutes(content_len)
-                cntnt.add_content(self[start:end + 1])
-            cntnt.add_content("--{}--\r\n".format(self.RANGE_BOUNDARY))
-        else:
-            start, end = ranges[0].absolutes(content_len)
-            cntnt.add_content(self[start: end + 1])
-            hdrs['Content-Range'] = 'bytes {}'.format(ranges[0].absolute_range(content_len))
-        self._next = cntnt
-        return hdrs
+            self._next = MultipartRangeContent(self, ranges, self.RANGE_BOUNDARY)
+            return {}
+
+        start, end = ranges[0].absolutes(content_len)
+        self._next = RangeContent(self, start, end)
+        return {'Content-Range': 'bytes {}'.format(ranges[0].absolute_range(content_len))}
 
     def _add_next(self, data=None, content_type=None):
         self.check_content_type()
@@ -317,19 +412,424 @@ class Content(object):
         self._next = ct
         return ct
 
+class CompressedContent(Content):
+    """ The content of another Content object, compressed as it is sent. As the final length
+        isn't known, it's sent using chunked transfer encoding.
+    """
+    READ_SIZE = 65536
+
+    def __init__(self, source, method, level):
+        Content.__init__(self, content_type=source.content_type, charset=source.charset)
+        self.source = source
+        self.compression = method
+        self.is_compressed = True
+        self.content_sz = 'chunked'
+        self.finished = True
+        self.read_position = 0
+        self.total = len(source)
+        self.compressor = compressor(method, level)
+
+    def header_lines(self):
+        rv = Content.header_lines(self)
+        rv.pop('Content-Length', None)
+        return rv
+
+    def next(self, pkt_len, max_send=None):
+        """ Compress the next block of the source and return it as a chunk. Input is read in
+            READ_SIZE blocks until the compressor has some output, so the chunk may be larger
+            than max_send. The last chunk is followed by the terminator.
+        """
+        if self.send_complete:
+            return b''
+        data = b''
+        while len(data) == 0 and self.read_position < self.total:
+            stop = min(self.total, self.read_position + self.READ_SIZE)
+            block = self.source._read(self.read_position, stop)
+            if not block:
+                break
+            self.read_position += len(block)
+            data = self.compressor.compress(block)
+        if len(data) > 0:
+            return chunk(data)
+
+        self.send_complete = True
+        data = self.compressor.flush()
+        if len(data) > 0:
+            return chunk(data) + LAST_CHUNK
+        return LAST_CHUNK
+
+    def file_region(self):
+        return None
+
+
+class StreamContent(Content):
+    """ Content of unknown length read from an iterator, a file-like object or a pipe (given as
+        a file descriptor), sent using chunked transfer encoding as it becomes available.
+        The source is read by a thread of it's own into a buffer of at most max_buffer bytes.
+        When the buffer is full the source isn't read until the client has taken some of it,
+        so a slow client holds up the source rather than using more memory, and the server is
+        never blocked waiting for the source.
+    """
+    BLOCK_SIZE = 65536
+    MAX_BUFFER = 1024 * 1024
+
+    def __init__(self, source, content_type=None, max_buffer=None, block_size=None):
+        Content.__init__(self, content_sz='chunked', content_type=content_type)
+        self.source = source
+        self.max_buffer = max_buffer or self.MAX_BUFFER
+        self.block_size = block_size or self.BLOCK_SIZE
+        self.finished = True
+        self.blocks = deque()
+        self.buffered = 0
+        self.eof = False
+        self.error = None
+        self.closed = False
+        self.listener = None
+        self.compressor = None
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def _start(self):
+        if self.thread is None and not self.closed:
+            self.thread = threading.Thread(target=self._reader)
+            self.thread.name = 'StreamContent'
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _blocks(self):
+        if isinstance(self.source, int):
+            while True:
+                yield os.read(self.source, self.block_size)
+        elif hasattr(self.source, 'read'):
+            # read1() returns whatever is available, rather than waiting for a full block.
+            read = getattr(self.source, 'read1', self.source.read)
+            while True:
+                yield read(self.block_size)
+        else:
+            for block in self.source:
+                yield block if not isinstance(block, str) else block.encode()
+
+    def _reader(self):
+        try:
+            for block in self._blocks():
+                if self.closed:
+                    break
+                if len(block) == 0:
+                    if isinstance(self.source, int) or hasattr(self.source, 'read'):
+                        break
+                    continue
+                with self.cond:
+                    while self.buffered >= self.max_buffer and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        break
+                    self.blocks.append(block)
+                    self.buffered += len(block)
+                self._notify()
+        except (IOError, OSError, ValueError) as e:
+            self.error = e
+        finally:
+            with self.cond:
+                self.eof = True
+            self._close_source()
+            self._notify()
+
+    def _close_source(self):
+        if isinstance(self.source, int):
+            os.close(self.source)
+        elif hasattr(self.source, 'close'):
+            self.source.close()
+
+    def _notify(self):
+        with self.cond:
+            listener, self.listener = self.listener, None
+            self.cond.notify_all()
+        if listener is not None:
+            listener()
+
+    def _ready(self):
+        return len(self.blocks) > 0 or self.eof or self.send_complete
+
+    def ready(self):
+        self._start()
+        with self.cond:
+            return self._ready()
+
+    def when_ready(self, callback):
+        self._start()
+        with self.cond:
+            if not self._ready():
+                self.listener = callback
+                return
+        callback()
+
+    def wait_ready(self, timeout=None):
+        self._start()
+        with self.cond:
+            if not self._ready():
+                self.cond.wait(timeout)
+            return self._ready()
+
+    def compress(self, policy=None):
+        """ The length isn't known, so the content is compressed as it is sent if the type
+            is suitable.
+        """
+        if self.is_compressed or not self.compression:
+            return
+        policy = policy or DEFAULT_POLICY
+        self.check_content_type()
+        if not policy.applies(self.content_type):
+            self.compression = False
+            return
+        self.compressor = compressor(self.compression, policy.level)
+
+    def next(self, pkt_len, max_send=None):
+        if self.send_complete:
+            return b''
+        self._start()
+        want = max((max_send or self.MAX_SEND) - pkt_len - 16, 1)
+        parts = []
+        with self.cond:
+            while self.blocks and want > 0:
+                block = self.blocks.popleft()
+                if len(block) > want:
+                    self.blocks.appendleft(block[want:])
+                    block = block[:want]
+                parts.append(block)
+                want -= len(block)
+                self.buffered -= len(block)
+            self.cond.notify_all()
+            eof = self.eof and len(self.blocks) == 0
+
+        if eof and self.error is not None:
+            # The client must not think the content is complete.
+            raise IOError(errno.EIO, "Unable to read the stream: {}".format(self.error))
+        data = b''.join(parts)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+            if eof:
+                data += self.compressor.flush()
+        rv = chunk(data) if len(data) > 0 else b''
+        if eof:
+            self.send_complete = True
+            rv += LAST_CHUNK
+        return rv
+
+    def close(self):
+        """ Stop reading the source. If the reader is waiting for the source it will be
+            closed once that read returns.
+        """
+        with self.cond:
+            self.closed = True
+            self.listener = None
+            self.blocks.clear()
+            self.buffered = 0
+            self.cond.notify_all()
+        if self.thread is None and not self.eof:
+            self.eof = True
+            self._close_source()
+
+
+class RangeContent(Content):
+    """ A single byte range of another Content object. The data isn't copied, it's read from
+        the source as it is sent.
+    """
+    def __init__(self, source, start, end):
+        source.check_content_type()
+        Content.__init__(self, content_type=source.content_type, charset=source.charset)
+        self.source = source
+        self.start = start
+        self.end = end
+        self.finished = True
+
+    def __len__(self):
+        return self.end - self.start + 1
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, ignored = item.indices(len(self))
+            return self._read(start, stop)
+        return self._read(item, item + 1)
+
+    def _read(self, start, stop):
+        return self.source._read(self.start + start, self.start + min(stop, len(self)))
+
+    @property
+    def content(self):
+        return self[:]
+
+    def file_region(self):
+        fd = self.source._fileno()
+        if fd is None or self.send_position >= len(self):
+            return None
+        return fd, self.start + self.send_position, len(self) - self.send_position
+
+
+class MultipartRangeContent(Content):
+    """ A number of byte ranges from another Content object, formatted as multipart/byteranges.
+        Only the headers for each part are held in memory, the data for each range is read from
+        the source as it is sent.
+    """
+    def __init__(self, source, ranges, boundary):
+        source.check_content_type()
+        Content.__init__(self, content_type='multipart/byteranges; boundary={}'.format(boundary))
+        self.source = source
+        self.finished = True
+        self.parts = []
+        self.length = 0
+
+        content_len = len(source)
+        for r in ranges:
+            hdr = "--{}\r\n".format(boundary)
+            if source.content_type is not None:
+                hdr += "Content-Type: {}\r\n".format(source.content_type)
+            hdr += "Content-Range: bytes {}\r\n\r\n".format(r.absolute_range(content_len))
+            self._add_part(hdr.encode())
+            start, end = r.absolutes(content_len)
+            self._add_part(start, end - start + 1)
+            self._add_part(self.CRLF)
+        self._add_part("--{}--\r\n".format(boundary).encode())
+
+    def _add_part(self, data, length=None):
+        """ Parts are stored as (offset, length, data), where data is either the bytes to send
+            or the offset within the source to send from.
+        """
+        if length is None:
+            length = len(data)
+        self.parts.append((self.length, length, data))
+        self.length += length
+
+    def _part_at(self, pos):
+        for part in self.parts:
+            if part[0] <= pos < part[0] + part[1]:
+                return part
+        return None
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, ignored = item.indices(len(self))
+            return self._read(start, stop)
+        return self._read(item, item + 1)
+
+    def _read(self, start, stop):
+        pieces = []
+        for offset, length, part in self.parts:
+            if offset + length <= start:
+                continue
+            if offset >= stop:
+                break
+            st = max(start - offset, 0)
+            end = min(stop - offset, length)
+            if isinstance(part, bytes):
+                pieces.append(part[st:end])
+            else:
+                pieces.append(self.source._read(part + st, part + end))
+        if len(pieces) == 1:
+            return pieces[0]
+        return b''.join(pieces)
+
+    @property
+    def content(self):
+        return self[:]
+
+    def next(self, pkt_len, max_send=None):
+        """ Each call returns data from a single part, so that ranges held in a file can be
+            sent using file_region().
+        """
+        part = self._part_at(self.send_position)
+        if part is None:
+            self.send_complete = True
+            return b''
+        avail = min(max((max_send or self.MAX_SEND) - pkt_len, 1), part[0] + part[1] - self.send_position)
+        rv = self._read(self.send_position, self.send_position + avail)
+        self.send_position += len(rv)
+        return rv
+
+    def file_region(self):
+        part = self._part_at(self.send_position)
+        if part is None or isinstance(part[2], bytes):
+            return None
+        fd = self.source._fileno()
+        if fd is None:
+            return None
+        offset, length, start = part
+        return fd, start + self.send_position - offset, offset + length - self.send_position
+
+
+class FileHandle(object):
+    """ A file descriptor for reading a file, shared by every FileContent for the same file.
+        Reads use os.pread() and sendfile() takes an offset, so no file position is shared.
+        Where os.pread() isn't available (Python 2), reads seek and read under the handle's lock.
+        Handles are reference counted and closed once they are no longer in use. As the key
+        includes the modification time and size, a file that changes gets a new handle.
+    """
+    _handles = {}
+    _lock = threading.Lock()
+
+    def __init__(self, key):
+        self.key = key
+        self.refs = 0
+        self.fd = os.open(key[0], os.O_RDONLY)
+        self.read_lock = threading.Lock()
+
+    def read(self, n, offset):
+        """ Read up to n bytes from offset. """
+        if hasattr(os, 'pread'):
+            return os.pread(self.fd, n, offset)
+        with self.read_lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, n)
+
+    @classmethod
+    def acquire(cls, filename, st=None):
+        """ Get the handle for a file, opening it if required.
+        :param filename: The file.
+        :param st: The result of os.stat() for the file, if already known.
+        :raise OSError: If the file can't be opened.
+        """
+        st = st or os.stat(filename)
+        key = (filename, st.st_mtime, st.st_size)
+        with cls._lock:
+            fh = cls._handles.get(key)
+            if fh is None:
+                fh = FileHandle(key)
+                cls._handles[key] = fh
+            fh.refs += 1
+            return fh
+
+    def release(self):
+        with self._lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+            if self._handles.get(self.key) is self:
+                del self._handles[self.key]
+        os.close(self.fd)
+
+
 class FileContent(Content):
-    def __init__(self, filename):
-        Content.__init__(self, content_sz=os.path.getsize(filename))
+    def __init__(self, filename, st=None, content_type=None):
+        """ Content read from a file.
+        :param filename: The file.
+        :param st: The result of os.stat() for the file, if already known.
+        :param content_type: The MIME type of the file, guessed from the filename if not given.
+        """
+        Content.__init__(self, content_sz=os.path.getsize(filename) if st is None else st.st_size)
         self.filename = filename
-        self.file_handle = None
-        self.exists = os.path.exists(filename)
+        self.stat = st
+        self.handle = None
+        self.exists = st is not None or os.path.exists(filename)
         if not self.exists:
             return
-        self.content_type, ignored = mimetypes.guess_type(filename)
+        self.content_type = content_type or mimetypes.guess_type(filename)[0]
 
     def __del__(self):
-        if self.file_handle is not None:
-            self.file_handle.close()
+        if getattr(self, 'handle', None) is not None:
+            self.handle.release()
+            self.handle = None
 
     def __len__(self):
         if self._next is not None:
@@ -339,34 +839,49 @@ class FileContent(Content):
         return len(self._buffer)
 
     def _open(self):
-        """ Open the file for reading.
-        :return: None
+        """ Get the shared handle for the file.
+        :return: The FileHandle
         """
-        if self.file_handle is not None:
-            return
-        self.file_handle = open(self.filename, "rb")
+        if self.handle is None:
+            self.handle = FileHandle.acquire(self.filename, self.stat)
+        return self.handle
 
     def _close(self):
-        """ Close the open file handle.
+        """ Release the file handle.
         :return: None
         """
-        if self.file_handle is None:
+        if self.handle is None:
             return
-        self.file_handle.close()
-        self.file_handle = None
+        self.handle.release()
+        self.handle = None
+
+    def close(self):
+        Content.close(self)
+        self._close()
+
+    def file_region(self):
+        if self._next is not None:
+            return self._next.file_region()
+        fd = self._fileno()
+        if fd is None or self.send_position >= len(self):
+            return None
+        return fd, self.send_position, len(self) - self.send_position
+
+    def _read(self, start, stop):
+        return self[start:stop]
+
+    def _fileno(self):
+        if not self.exists or self.compression:
+            return None
+        return self._open().fd
 
     def __getitem__(self, item):
+        handle = self._open()
         if isinstance(item, slice):
-            self._open()
-            self.file_handle.seek(item.start)
-            if self.file_handle.tell() == item.start:
-                return self.file_handle.read(item.stop - item.start)
-
-        elif isinstance(item, int):
-            self._open()
-            self.file_handle.seek(item)
-            if self.file_handle.tell() == item:
-                return self.file_handle.read(1)
+            start = item.start or 0
+            stop = len(self) if item.stop is None else item.stop
+            return handle.read(max(0, stop - start), start)
+        return handle.read(1, item)
 
     def write(self):
         if self._next is not None:
@@ -377,3 +892,96 @@ class FileContent(Content):
         self._close()
         with open(self.filename, "wb") as fh:
             fh.write(self._buffer)
+
+
+class FileMapping(object):
+    """ A read only memory map of a file, shared by every MappedFileContent for the same file.
+        Mappings are reference counted and closed once they are no longer in use. As the key
+        includes the modification time and size, a file that changes gets a new mapping.
+    """
+    _mappings = {}
+    _lock = threading.Lock()
+
+    def __init__(self, key):
+        self.key = key
+        self.refs = 0
+        self.fd = os.open(key[0], os.O_RDONLY)
+        try:
+            self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            os.close(self.fd)
+            raise
+        self.view = memoryview(self.map)
+
+    @classmethod
+    def acquire(cls, filename, st=None):
+        """ Get the mapping for a file, creating it if required.
+        :param filename: The file.
+        :param st: The result of os.stat() for the file, if already known.
+        :return: The FileMapping or None if the file can't be mapped.
+        """
+        try:
+            st = st or os.stat(filename)
+            key = (filename, st.st_mtime, st.st_size)
+            with cls._lock:
+                fm = cls._mappings.get(key)
+                if fm is None:
+                    fm = FileMapping(key)
+                    cls._mappings[key] = fm
+                fm.refs += 1
+                return fm
+        except (OSError, ValueError, mmap.error):
+            return None
+
+    def release(self):
+        with self._lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+            if self._mappings.get(self.key) is self:
+                del self._mappings[self.key]
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # Slices are still in use, the map will be closed when they have gone.
+            pass
+        os.close(self.fd)
+
+
+class MappedFileContent(FileContent):
+    """ FileContent that reads from a memory map of the file, shared with any other responses
+        for the same file. Slices are returned as memoryviews of the map, so no data is copied.
+    """
+    def __init__(self, filename, st=None, content_type=None):
+        FileContent.__init__(self, filename, st, content_type)
+        self.mapping = None
+
+    def _map(self):
+        if self.mapping is None and self.exists:
+            self.mapping = FileMapping.acquire(self.filename, self.stat)
+        return self.mapping
+
+    def __getitem__(self, item):
+        if self._map() is None:
+            return FileContent.__getitem__(self, item)
+        if isinstance(item, slice):
+            return self.mapping.view[item]
+        return self.mapping.view[item:item + 1]
+
+    def _fileno(self):
+        if self.compression or self._map() is None:
+            return FileContent._fileno(self)
+        return self.mapping.fd
+
+    def close(self):
+        FileContent.close(self)
+        if self.mapping is not None:
+            self.mapping.release()
+            self.mapping = None
+
+    def __del__(self):
+        FileContent.__del__(self)
+        if getattr(self, 'mapping', None) is not None:
+            self.mapping.release()
+            self.mapping = None
@@ -1,15 +1,77 @@
-from datetime import datetime
+from email.utils import formatdate
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+_date = (0, '')
+
+
+def http_date():
+    """ The current time formatted for a Date header. The value is only formatted once each
+        second.
+    """
+    global _date
+    now = int(time.time())
+    cached = _date
+    if cached[0] != now:
+        cached = _date = (now, formatdate(now, usegmt=True))
+    return cached[1]
+
+
+def _encode_line(key, value):
+    return "{}: {}\r\n".format(key, value).encode()
+
+
+class HeaderError(Exception):
+    """ The headers received can't be accepted. code is the HTTP status for the response. """
+    def __init__(self, code, msg):
+        Exception.__init__(self, msg)
+        self.code = code
+
+
+class HeaderBlock(object):
+    """ A set of headers that are the same for many responses, e.g. Server, encoded once so they
+        can be added to any number of Headers without being formatted each time.
+    """
+    def __init__(self, hdr_dict):
+        self.headers = dict(hdr_dict)
+        self.lines = dict((k, _encode_line(k, v)) for k, v in self.headers.items())
+
+    def __len__(self):
+        return len(self.headers)
+
+    def items(self):
+        return self.headers.items()
 
 
 class Headers(object):
+    """ The headers for a request or response. Keys keep the case they were given in, but are
+        indexed by their lower case version so that get() is case insensitive. Adding a header
+        replaces any existing header with the same name, whatever it's case.
+    """
     CRLF = b"\r\n"
     EOH = b"\r\n\r\n"
 
-    def __init__(self, data=None, status_line=None):
+    MAX_SIZE = 16384
+    MAX_LINES = 100
+
+    def __init__(self, data=None, status_line=None, strict=False):
+        """ Create a set of headers.
+        :param data: Header data that has already been read.
+        :param status_line: The first line of the request or response.
+        :param strict: Reject malformed header lines rather than logging and ignoring them.
+        """
         self.buffer = data or b''
         self.finished = False
         self.status_line = status_line
+        self.strict = strict
         self.headers = {}
+        self._index = {}
+        self._encoded = {}
+        self._line_start = 0
+        self._lines = 0
+        self._last = None
 
     def __len__(self):
         return len(self.buffer)
@@ -21,68 +83,114 @@ class Headers(object):
         return True
 
     def read_content(self, cntnt):
-        """ Read data from a stream until we have a complete set of headers.
+        """ Read data from a stream until we have a complete set of headers. Each line is
+            parsed as soon as it's complete, so no data is scanned twice.
         :param cntnt: Stream data to read.
         :return: Number of bytes of stream that have been used.
+        :raise HeaderError: If the headers are too large or malformed.
         """
         if self.finished:
             return 0
-        consumed = 0
-        idx = cntnt.find(self.EOH)
-        if idx >= 0:
-            consumed = idx + 4
-            self.buffer += cntnt[:idx]
-            self.finished = True
-        else:
-            consumed = len(cntnt)
-            olen = len(self.buffer)
-            self.buffer += cntnt
-            idx = self.buffer.find(self.EOH)
-            if idx >= 0:
-                consumed = idx - olen + 4
-                self.buffer = self.buffer[:idx]
+        if not isinstance(self.buffer, bytearray):
+            self.buffer = bytearray(self.buffer)
+        olen = len(self.buffer)
+        # Never hold more than is allowed.
+        cntnt = cntnt[:max(0, self.MAX_SIZE + 4 - olen)]
+        self.buffer += cntnt
+        # A CR at the end of the last data may be the start of a CRLF.
+        pos = max(self._line_start, olen - 1)
+        while True:
+            idx = self.buffer.find(self.CRLF, pos)
+            if idx < 0 or idx > self.MAX_SIZE:
+                break
+            if idx == self._line_start and self.status_line is not None:
+                # An empty line marks the end of the headers.
                 self.finished = True
-        if self.finished:
-            self.parse_headers()
-        return consumed
+                self.buffer = bytes(self.buffer[:max(0, idx - 2)])
+                return idx + 2 - olen
+            if idx - self._line_start > 0:
+                self._parse_line(bytes(self.buffer[self._line_start:idx]))
+            self._line_start = pos = idx + 2
+
+        if len(self.buffer) > self.MAX_SIZE:
+            raise HeaderError(431, "Headers are larger than {} bytes.".format(self.MAX_SIZE))
+        return len(cntnt)
+
+    def _parse_line(self, line):
+        self._lines += 1
+        if self._lines > self.MAX_LINES:
+            raise HeaderError(431, "More than {} header lines.".format(self.MAX_LINES))
+        if self.status_line is None:
+            self.status_line = line.decode('latin-1')
+            return
+
+        if line[:1] in (b' ', b'\t') and self._last is not None and not self.strict:
+            # obsolete line folding, continues the previous value
+            value = self.headers[self._last]
+            if not isinstance(value, list):
+                self.headers[self._last] = value + ' ' + line.strip().decode('latin-1')
+            return
+
+        key, sep, value = line.partition(b':')
+        if not sep or len(key) == 0 or key != key.strip():
+            if self.strict:
+                raise HeaderError(400, "Malformed header line: {!r}".format(line))
+            logger.warning("Ignoring malformed header line: %r", line)
+            return
+
+        key = key.decode('latin-1')
+        value = value.strip().decode('latin-1')
+        if key.lower() == 'set-cookie':
+            cookies = self.get(key)
+            if cookies is None:
+                cookies = []
+                self.add_header(key, cookies)
+            cookies.append(value)
+        else:
+            self.add_header(key, value)
+        self._last = self._index[key.lower()]
 
     def add_header(self, key, value):
+        lkey = key.lower()
+        existing = self._index.get(lkey)
+        if existing is not None and existing != key:
+            del self.headers[existing]
+        self._encoded.pop(existing, None)
         self.headers[key] = value
+        self._index[lkey] = key
 
     def add_headers(self, hdr_dict):
+        """ Add a number of headers.
+        :param hdr_dict: A dict or a HeaderBlock.
+        """
         if hdr_dict is not None and len(hdr_dict) > 0:
-            self.headers.update(hdr_dict)
+            for k, v in hdr_dict.items():
+                self.add_header(k, v)
+            if isinstance(hdr_dict, HeaderBlock):
+                self._encoded.update(hdr_dict.lines)
 
-    def parse_headers(self):
-        """ Parse headers from a request.
-        :param hdr_data: The header data, excluding the final \r\n\r\n
-        :return: No
+    def encode(self):
+        """ The status line and headers as bytes, ready to be sent. The Date is set and sent
+            first.
         """
-        self.headers = {}
-        lines = self.buffer.split(self.CRLF)
-        self.status_line = lines[0].decode()
-        for line in lines[1:]:
-#            print(":: {}".format(line))
-            if b':' in line:
-                key, value = line.split(b':', 1)
-                if key.decode().lower() == 'set-cookie':
-                    self.headers.setdefault(key.decode(), []).append(value.strip().decode())
-                else:
-                    self.headers[key.decode()] = value.strip().decode()
+        self.add_header('Date', http_date())
+        lines = [self.status_line.encode() + self.CRLF] if self.status_line is not None else []
+        lines.append(_encode_line('Date', self.headers['Date']))
+        for k, v in self.headers.items():
+            if k == 'Date':
+                continue
+            line = self._encoded.get(k)
+            if line is not None:
+                lines.append(line)
+            elif not isinstance(v, list):
+                lines.append(_encode_line(k, v))
             else:
-                print("Malformed header line: {}".format(line))
+                lines.extend(_encode_line(k, vv) for vv in v)
+        lines.append(self.CRLF)
+        return b''.join(lines)
 
     def __str__(self):
-        lines = [self.status_line] if self.status_line is not None else []
-        self.headers['Date'] = datetime.utcnow().strftime("%a, %d %b %Y %H:%M:%S GMT")
-        for k in sorted(self.headers):
-            if not isinstance(self.headers[k], list):
-                lines.append("{}: {}".format(k, self.headers[k]))
-            else:
-                for v in self.headers[k]:
-                    lines.append("{}: {}".format(k, v))
-
-        return "\r\n".join(lines) + "\r\n\r\n"
+        return self.encode().decode()
 
     def get(self, key, default=None):
         """ Get a header value or default, regardless of case.
@@ -91,11 +199,10 @@ class Headers(object):
         :return: The value of the header or the default value (if no default is given, None).
         """
         key = key.decode() if isinstance(key, bytes) else key
-        for k in self.headers.keys():
-            kk = k if not isinstance(k, bytes) else k.decode()
-            if kk.lower() == key.lower():
-                v = self.headers[k]
-                if not isinstance(v, list):
-                    return int(v) if v.isdigit() else v
-                return v
-        return default
+        k = self._index.get(key.lower())
+        if k is None:
+            return default
+        v = self.headers[k]
+        if not isinstance(v, list):
+            return int(v) if v.isdigit() else v
+        return v
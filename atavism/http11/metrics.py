@@ -0,0 +1,187 @@
+""" Counters and histograms of what a server is doing, exposed in the Prometheus text format.
+"""
+from bisect import bisect_left
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _Sharded(object):
+    """ Values kept separately for each thread that records them, so recording never takes a
+        lock. They are only added together when the metric is read. The values of threads
+        that have finished are added to a shared total when the next thread starts recording.
+    """
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+        self._retired = self._new_shard()
+
+    def _new_shard(self):
+        # A count for each set of label values.
+        return {}
+
+    def _merge(self, into, shard):
+        for k, v in list(shard.items()):
+            into[k] = into.get(k, 0) + v
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = self._new_shard()
+            with self._lock:
+                live = []
+                for thread, other in self._shards:
+                    if thread.is_alive():
+                        live.append((thread, other))
+                    else:
+                        self._merge(self._retired, other)
+                live.append((threading.current_thread(), shard))
+                self._shards = live
+        return shard
+
+    def _total(self):
+        total = self._new_shard()
+        with self._lock:
+            self._merge(total, self._retired)
+            for thread, shard in self._shards:
+                self._merge(total, shard)
+        return total
+
+
+class Counter(_Sharded):
+    """ Counts of events, for each set of label values. The name is given the '_total' suffix
+        Prometheus expects of counters, if it doesn't have it already.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = _counter_name(name)
+        self.help = help
+        self.labels = labels
+        _Sharded.__init__(self)
+
+    def inc(self, values=(), n=1):
+        """ Add n to the count for the label values given. """
+        shard = self._shard()
+        shard[values] = shard.get(values, 0) + n
+
+    def values(self):
+        """ The totals, as a dict of label values and count. """
+        return self._total()
+
+    def samples(self):
+        for values, n in sorted(self.values().items()):
+            yield self.name, dict(zip(self.labels, values)), n
+
+
+class Histogram(_Sharded):
+    """ The distribution of observed values, e.g. durations in seconds, counted into buckets
+        with the upper bounds given.
+    """
+    kind = 'histogram'
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, help, buckets=None):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets or self.BUCKETS))
+        _Sharded.__init__(self)
+
+    def _new_shard(self):
+        # A count for each bucket, one for values above them all, then the sum.
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def _merge(self, into, shard):
+        for n, v in enumerate(list(shard)):
+            into[n] += v
+
+    def observe(self, value):
+        shard = self._shard()
+        shard[bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def totals(self):
+        """ The counts in each bucket (not cumulative), the count and the sum of values. """
+        total = self._total()
+        return total[:-1], sum(total[:-1]), total[-1]
+
+    def samples(self):
+        counts, count, total = self.totals()
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            yield self.name + '_bucket', {'le': '+Inf' if bound == float('inf') else repr(bound)}, cumulative
+        yield self.name + '_sum', {}, total
+        yield self.name + '_count', {}, count
+
+
+class Metrics(object):
+    """ The metrics recorded by a server. Its stats() counters are included when the metrics
+        are rendered, named with prefix. Stats that go up and down are listed in gauges.
+        A stat named 'kind:label:name' becomes the metric 'kind_name' with a kind label.
+        The metrics are those of one process, so with workers they are only for the worker
+        that answers.
+    """
+    PREFIX = 'atavism_'
+
+    def __init__(self, prefix=None):
+        self.prefix = prefix or self.PREFIX
+        self.metrics = []
+        self.gauges = {'handler_queue', 'handler_wait_max_ms', 'workers', 'paced_rate', 'open_connections'}
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(self.prefix + name, help, labels))
+
+    def histogram(self, name, help, buckets=None):
+        return self.add(Histogram(self.prefix + name, help, buckets))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, stats=None):
+        """ The metrics in the Prometheus text format.
+        :param stats: Dict of the server's stats.
+        :return: The text.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append(_sample(name, labels, value))
+
+        families = {}
+        for key, value in sorted((stats or {}).items()):
+            labels = {}
+            name = key
+            if ':' in key:
+                kind, label, name = key.split(':', 2)
+                labels[kind] = label
+                name = kind + '_' + name
+            families.setdefault(name, []).append((labels, value))
+        for name, samples in sorted(families.items()):
+            if name in self.gauges:
+                full, kind = self.prefix + _clean(name), 'gauge'
+            else:
+                full, kind = _counter_name(self.prefix + _clean(name)), 'counter'
+            lines.append('# TYPE {} {}'.format(full, kind))
+            for labels, value in samples:
+                lines.append(_sample(full, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+def _counter_name(name):
+    return name if name.endswith('_total') else name + '_total'
+
+
+def _clean(name):
+    return ''.join(c if c.isalnum() or c == '_' else '_' for c in name)
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                               for k, v in sorted(labels.items())) + '}'
+    return '{} {}'.format(name, value)
@@ -2,12 +2,15 @@
     able to be created in either a client or server environment. They are named for
     their content and intent.
 """
+from email.utils import parsedate_tz, mktime_tz
 try:
     from urllib.parse import urlparse
 except ImportError:
     from urlparse import urlparse
 
 from atavism.http11.base import BaseHttp
+from atavism.http11.compression import accepted_encoding
+from atavism.http11.headers import HeaderError
 
 
 class HttpRequest(BaseHttp):
@@ -15,6 +18,7 @@ class HttpRequest(BaseHttp):
     """
     def __init__(self, inp=None, method=None, path=None):
         BaseHttp.__init__(self)
+        self.header.strict = True
         if inp is not None:
             self.read_content(inp)
         self.method = method or 'GET'
@@ -27,9 +31,19 @@ class HttpRequest(BaseHttp):
         hdr = self.header.finished
         rv = BaseHttp.read_content(self, data)
         if hdr is False and self.header.finished:
-            self.method, self.path, self.http = self.header.status_line.split(' ')
+            parts = self.header.status_line.split(' ')
+            if len(parts) != 3:
+                raise HeaderError(400, "Malformed request line: {!r}".format(self.header.status_line))
+            self.method, self.path, self.http = parts
         return rv
 
+    def _update_content(self):
+        BaseHttp._update_content(self)
+        # A request without a length has no body, so any data following the headers
+        # belongs to the next (pipelined) request.
+        if self._content.content_sz is None:
+            self._content.content_sz = 0
+
     def reset(self):
         cnt = self._content
         while cnt._next:
@@ -45,19 +59,44 @@ class HttpRequest(BaseHttp):
 #            self._content.content_sz = 'chunked'
         self._complete()
 
+    def not_modified(self, etag, mtime):
+        """ Do the request validators show the client already has the current version?
+            If-None-Match takes precedence over If-Modified-Since.
+        :param etag: The current (strong) ETag.
+        :param mtime: The current modification time, in seconds since the epoch.
+        :return: True if a 304 response should be sent.
+        """
+        inm = self.get('if-none-match')
+        if inm is not None:
+            if inm.strip() == '*':
+                return True
+            return etag in [tag.strip().replace('W/', '', 1) for tag in inm.split(',')]
+        ims = _parse_date(self.get('if-modified-since'))
+        return ims is not None and int(mtime) <= ims
+
+    def if_range_matches(self, etag, mtime):
+        """ Should the ranges requested be honoured? When If-Range doesn't match the current
+            ETag, or modification time, the full content should be sent instead.
+        """
+        ir = self.get('if-range')
+        if ir is None:
+            return True
+        ir = ir.strip()
+        if ir.startswith('"'):
+            return ir == etag
+        return _parse_date(ir) == int(mtime)
+
     def make_response(self):
         resp = HttpResponse()
 
         resp.add_header('Connection', 'keep-alive' if self.is_keepalive else 'close')
         resp.ranges = self.ranges
 
-        if self.method.upper() == b'HEAD':
+        if self.method.upper() == 'HEAD':
             resp.headers_only = True
 
-        ce = self.get('accept-encoding')
-        if ce is not None and 'gzip' in ce:
-            # todo - handle this properly
-            resp.set_compression('gzip')
+        # Whether it's used depends on the content, see CompressionPolicy.
+        resp.set_compression(accepted_encoding(self.get('accept-encoding')))
         return resp
 
 
@@ -69,18 +108,25 @@ class HttpResponse(BaseHttp):
         200: 'OK',
         206: 'Partial Content',
         301: 'Moved permanently',
+        304: 'Not Modified',
+        400: 'Bad Request',
         401: 'Unathorised',
         402: 'Payment required',
         403: 'Forbidden',
         404: 'Not found',
         405: 'Method not allowed',
-        416: 'Requested range not satisfiable'
+        416: 'Requested range not satisfiable',
+        431: 'Request Header Fields Too Large',
+        500: 'Internal Server Error',
+        503: 'Service Unavailable'
     }
 
     def __init__(self, inp=None, code=None):
         BaseHttp.__init__(self)
         self.msg = 'OK'
         self.code = code or 200
+        # The AccessRecord for the request being answered, set by the server.
+        self.access = None
         if inp is not None:
             self.read_content(inp)
 
@@ -94,6 +140,13 @@ class HttpResponse(BaseHttp):
             self.code = int(self.code)
         return rv
 
+    def _update_content(self):
+        BaseHttp._update_content(self)
+        # These responses never have a body, whatever the headers say.
+        code = self.header.status_line.split(' ', 2)[1]
+        if self.headers_only or code in ('204', '304') or code.startswith('1'):
+            self._content.content_sz = 0
+
     def status_msg(self):
         return self.STATUS_MSG.get(self.code, "Unknown status! {}".format(self.code))
 
@@ -103,16 +156,21 @@ class HttpResponse(BaseHttp):
         :return: None.
         """
         self.code = code
-        if code >= 400:
+        if code == 304:
+            self.ranges = []
+            self.set_compression(None)
+        elif code >= 400:
             self.ranges = []
         elif code == 206 and len(self.ranges) == 0:
             self.code = 200
 
     def mark_complete(self):
-        self._content.finished = True
-        self._content.decompress()
+        self._content.mark_complete()
 
-    def complete(self):
+    def complete(self, policy=None):
+        """ Finish the response so it can be sent.
+        :param policy: The CompressionPolicy used to decide whether to compress the content.
+        """
         if len(self.ranges) > 0:
             self.check_ranges()
             if self.code == 200:
@@ -121,7 +179,7 @@ class HttpResponse(BaseHttp):
         hdrs = self._content.create_ranged_output(self.ranges)
         self.header.add_headers(hdrs)
         self.header.status_line = 'HTTP/1.1 {} {}'.format(self.code, self.status_msg())
-        self._complete()
+        self._complete(policy)
 
     def check_ranges(self):
         for r in self.ranges:
@@ -129,3 +187,13 @@ class HttpResponse(BaseHttp):
             if 0 < st >= len(self) or st > end >= len(self):
                 self.set_code(416)
                 break
+
+
+def _parse_date(value):
+    """ Parse an HTTP date into seconds since the epoch, or None. """
+    if value is None:
+        return None
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
@@ -0,0 +1,167 @@
+""" Limiting the rate data is sent, using token buckets.
+"""
+import threading
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+
+def rate_for_bitrate(bitrate, factor=1.5):
+    """ The rate a client needs to be sent data to play a video without falling behind,
+        with some headroom so it can build a buffer.
+    :param bitrate: The bitrate of the video, in bits per second.
+    :param factor: How many times faster than real time the video may be sent.
+    :return: The rate in bytes per second.
+    """
+    return int(bitrate * factor / 8)
+
+
+class TokenBucket(object):
+    """ Allow rate bytes per second to be sent, with bursts of up to burst bytes. Tokens are
+        added as time passes and taken as data is sent. The rate data has been sent at over
+        the last second or so is kept as sent_rate.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+        self.sent_rate = 0.0
+        self._window_start = self.updated
+        self._window_bytes = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, now=None):
+        with self.lock:
+            self._refill(now or monotonic())
+            return self.tokens
+
+    def delay(self, n, now=None):
+        """ Seconds until n bytes may be sent. """
+        with self.lock:
+            self._refill(now or monotonic())
+            return max(0.0, (min(n, self.burst) - self.tokens) / self.rate)
+
+    def take(self, n, now=None):
+        """ Record that n bytes have been sent. """
+        now = now or monotonic()
+        with self.lock:
+            self._refill(now)
+            self.tokens -= n
+            self._window_bytes += n
+            elapsed = now - self._window_start
+            if elapsed >= 1.0:
+                self.sent_rate = self._window_bytes / elapsed
+                self._window_start = now
+                self._window_bytes = 0
+
+
+class Pacer(object):
+    """ Limit the rate responses are sent, for each connection, each client address and in
+        total. A limit of 0 means no limit. Connections get the buckets that apply to them
+        from attach() and must give them back with detach() when they close.
+        Data is only sent once at least QUANTUM bytes (or the burst, if smaller) are allowed,
+        so pacing doesn't lead to many small writes.
+    """
+    QUANTUM = 16384
+    BURST = 1.0
+
+    def __init__(self, rate=0, per_ip=0, per_connection=0, burst=None):
+        """
+        :param rate: The total bytes per second for the server.
+        :param per_ip: The bytes per second for each client address.
+        :param per_connection: The bytes per second for each connection.
+        :param burst: Seconds of data that can be sent at once, BURST if not given.
+        """
+        self.rate = rate
+        self.per_ip = per_ip
+        self.per_connection = per_connection
+        self.burst = burst or self.BURST
+        self.total = TokenBucket(rate, rate * self.burst) if rate > 0 else None
+        self.addresses = {}
+        self.waits = 0
+        self.lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.rate > 0 or self.per_ip > 0 or self.per_connection > 0
+
+    def _bucket(self, rate):
+        return TokenBucket(rate, rate * self.burst)
+
+    def attach(self, address):
+        """ Get the buckets a new connection from address is limited by.
+        :return: A list of TokenBuckets, or None if the connection isn't limited.
+        """
+        if not self.active:
+            return None
+        ip = address[0] if isinstance(address, tuple) else address
+        buckets = []
+        if self.per_connection > 0:
+            buckets.append(self._bucket(self.per_connection))
+        if self.per_ip > 0:
+            with self.lock:
+                entry = self.addresses.get(ip)
+                if entry is None:
+                    entry = self.addresses[ip] = [self._bucket(self.per_ip), 0]
+                entry[1] += 1
+            buckets.append(entry[0])
+        if self.total is not None:
+            buckets.append(self.total)
+        return buckets
+
+    def detach(self, address):
+        """ Record that a connection given buckets by attach() has closed. """
+        if self.per_ip == 0:
+            return
+        ip = address[0] if isinstance(address, tuple) else address
+        with self.lock:
+            entry = self.addresses.get(ip)
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self.addresses[ip]
+
+    def allowance(self, buckets):
+        """ How much may be sent now.
+        :param buckets: The buckets from attach().
+        :return: Tuple of (bytes, delay). When bytes is 0, delay is the number of seconds
+                 until sending may resume.
+        """
+        now = monotonic()
+        n = min(b.available(now) for b in buckets)
+        quantum = min([self.QUANTUM] + [b.burst for b in buckets])
+        if n >= quantum:
+            return int(n), 0
+        with self.lock:
+            self.waits += 1
+        return 0, max(b.delay(quantum, now) for b in buckets)
+
+    def consume(self, buckets, n):
+        now = monotonic()
+        for b in buckets:
+            b.take(n, now)
+
+    def rates(self):
+        """ The rates data has recently been sent at, for the server and each address.
+        :return: Dict of address (or 'total') and bytes per second.
+        """
+        rv = {}
+        if self.total is not None:
+            rv['total'] = self.total.sent_rate
+        with self.lock:
+            for ip, entry in self.addresses.items():
+                rv[ip] = entry[0].sent_rate
+        return rv
+
+    def stats(self):
+        rv = {'paced': self.waits}
+        if self.total is not None:
+            rv['paced_rate'] = int(self.total.sent_rate)
+        return rv
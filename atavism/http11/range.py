@@ -1,7 +1,7 @@
 class Range(object):
     def __init__(self, tpl):
-        self.start = int(tpl[0]) if tpl[0] is not None and tpl[0] != b'' else None
-        self.end = int(tpl[1]) if tpl[1] is not None and tpl[1] != b'' else None
+        self.start = int(tpl[0]) if tpl[0] not in (None, '', b'') else None
+        self.end = int(tpl[1]) if tpl[1] not in (None, '', b'') else None
         if self.start is None and self.end is not None and self.end > 0:
             self.end *= -1
 
@@ -51,14 +51,15 @@ class Range(object):
         start = self.start
         if self.start is None:
             if self.end < 0:
-                return clen + self.end, clen - 1
+                # A suffix longer than the content is all of it (RFC 7233, 2.1).
+                return max(0, clen + self.end), clen - 1
             start = 0
         end = clen - 1
         if self.end is not None:
             if self.end < 0:
                 end = clen + self.end - 1
             else:
-                end = self.end - 1
+                end = min(self.end, end)
         if end < start:
             end = start
         return start, end
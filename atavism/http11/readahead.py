@@ -0,0 +1,162 @@
+""" Hinting the kernel about the files that will be read next, and those that won't.
+"""
+import os
+import posixpath
+import threading
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', None)
+DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', None)
+
+
+def can_advise():
+    return hasattr(os, 'posix_fadvise')
+
+
+def advise(filename, advice, offset=0, length=0):
+    """ Give the kernel advice about the pages of a file, see posix_fadvise(2). With WILLNEED
+        the file is read into the page cache in the background, with DONTNEED it's pages are
+        dropped from it.
+    :param filename: The file to give advice about.
+    :param advice: WILLNEED or DONTNEED.
+    :param offset: The start of the region the advice is for.
+    :param length: The length of the region, 0 for the rest of the file.
+    :return: True if the advice was given.
+    """
+    if not can_advise():
+        return False
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        os.posix_fadvise(fd, offset, length, advice)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def parse_playlist(url, data):
+    """ Find the segments listed in a media playlist, in the order they are played.
+    :param url: The URL path of the playlist, which relative URIs are resolved against.
+    :param data: The contents of the playlist, as bytes.
+    :return: List of the URL paths of the segments.
+    """
+    base = posixpath.dirname(url)
+    segments = []
+    for line in data.splitlines():
+        line = line.strip()
+        if len(line) == 0 or line.startswith(b'#'):
+            continue
+        uri = line.decode('utf-8', 'replace').split('?', 1)[0]
+        if '://' in uri:
+            continue
+        segments.append(posixpath.normpath(posixpath.join(base, uri)))
+    return segments
+
+
+class Readahead(object):
+    """ Predict the segments of a playlist that will be requested next. Playback is sequential,
+        so when segment N is requested the next ahead segments are read into the page cache.
+        Once every client seen in the last CLIENT_TTL seconds has moved more than behind
+        segments past a segment, it's pages are dropped from the cache.
+        Clients aren't told apart, the position of the slowest is taken to be the earliest
+        segment requested within CLIENT_TTL.
+    """
+    CLIENT_TTL = 60.0
+    MAX_PLAYLIST = 4 * 1024 * 1024
+
+    def __init__(self, find_file, ahead=2, behind=1):
+        """
+        :param find_file: Function to get the filename for a segment's URL path.
+        :param ahead: The number of segments to read ahead.
+        :param behind: The number of segments played to keep in the cache.
+        """
+        self.find_file = find_file
+        self.ahead = ahead
+        self.behind = behind
+        self.key = None
+        self.segments = []
+        self.positions = {}
+        self.recent = {}
+        self.hinted = set()
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.counters = {'readahead_hints': 0, 'readahead_drops': 0}
+
+    def load(self, url, filename, st):
+        """ Read the list of segments from the playlist, if it has changed since it was last read.
+        :param url: The URL path of the playlist.
+        :param filename: The playlist file.
+        :param st: The result of os.stat() for the playlist.
+        """
+        key = (filename, st.st_mtime, st.st_size)
+        if key == self.key or st.st_size > self.MAX_PLAYLIST:
+            return
+        try:
+            with open(filename, 'rb') as fh:
+                segments = parse_playlist(url, fh.read())
+        except (IOError, OSError):
+            return
+        with self.lock:
+            if segments[:len(self.segments)] != self.segments:
+                # A different playlist, rather than more segments added to the same one.
+                self.recent.clear()
+                self.hinted.clear()
+                self.dropped = 0
+            self.key = key
+            self.segments = segments
+            self.positions = dict((u, n) for n, u in enumerate(segments))
+
+    def requested(self, path):
+        """ Record a request for a path, and advise the kernel about the segments that will be
+            wanted next and those that won't.
+        :param path: The URL path requested.
+        :return: True if the path is a segment of the playlist.
+        """
+        now = monotonic()
+        with self.lock:
+            n = self.positions.get(path)
+            if n is None:
+                return False
+            self.recent[n] = now
+            for k in [k for k, t in self.recent.items() if now - t > self.CLIENT_TTL]:
+                del self.recent[k]
+            wanted = [i for i in range(n + 1, min(n + 1 + self.ahead, len(self.segments)))
+                      if i not in self.hinted]
+            self.hinted.update(wanted)
+            oldest = max(0, min(self.recent) - self.behind)
+            unwanted = list(range(self.dropped, oldest))
+            self.dropped = oldest
+            self.hinted.difference_update(unwanted)
+            segments = self.segments
+
+        missing = self._advise(segments, wanted, WILLNEED)
+        dropped = len(unwanted) - len(self._advise(segments, unwanted, DONTNEED))
+        with self.lock:
+            # Segments that haven't been written yet are tried again next time.
+            self.hinted.difference_update(missing)
+            self.counters['readahead_hints'] += len(wanted) - len(missing)
+            self.counters['readahead_drops'] += dropped
+        return True
+
+    def _advise(self, segments, indexes, advice):
+        """ Give the advice for the segments with the indexes.
+        :return: List of the indexes it couldn't be given for.
+        """
+        failed = []
+        for i in indexes:
+            fn = self.find_file(segments[i])
+            if fn is None or not advise(fn, advice):
+                failed.append(i)
+        return failed
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
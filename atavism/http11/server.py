@@ -1,28 +1,140 @@
 from _socket import SHUT_RD, SHUT_RDWR
+from collections import deque
+from concurrent.futures import CancelledError, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from itertools import count as counter
+import errno
+import heapq
 import logging
+import multiprocessing
+import os
+import signal
 import socket
 import threading
 import select
-from atavism.http11.objects import HttpRequest
+from atavism.http11.access import AccessRecord
+from atavism.http11.buffers import OutputBuffer, ReceiveBuffer
+from atavism.http11.compression import CompressionPolicy
+from atavism.http11.headers import HeaderError
+from atavism.http11.metrics import CONTENT_TYPE as METRICS_TYPE, Metrics
+from atavism.http11.objects import HttpRequest, HttpResponse
+from atavism.http11.pacing import Pacer
+from atavism.http11.sockets import SocketOptions
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
 
 
 class HttpServerError(Exception):
     pass
 
 
+def blocking(handler):
+    """ Mark a request handler as one that may block, e.g. while it waits for a file to be
+        written, so the server runs it in it's handler pool rather than on the thread that
+        does the socket I/O.
+    """
+    handler.blocking = True
+    return handler
+
+
 class HttpServer(object):
     """ Class that serves an HLSVideo via HTTP.
+        By default every accepted connection is given it's own thread. If loop_threads is
+        set then that many SelectorLoop threads are started instead and connections are
+        shared between them, so the number of threads doesn't grow with the number of clients.
+        Pipelined requests are answered in order, with at most max_pipeline responses queued
+        for each connection.
+        Connections that don't send a complete request within header_timeout seconds, or that
+        make no progress for idle_timeout seconds, are closed. A timeout of 0 disables it.
+        New connections are refused once there are max_connections, or max_per_ip from the
+        same address (0 for no limit).
+        Responses are compressed according to the CompressionPolicy given as compression.
+        The rate responses are sent at can be limited by a Pacer, given as pacing. Connections
+        that have used their allowance stop writing until they may send more, no thread is
+        put to sleep.
+        The listening and accepted sockets are set up using socket_options, a SocketOptions.
+        Handlers marked with @blocking are run by a pool of handler_threads threads. The
+        response is sent once it's ready, without holding up the connection's I/O.
+        If an access_log is given, an AccessRecord of every request is added to it once the
+        response has been sent.
+        The server's metrics, including histograms of how long requests take, are served in
+        the Prometheus text format at metrics_path (METRICS_PATH unless given, '' to not serve
+        them). They aren't served with workers, as each scrape would be answered by whichever
+        worker accepted it, so the values would jump between those of different processes.
+        If server_timing is set, responses carry a Server-Timing header with the time the
+        handler took.
+        If workers is set, that many processes are forked to serve connections. Each binds the
+        same port using SO_REUSEPORT and the kernel shares connections between them. The
+        parent process holds the port, restarts any worker that exits and collects their stats.
     """
+    STATS_INTERVAL = 1.0
+    MAX_PIPELINE = 16
+    HEADER_TIMEOUT = 10.0
+    IDLE_TIMEOUT = 60.0
+    HANDLER_THREADS = 4
+    METRICS_PATH = '/_atavism/metrics'
+    REFUSED = b'HTTP/1.1 503 Service Unavailable\r\nConnection: close\r\nContent-Length: 0\r\n\r\n'
 
-    def __init__(self, host=None, port=80, handler=None):
+    def __init__(self, host=None, port=80, handler=None, loop_threads=0, workers=0, max_pipeline=None,
+                 header_timeout=None, idle_timeout=None, max_connections=0, max_per_ip=0, compression=None,
+                 pacing=None, socket_options=None, handler_threads=None, access_log=None, metrics_path=None,
+                 server_timing=False):
         self.socket = None
-        self.backlog = 5
+        self.socket_options = socket_options or SocketOptions()
+        self.backlog = self.socket_options.backlog
         self.running = False
         self.accept_thread = None
         self.connections = []
-        self.logger = logging.getLogger()
+        self.logger = logging.getLogger(__name__)
         self.host = host
         self.port = port
+        self.loop_threads = loop_threads
+        self.loops = []
+        self._next_loop = 0
+        self.workers = workers
+        self.worker_id = None
+        self.max_pipeline = max_pipeline or self.MAX_PIPELINE
+        self.header_timeout = self.HEADER_TIMEOUT if header_timeout is None else header_timeout
+        self.idle_timeout = self.IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.compression = compression or CompressionPolicy()
+        self.pacer = pacing or Pacer()
+        self.per_ip = {}
+        self.handler_threads = handler_threads or self.HANDLER_THREADS
+        self.handler_pool = None
+        self.handler_queue = 0
+        self.access_log = access_log
+        self.metrics_path = self.METRICS_PATH if metrics_path is None else metrics_path
+        if workers > 0:
+            self.metrics_path = ''
+        self.server_timing = server_timing
+        self.metrics = Metrics()
+        self.request_seconds = self.metrics.histogram(
+            'request_duration_seconds', 'Time from the start of a request until the response was sent.')
+        self.first_byte_seconds = self.metrics.histogram(
+            'time_to_first_byte_seconds', 'Time from the start of a request until the response started.')
+        self.handler_seconds = self.metrics.histogram('handler_duration_seconds', 'Time taken by the handler.')
+        self.response_codes = self.metrics.counter('responses_total', 'Responses sent, by status code.', ('code',))
+        self.timer = None
+        self.processes = []
+        self.worker_stats = {}
+        self._stats_queue = None
+        self._stats_lock = threading.Lock()
+        self.counters = {'connections': 0, 'requests': 0, 'bytes_sent': 0, 'refused': 0, 'timeouts': 0, 'aborted': 0,
+                         'handler_calls': 0, 'handler_errors': 0, 'handler_wait_ms': 0, 'handler_wait_max_ms': 0}
 
         if not hasattr(self, 'handler'):
             self.handler = handler
@@ -38,53 +150,331 @@ class HttpServer(object):
     def make_socket(self):
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.setblocking(0)
-            sock.settimeout(5)
+            self.set_socket_options(sock)
             sock.bind((self.host, self.port))
-            sock.listen(self.backlog)
+            self.listen(sock)
             self.socket = sock
+            self.port = sock.getsockname()[1]
         except socket.error:
             raise HttpServerError("Unable to open a socket for {}:{}".format(self.host, self.port))
 
+    def set_socket_options(self, sock):
+        """ Set the options required for a listening socket before it's bound. """
+        self.socket_options.listener(sock)
+        if self.workers > 0:
+            if not hasattr(socket, 'SO_REUSEPORT'):
+                raise HttpServerError("Workers require SO_REUSEPORT, which isn't available.")
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setblocking(0)
+        sock.settimeout(5)
+
+    def listen(self, sock):
+        """ Start listening on a bound socket. When using workers the parent only holds the
+            port, so all connections are given to the workers.
+        """
+        if self.workers == 0 or self.worker_id is not None:
+            sock.listen(self.backlog)
+
+    def count(self, key, n=1):
+        with self._stats_lock:
+            self.counters[key] += n
+
+    def admit(self, address):
+        """ Check a newly accepted connection against the connection limits.
+        :return: True if the connection can be served.
+        """
+        ip = address[0] if isinstance(address, tuple) else address
+        with self._stats_lock:
+            n = self.per_ip.get(ip, 0)
+            if (self.max_connections == 0 or len(self.connections) < self.max_connections) and \
+                    (self.max_per_ip == 0 or n < self.max_per_ip):
+                self.per_ip[ip] = n + 1
+                return True
+            self.counters['refused'] += 1
+        self.logger.warning("Refusing a connection from %s, too many connections.", ip)
+        return False
+
+    def refuse(self, sock):
+        """ Send a 503 response, if the socket will take it, and close the socket. """
+        try:
+            sock.setblocking(0)
+            sock.send(self.REFUSED)
+        except socket.error:
+            pass
+        sock.close()
+        return False
+
+    def release(self, address):
+        """ Record that a connection admitted via admit() has closed. """
+        ip = address[0] if isinstance(address, tuple) else address
+        with self._stats_lock:
+            n = self.per_ip.get(ip, 0) - 1
+            if n > 0:
+                self.per_ip[ip] = n
+            else:
+                self.per_ip.pop(ip, None)
+
+    def error_response(self, code):
+        """ Create the response sent when a request can't be accepted, after which the
+            connection is closed.
+        :param code: The HTTP status code.
+        :return: The HttpResponse.
+        """
+        resp = HttpResponse()
+        resp.set_code(code)
+        resp.add_header('Connection', 'close')
+        resp.set_content_type('text/plain')
+        resp.add_content(resp.status_msg())
+        return resp
+
+    def blocks(self, request):
+        """ Should the handler for a request be run in the handler pool? """
+        return getattr(self.handler, 'blocking', False) and request.path != self.metrics_path
+
+    def call_handler(self, request):
+        """ Get the response for a request from the handler, or the metrics if they were asked
+            for. If the handler fails, a 500 response is used instead.
+        """
+        if self.metrics_path and request.path == self.metrics_path:
+            return self.metrics_response(request)
+        try:
+            return self.handler(request)
+        except Exception:
+            return self.handler_failed(request)
+
+    def handler_failed(self, request):
+        self.logger.exception("Request handler failed for '%s'", request.path)
+        self.count('handler_errors')
+        return self.error_response(500)
+
+    def finish_response(self, resp, started, wait=None):
+        """ Record the time the handler took and complete the response.
+        :param started: When the handler was called, from monotonic().
+        :param wait: Seconds the request waited for the handler pool, if it was used.
+        """
+        took = monotonic() - started
+        self.handler_seconds.observe(took)
+        if self.server_timing:
+            timing = 'handler;dur={:.3f}'.format(took * 1000)
+            if wait is not None:
+                timing = 'queue;dur={:.3f}, {}'.format(wait * 1000, timing)
+            resp.add_header('Server-Timing', timing)
+        resp.complete(self.compression)
+        return resp
+
+    def metrics_response(self, request):
+        resp = request.make_response()
+        resp.set_content_type(METRICS_TYPE)
+        resp.add_content(self.metrics.render(self.stats()))
+        return resp
+
+    def finished(self, record):
+        """ Called with the AccessRecord of each response once it has been sent, or aborted.
+            Aborted responses are only counted, not included in the timings.
+        """
+        if record.aborted:
+            self.count('aborted')
+        else:
+            self.request_seconds.observe(record.finished - record.started)
+            if record.first_byte is not None:
+                self.first_byte_seconds.observe(record.first_byte - record.started)
+            self.response_codes.inc((record.status,))
+        if self.access_log is not None:
+            self.access_log.add(record)
+
+    def submit_handler(self, request):
+        """ Run the handler for a request in the handler pool.
+        :return: A Future for the completed HttpResponse.
+        """
+        with self._stats_lock:
+            if self.handler_pool is None:
+                self.handler_pool = ThreadPoolExecutor(self.handler_threads, thread_name_prefix='HttpHandler')
+            self.handler_queue += 1
+        return self.handler_pool.submit(self.run_handler, request, monotonic())
+
+    def run_handler(self, request, submitted):
+        """ Called in a pool thread to create and complete the response for a request. """
+        started = monotonic()
+        wait = int((started - submitted) * 1000)
+        with self._stats_lock:
+            self.handler_queue -= 1
+            self.counters['handler_calls'] += 1
+            self.counters['handler_wait_ms'] += wait
+            self.counters['handler_wait_max_ms'] = max(self.counters['handler_wait_max_ms'], wait)
+        return self.finish_response(self.call_handler(request), started, started - submitted)
+
+    def stats(self):
+        """ Get the server counters. When using workers, these are the totals last reported.
+        :return: Dict of counters.
+        """
+        if self.workers == 0 or self.worker_id is not None:
+            with self._stats_lock:
+                rv = dict(self.counters)
+                rv['handler_queue'] = self.handler_queue
+                rv['open_connections'] = len(self.connections)
+            if self.pacer.active:
+                rv.update(self.pacer.stats())
+            if self.access_log is not None:
+                rv.update(self.access_log.stats())
+            return rv
+        # Maximums are combined as the largest of any worker. Everything else, including levels
+        # such as open_connections, is a count of that worker's share so the total is the sum.
+        totals = dict.fromkeys(self.counters, 0)
+        for ws in list(self.worker_stats.values()):
+            for k in ws:
+                if '_max' in k:
+                    totals[k] = max(totals.get(k, 0), ws[k])
+                else:
+                    totals[k] = totals.get(k, 0) + ws[k]
+        totals['workers'] = len([p for p in self.processes if p.is_alive()])
+        return totals
+
     def start(self):
         self.logger.info("HttpServer starting up")
+        if self.workers > 0 and self.worker_id is None:
+            return self._start_workers()
         if self.socket is None:
             self.make_socket()
             if self.socket is None:
                 raise HttpServerError("Failed to start as no socket was created.")
 
         self.running = True
-        self.accept_thread = threading.Thread(target=self._accept_loop)
-        self.accept_thread.start()
+        if self.header_timeout or self.idle_timeout:
+            self.timer = ConnectionTimer(self)
+            self.timer.start()
+        if self.loop_threads > 0:
+            if selectors is None:
+                raise HttpServerError("The selectors module is required to use loop_threads.")
+            self.socket.setblocking(0)
+            self.loops = [SelectorLoop(self, n) for n in range(self.loop_threads)]
+            self.loops[0].add_listener(self.socket)
+            for lp in self.loops:
+                lp.start()
+            self.accept_thread = self.loops[0].thread
+        else:
+            self.accept_thread = threading.Thread(target=self._accept_loop)
+            self.accept_thread.start()
 
     def stop(self):
-#        if self.socket is not None:
-#            self.socket.shutdown(SHUT_RD)
-#            self.socket.close()
-#            self.socket = None
+        if self.workers > 0 and self.worker_id is None:
+            return self._stop_workers()
 
-        for c in self.connections:
+        connections = list(self.connections)
+        for c in connections:
             c.stop()
+        for c in connections:
+            if c.thread is not None and c.thread is not threading.current_thread():
+                c.thread.join(1.0)
 
         if self.running:
             self.running = False
+            if self.socket is not None:
+                # wakes up the accept loop...
+                try:
+                    self.socket.shutdown(SHUT_RD)
+                except socket.error:
+                    pass
+            for lp in self.loops:
+                lp.wake()
             try:
-                self.accept_thread.join()
+                for lp in self.loops:
+                    lp.thread.join()
+                if self.accept_thread is not None and self.accept_thread.is_alive():
+                    self.accept_thread.join()
             except KeyboardInterrupt as e:
                 pass
+        self.loops = []
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+        if self.handler_pool is not None:
+            self.handler_pool.shutdown(wait=False)
+            self.handler_pool = None
+        if self.access_log is not None:
+            self.access_log.close()
 
         if self.socket is not None:
-            self.socket.shutdown(SHUT_RD)
             self.socket.close()
             self.socket = None
 
-
     def join(self):
         self.accept_thread.join(1.0)
 
+    ### Worker processes
+    def _start_workers(self):
+        if self.socket is None:
+            self.make_socket()
+        self.running = True
+        ctx = multiprocessing.get_context('fork')
+        self._stats_queue = ctx.Queue()
+        self.processes = [self._start_worker(ctx, n) for n in range(self.workers)]
+        self.accept_thread = threading.Thread(target=self._supervise, args=(ctx,))
+        self.accept_thread.name = 'HttpServerSupervisor'
+        self.accept_thread.daemon = True
+        self.accept_thread.start()
+
+    def _start_worker(self, ctx, n):
+        p = ctx.Process(target=self._worker_main, args=(n,))
+        p.daemon = True
+        p.start()
+        self.logger.info("Started worker %d [pid %d] for %s:%d", n, p.pid, self.host, self.port)
+        return p
+
+    def _supervise(self, ctx):
+        while self.running:
+            try:
+                n, stats = self._stats_queue.get(timeout=self.STATS_INTERVAL)
+                self.worker_stats[n] = stats
+            except queue.Empty:
+                pass
+            except (EOFError, OSError):
+                break
+
+            for n, p in enumerate(self.processes):
+                if self.running and not p.is_alive():
+                    self.logger.warning("Worker %d exited with code %s, restarting it.", n, p.exitcode)
+                    self.processes[n] = self._start_worker(ctx, n)
+
+    def _stop_workers(self):
+        self.running = False
+        for p in self.processes:
+            if p.is_alive():
+                p.terminate()
+        for p in self.processes:
+            p.join(5.0)
+            if p.is_alive():
+                os.kill(p.pid, signal.SIGKILL)
+                p.join()
+        if self.accept_thread is not None:
+            self.accept_thread.join()
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def _worker_main(self, n):
+        """ Entry point for a worker process. Opens it's own socket for the port held by the
+            parent, serves connections until asked to stop and regularly reports it's stats.
+        """
+        finished = threading.Event()
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: finished.set())
+        self.worker_id = n
+        self.worker_stats = {}
+        self.processes = []
+        self.socket.close()
+        self.socket = None
+        HttpServer.make_socket(self)
+        self.start()
+        while not finished.wait(self.STATS_INTERVAL) and self.running:
+            self._stats_queue.put((n, self.stats()))
+        self.stop()
+        self._stats_queue.put((n, self.stats()))
+        self._stats_queue.close()
+        self._stats_queue.join_thread()
+
     def _accept_loop(self):
-        self.make_socket()
+        if self.socket is None:
+            self.make_socket()
         self.logger.info("Starting accept loop for {}:{}".format(self.host, self.port))
         while self.running:
             r, w, e = select.select([self.socket], [], [self.socket], 5.0)
@@ -95,8 +485,10 @@ class HttpServer(object):
 
             try:
                 ns = self.socket.accept()
-                conn = HttpConnection(self, *ns)
-                self.connections.append(conn)
+                if not self.admit(ns[1]):
+                    self.refuse(ns[0])
+                    continue
+                HttpConnection(self, *ns)
                 self.logger.info("Accepted a connection from %s.", ns)
             except socket.timeout as e:
                 continue
@@ -107,87 +499,707 @@ class HttpServer(object):
 
         self.running = False
 
+    def accept_pending(self):
+        """ Accept every connection waiting on the (non-blocking) listening socket and
+            hand them out to the selector loops in turn.
+        :return: False if the listening socket has failed, otherwise True.
+        """
+        while self.running:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ECONNABORTED):
+                    return True
+                if self.running:
+                    self.logger.warning("Socket error in accept loop :-( %s", e)
+                return False
+            except (AttributeError, ValueError):
+                return False
+            if not self.admit(address):
+                self.refuse(sock)
+                continue
+            lp = self.loops[self._next_loop % len(self.loops)]
+            self._next_loop += 1
+            HttpConnection(self, sock, address, loop=lp)
+            self.logger.info("Accepted a connection from %s.", address)
+        return True
+
+
+class SelectorLoop(object):
+    """ Drive the accept, read, parse and write stages for many HttpConnections from one
+        thread, using the most efficient selector for the platform (epoll on Linux).
+        Connections can be added from any thread, the loop is woken via a socketpair.
+    """
+    def __init__(self, server, n=0):
+        self.server = server
+        self.logger = server.logger
+        self.selector = selectors.DefaultSelector()
+        self.listener = None
+        self.pending = deque()
+        self.updates = deque()
+        self.paused = []
+        self.pausing = set()
+        self.seq = counter()
+        self.connections = set()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(0)
+        self._wake_w.setblocking(0)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.name = 'SelectorLoop-{}'.format(n)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def add_listener(self, sock):
+        self.listener = sock
+        self.selector.register(sock, selectors.EVENT_READ, self)
+
+    def add(self, conn):
+        """ Add a connection to this loop. Safe to call from any thread. """
+        self.pending.append(conn)
+        self.wake()
+
+    def refresh(self, conn):
+        """ Check what a connection is waiting for again. Safe to call from any thread. """
+        self.updates.append(conn)
+        self.wake()
+
+    def wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except socket.error:
+            pass
+
+    def run(self):
+        self.logger.info("Starting selector loop for {}:{}".format(self.server.host, self.server.port))
+        while self.server.running:
+            while self.pending:
+                conn = self.pending.popleft()
+                conn.mask = selectors.EVENT_READ
+                try:
+                    self.selector.register(conn.socket, conn.mask, conn)
+                except (ValueError, KeyError, OSError):
+                    conn.close()
+                    continue
+                self.connections.add(conn)
+            while self.updates:
+                conn = self.updates.popleft()
+                if conn in self.connections:
+                    self._dispatch(conn, 0)
+
+            timeout = 1.0
+            if self.paused:
+                timeout = max(0, min(timeout, self.paused[0][0] - monotonic()))
+            try:
+                events = self.selector.select(timeout)
+            except (OSError, select.error, ValueError):
+                break
+
+            for key, mask in events:
+                if key.data is None:
+                    try:
+                        while self._wake_r.recv(512):
+                            pass
+                    except socket.error:
+                        pass
+                elif key.data is self:
+                    if not self.server.accept_pending():
+                        self.server.running = False
+                else:
+                    self._dispatch(key.data, mask)
+            self._resume()
+
+        for conn in list(self.connections):
+            self._close(conn)
+        if self.listener is not None:
+            self.selector.unregister(self.listener)
+        self.selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def _dispatch(self, conn, mask):
+        """ Handle the events for a connection, then check what it's waiting for. A mask of 0
+            only does the check. A connection that fails is closed, it never stops the loop.
+        """
+        try:
+            ok = True
+            if mask & selectors.EVENT_READ:
+                ok = conn.handle_read()
+            if ok and mask & selectors.EVENT_WRITE:
+                ok = conn.handle_write()
+            if not ok:
+                self._close(conn)
+            else:
+                self._update(conn)
+        except Exception:
+            self.logger.exception("Connection from %s failed, closing it.", conn.address)
+            self._close(conn)
+
+    def _wait_ready(self, conn):
+        """ Arrange for the connection to be refreshed once it's stalled response is ready.
+            The callback is only registered once while the response is waited for.
+        """
+        resp = conn.waiting_on = conn.responses[0]
+
+        def ready():
+            if conn.waiting_on is resp:
+                conn.waiting_on = None
+            self.refresh(conn)
+        resp.when_ready(ready)
+
+    def _resume(self):
+        """ Let connections that were paused by pacing write again once their time is up. """
+        now = monotonic()
+        while self.paused and self.paused[0][0] <= now:
+            when, n, conn = heapq.heappop(self.paused)
+            self.pausing.discard(conn)
+            conn.paused = None
+            if conn in self.connections:
+                self._dispatch(conn, 0)
+
+    def _update(self, conn):
+        if not conn.running:
+            self._close(conn)
+            return
+        mask = selectors.EVENT_WRITE if conn.wants_write else 0
+        if conn.wants_read:
+            mask |= selectors.EVENT_READ
+        if conn.stalled and conn.waiting_on is not conn.responses[0]:
+            self._wait_ready(conn)
+        waiting = conn.stalled
+        if conn.paused is not None:
+            waiting = True
+            if conn not in self.pausing:
+                self.pausing.add(conn)
+                heapq.heappush(self.paused, (conn.paused, next(self.seq), conn))
+        if mask == 0:
+            if not waiting:
+                self._close(conn)
+            elif conn.mask != 0:
+                # Nothing to do until the response has more data, see refresh(), or
+                # the connection may send again, see _resume().
+                conn.mask = 0
+                self.selector.unregister(conn.socket)
+        elif conn.mask == 0:
+            conn.mask = mask
+            self.selector.register(conn.socket, mask, conn)
+        elif mask != conn.mask:
+            conn.mask = mask
+            self.selector.modify(conn.socket, mask, conn)
+
+    def _close(self, conn):
+        self.pausing.discard(conn)
+        if conn in self.connections:
+            self.connections.discard(conn)
+            try:
+                if conn.mask != 0:
+                    self.selector.unregister(conn.socket)
+            except (KeyError, ValueError, OSError):
+                pass
+        conn.close()
+
+
+class ConnectionTimer(object):
+    """ Close connections once their deadline has passed, from a single thread for the
+        whole server. Connections just update their deadline attribute as they make progress,
+        the heap only gains an entry when a deadline is earlier than the one already scheduled.
+        When a later deadline is found on expiry, the connection is rescheduled for it.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.heap = []
+        self.seq = counter()
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.name = 'ConnectionTimer'
+        self.thread.daemon = True
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+
+    def schedule(self, conn, deadline):
+        """ Set the time by which the connection must have made progress.
+        :param conn: The HttpConnection.
+        :param deadline: Time, from monotonic(), or None for no deadline.
+        """
+        conn.deadline = deadline
+        if deadline is None or (conn.scheduled is not None and conn.scheduled <= deadline):
+            return
+        with self.cond:
+            conn.scheduled = deadline
+            heapq.heappush(self.heap, (deadline, next(self.seq), conn))
+            if self.heap[0][2] is conn:
+                self.cond.notify()
+
+    def run(self):
+        while self.running:
+            expired = []
+            with self.cond:
+                now = monotonic()
+                while self.heap and self.heap[0][0] <= now:
+                    when, n, conn = heapq.heappop(self.heap)
+                    if conn.scheduled != when:
+                        continue
+                    conn.scheduled = None
+                    if not conn.running or conn.deadline is None:
+                        continue
+                    if conn.deadline > now:
+                        conn.scheduled = conn.deadline
+                        heapq.heappush(self.heap, (conn.deadline, next(self.seq), conn))
+                    else:
+                        expired.append(conn)
+                if not expired:
+                    self.cond.wait(self.heap[0][0] - now if self.heap else None)
+            for conn in expired:
+                conn.expire()
+
+
+class PendingResponse(object):
+    """ Holds the place of a response that is being created in the handler pool, so that
+        pipelined responses are still sent in order. Until the response is ready the
+        connection treats it as a stalled stream.
+    """
+    def __init__(self, parent, future):
+        self.parent = parent
+        self.future = future
+        self.access = None
+
+    def ready(self):
+        return self.future.done()
+
+    def when_ready(self, callback):
+        """ Call callback(), possibly from another thread, once the response is ready. """
+        self.future.add_done_callback(lambda f: callback())
+
+    def wait_ready(self, timeout=None):
+        try:
+            self.future.exception(timeout)
+        except (FutureTimeout, CancelledError):
+            pass
+        return self.ready()
+
+    def response(self):
+        """ The completed response, or a 503 response when the pool was shut down first. """
+        try:
+            return self.future.result()
+        except CancelledError:
+            resp = self.parent.error_response(503)
+            resp.complete()
+            return resp
+
+    def send_complete(self):
+        return False
+
+    def file_region(self):
+        return None
+
+    def close(self):
+        """ Cancel the handler call, or close the response once it has been created. """
+        def release(f):
+            if not f.cancelled() and f.exception() is None:
+                f.result().close()
+        if not self.future.cancel():
+            self.future.add_done_callback(release)
+
 
 class HttpConnection(object):
-    def __init__(self, parent, sock, address):
+    """ A single client connection. When a SelectorLoop is supplied the connection is
+        driven by that loop, otherwise it starts a thread of it's own.
+        Where possible, file content is sent using os.sendfile().
+    """
+    SENDFILE_MAX = 1024 * 1024
+    STREAM_WAIT = 0.1
+    MIN_WRITE_SIZE = 65536
+    MAX_WRITE_SIZE = 1024 * 1024
+    READ_SIZE = 65536
+    WRITE_BUDGET = 4 * 1024 * 1024
+
+    def __init__(self, parent, sock, address, loop=None):
         self.parent = parent
         self.socket = sock
         self.address = address
-        self.logger = logging.getLogger()
+        self.logger = logging.getLogger(__name__)
+        self.mask = 0
+        self.loop = loop
+        self.use_sendfile = hasattr(os, 'sendfile')
 
-        self.inp = b''
+        self.inp = ReceiveBuffer(self.READ_SIZE)
+        self.out = OutputBuffer()
+        self.write_size = self.MIN_WRITE_SIZE
         self.running = True
-        self.responses = []
+        self.eof = False
+        self.close_when_sent = False
+        self.linger = False
+        self.sent = []
+        # The records of the responses with output waiting, and how many bytes of it each has.
+        self.unsent = deque()
+        self.request = None
+        self.request_started = None
+        self.responses = deque()
+        self.closed = False
+        self.deadline = None
+        self.scheduled = None
+        self.paused = None
+        self.waiting_on = None
+        self.pacing = parent.pacer.attach(address)
+        parent.socket_options.connection(sock)
+        parent.connections.append(self)
+        parent.count('connections')
+        self.set_deadline()
+
+        if loop is not None:
+            self.socket.setblocking(0)
+            self.thread = None
+            loop.add(self)
+            return
 
         self.thread = threading.Thread(target=self.main_loop)
         self.thread.name = 'HttpConnection'
         self.thread.daemon = True
         self.thread.start()
-        parent.connections.append(self)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    @property
+    def wants_read(self):
+        return self.running and not self.eof and len(self.responses) < self.parent.max_pipeline
+
+    @property
+    def wants_write(self):
+        if self.paused is not None:
+            return False
+        return len(self.out) > 0 or (len(self.responses) > 0 and self.responses[0].ready())
+
+    @property
+    def stalled(self):
+        """ Is the connection waiting for a streamed response to have more data? """
+        return len(self.out) == 0 and len(self.responses) > 0 and not self.responses[0].ready()
 
     def main_loop(self):
-        #todo add timeout checking...
-        request = None
         self.logger.info("HttpConnection main loop started.")
+        try:
+            self._serve()
+        except Exception:
+            self.logger.exception("Connection from %s failed, closing it.", self.address)
+        self.close()
+
+    def _serve(self):
         while self.running:
-            ws = [self.socket] if len(self.responses) > 0 else []
+            timeout = 5.0
+            if self.stalled:
+                # Wait for the response to have data, checking the socket regularly.
+                self.responses[0].wait_ready(self.STREAM_WAIT)
+                timeout = 0
+            if self.paused is not None:
+                timeout = min(timeout, max(0, self.paused - monotonic()))
+            rs = [self.socket] if self.wants_read else []
+            ws = [self.socket] if self.wants_write else []
+            if len(rs) == 0 and len(ws) == 0 and self.paused is None:
+                if self.stalled:
+                    continue
+                break
 
             try:
-                r, w, e = select.select([self.socket], ws, [self.socket], 5.0)
+                r, w, e = select.select(rs, ws, [self.socket], timeout)
             except:
                 break
 
             if len(e) > 0:
                 break
+            if self.paused is not None and monotonic() >= self.paused:
+                self.paused = None
+            if len(r) > 0 and not self.handle_read():
+                break
+            if len(w) > 0 and not self.handle_write():
+                break
 
-            resp = self.responses[0] if len(self.responses) > 0 else None
-            if len(r) > 0:
-                try:
-                    data = self.socket.recv(2048)
-                except socket.error as e:
-                    self.logger.warning("Socket error: %s", e)
-                    break
+    def handle_read(self):
+        """ Read whatever data is available and process any request that is completed.
+        :return: False if the connection should be closed.
+        """
+        try:
+            n = self.inp.recv(self.socket)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return True
+            self.logger.warning("Socket error: %s", e)
+            return False
 
-                self.logger.debug("Read %d bytes from accepted socket", len(data))
-                if len(data) == 0:
-                    if resp is None or not resp.is_keepalive:
-                        self.logger.debug("Zero byte read, keepalive not asked for, closing socket...")
-                        break
+        if n == 0:
+            if len(self.out) == 0 and len(self.responses) == 0:
+                self.logger.debug("Zero byte read, nothing left to send, closing socket...")
+                return False
+            # Finish sending what has been asked for, then close.
+            self.eof = True
+            return True
 
-                self.inp += data
-                if request is None:
-                    request = HttpRequest()
+        if self.linger:
+            self.inp.clear()
+            return True
+        self.process_input()
+        self.set_deadline()
+        return True
 
-                read = request.read_content(self.inp)
-                self.inp = self.inp[read:]
+    def process_input(self):
+        """ Parse every complete request in the input buffer and queue the responses, in the
+            order the requests were received. Parsing stops once max_pipeline responses are
+            queued and resumes as they are sent.
+        """
+        while len(self.inp) > 0 and len(self.responses) < self.parent.max_pipeline and not self.linger:
+            if self.request is None:
+                self.request = HttpRequest()
+                self.request_started = monotonic()
+
+            try:
+                read = self.request.read_content(self.inp.view())
+            except HeaderError as e:
+                self.logger.warning("Bad request from %s: %s", self.address, e)
+                resp = self.parent.error_response(e.code)
+                resp.complete()
+                self._queue(resp, None)
+                # Anything else the client sends is discarded.
+                self.request = None
+                self.inp.clear()
+                self.linger = True
+                break
+            self.inp.consume(read)
+            if not self.request.is_complete():
+                break
 
-                if request.header.finished:
-                    self.logger.debug(request.header)
+            if self.parent.blocks(self.request):
+                resp = PendingResponse(self.parent, self.parent.submit_handler(self.request))
+            else:
+                started = monotonic()
+                resp = self.parent.finish_response(self.parent.call_handler(self.request), started)
+            self.parent.count('requests')
+            self._queue(resp, self.request)
+            self.request = None
 
-                if request.is_complete():
-                    resp = self.parent.handler(request)
-                    resp.complete()
-                    self.responses.append(resp)
-                    request = None
+    def _queue(self, resp, request):
+        """ Add a response to be sent, with a record of it for the metrics and access log. """
+        resp.access = AccessRecord(self.address, request, self.request_started)
+        self.responses.append(resp)
 
-            if len(w) > 0 and resp is not None:
-                # only process one response each pass...
-                next = resp.next_output()
-                self.logger.debug("Sending %s bytes", len(next))
-                try:
-                    self.socket.send(next)
-                except socket.error as e:
-                    if self.running:
-                        self.logger.warning("Unable to send via socket. Closing it. %s", e)
+    def handle_write(self):
+        """ Send as much of the queued responses as the socket will accept. Output is gathered
+            into write_size blocks and sent with as few calls as possible, file content is sent
+            using os.sendfile(). The size of the blocks grows while the socket accepts all that is
+            offered and shrinks when it doesn't. Data the socket doesn't accept is kept and sent
+            on the next call. When the connection is paced, no more than the allowance is sent
+            and once that's used the connection is paused.
+        :return: False if the connection should be closed.
+        """
+        budget = self.WRITE_BUDGET
+        while budget > 0:
+            try:
+                resp = self._fill()
+            except (IOError, OSError) as e:
+                self.logger.warning("Unable to read the response to send. Closing the connection. %s", e)
+                return False
+            if len(self.out) == 0 and resp is None:
+                break
+            limit = self.SENDFILE_MAX
+            if self.pacing is not None:
+                limit, delay = self.parent.pacer.allowance(self.pacing)
+                if limit == 0:
+                    self.paused = monotonic() + delay
+                    return True
+            try:
+                if len(self.out) > 0:
+                    wanted = min(len(self.out), limit)
+                    sent = self.out.write(self.socket, self._more(), limit=wanted)
+                    self._written(sent)
+                else:
+                    fd, offset, count = resp.file_region()
+                    wanted = min(count, limit)
+                    sent = os.sendfile(self.socket.fileno(), fd, offset, wanted)
+                    if sent == 0:
+                        self.logger.warning("File is shorter than expected. Closing socket.")
+                        return False
+                    resp.advance(sent)
+                    if resp.access is not None:
+                        resp.access.written(sent)
+            except (OSError, socket.error) as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return True
+                if self.running:
+                    self.logger.warning("Unable to send via socket. Closing it. %s", e)
+                return False
+
+            self.parent.count('bytes_sent', sent)
+            if self.pacing is not None:
+                self.parent.pacer.consume(self.pacing, sent)
+            budget -= sent
+            if len(self.out) == 0:
+                self._release_sent()
+            if sent < wanted:
+                # The socket is full, so wait until it's writable again.
+                self.write_size = max(self.MIN_WRITE_SIZE, self.write_size // 2)
+                return True
+            self.write_size = min(self.MAX_WRITE_SIZE, self.write_size * 2)
+
+        if len(self.out) == 0:
+            self._release_sent()
+        if len(self.inp) > 0 and not self.close_when_sent:
+            self.process_input()
+        if len(self.out) == 0 and self.close_when_sent and self.linger and not self.eof:
+            # Closing with data unread makes the socket reset, which can lose the response.
+            # So stop sending and read until the client closes, or the header timeout.
+            try:
+                self.socket.shutdown(socket.SHUT_WR)
+            except socket.error:
+                return False
+            self.set_deadline()
+            return True
+        if len(self.out) == 0 and (self.close_when_sent or (self.eof and len(self.responses) == 0)):
+            return False
+        self.set_deadline()
+        return True
+
+    def set_deadline(self):
+        """ Update the time by which the connection must next make progress. While there is
+            output waiting, or nothing has been asked for, the idle timeout applies. A request
+            must be received in full within the header timeout of it's first byte.
+        """
+        timer = self.parent.timer
+        if timer is None:
+            return
+        if self.linger and self.parent.header_timeout:
+            deadline = monotonic() + self.parent.header_timeout
+        elif self.request is not None and not self.wants_write and self.parent.header_timeout:
+            deadline = self.request_started + self.parent.header_timeout
+        elif self.parent.idle_timeout:
+            deadline = monotonic() + self.parent.idle_timeout
+        else:
+            deadline = None
+        timer.schedule(self, deadline)
+
+    def expire(self):
+        """ Called by the ConnectionTimer when the deadline has passed. """
+        if not self.running:
+            return
+        self.logger.info("Closing connection from %s as it has timed out.", self.address)
+        self.parent.count('timeouts')
+        self.stop()
+
+    def _more(self):
+        """ The flags for writing the output buffer. When the next response is to be sent
+            from a file, the headers waiting are sent with MSG_MORE so they share a packet with
+            the start of the file.
+        """
+        flag = self.parent.socket_options.more_flag
+        if flag and self.use_sendfile and len(self.responses) > 0 and self.responses[0].file_region() is not None:
+            return flag
+        return 0
+
+    def _queued(self, record, n):
+        """ Note that n bytes of output for the response with the record have been buffered. """
+        if len(self.unsent) > 0 and self.unsent[-1][0] is record:
+            self.unsent[-1][1] += n
+        elif n > 0:
+            self.unsent.append([record, n])
+
+    def _written(self, n):
+        """ Share n bytes written from the output buffer between the records of the responses
+            they were for, in order.
+        """
+        while n > 0 and len(self.unsent) > 0:
+            entry = self.unsent[0]
+            k = min(n, entry[1])
+            entry[0].written(k)
+            entry[1] -= k
+            n -= k
+            if entry[1] == 0:
+                self.unsent.popleft()
+
+    def _release_sent(self, aborted=()):
+        """ Responses are only closed once all their output has been written, as the output
+            buffer may refer to their content.
+        :param aborted: The records of responses whose output was discarded.
+        """
+        for resp in self.sent:
+            if resp.access is not None:
+                if any(resp.access is r for r in aborted):
+                    resp.access.abort()
+                else:
+                    resp.access.finish(resp)
+                self.parent.finished(resp.access)
+            resp.close()
+        self.sent = []
+
+    def _fill(self):
+        """ Add output from the queued responses to the output buffer, in order, until there is
+            write_size bytes waiting.
+        :return: The response if the next data for it should be sent directly from a file.
+        """
+        while len(self.responses) > 0 and not self.close_when_sent:
+            resp = self.responses[0]
+            if isinstance(resp, PendingResponse):
+                if not resp.ready():
                     break
-                if resp.send_complete():
-                    if not resp.is_keepalive:
-                        break
-                    self.responses.pop()
+                access = resp.access
+                resp = self.responses[0] = resp.response()
+                resp.access = access
+            if resp.send_complete():
+                self.responses.popleft()
+                self.sent.append(resp)
+                if not resp.is_keepalive:
+                    self.close_when_sent = True
+                continue
+            if self.use_sendfile and resp.file_region() is not None:
+                return resp if len(self.out) == 0 else None
+            space = self.write_size - len(self.out)
+            if space < self.MIN_WRITE_SIZE // 4:
+                break
+            if resp.access is not None:
+                resp.access.sending()
+            blocks = resp.next_blocks(space)
+            queued = sum(len(b) for b in blocks)
+            if queued == 0 and not resp.send_complete():
+                break
+            for b in blocks:
+                self.out.append(b)
+            if resp.access is not None:
+                self._queued(resp.access, queued)
+        return None
 
-        self.socket.close()
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+        if not self.closed:
+            self.closed = True
+            self.parent.release(self.address)
+            if self.pacing is not None:
+                self.parent.pacer.detach(self.address)
         self.running = False
-        self.parent.connections.remove(self)
+        self.deadline = None
+        self.out.clear()
+        self._release_sent([entry[0] for entry in self.unsent])
+        self.unsent.clear()
+        for resp in self.responses:
+            if resp.access is not None and resp.access.first_byte is not None:
+                # Sending had started, but not finished.
+                resp.access.abort()
+                self.parent.finished(resp.access)
+            resp.close()
+        self.responses.clear()
+        if self in self.parent.connections:
+            try:
+                self.parent.connections.remove(self)
+            except ValueError:
+                pass
 
     def stop(self):
         self.running = False
@@ -195,3 +1207,5 @@ class HttpConnection(object):
             self.socket.shutdown(SHUT_RDWR)
         except socket.error:
             pass
+        if self.loop is not None:
+            self.loop.refresh(self)
@@ -0,0 +1,66 @@
+""" Tuning for the sockets used to serve and fetch data.
+"""
+import socket
+
+
+class SocketOptions(object):
+    """ The options set on sockets. Options the platform doesn't support are skipped.
+        backlog is the length of the listen queue. nodelay disables Nagle's algorithm, so
+        small responses such as playlists aren't delayed. sndbuf and rcvbuf set the kernel
+        buffer sizes, when given. With cork, response headers are sent with MSG_MORE when the
+        body follows, so they share a packet with it. keepalive turns on TCP keepalives, with
+        the idle time, interval and count given (in seconds) by keepidle, keepintvl and keepcnt.
+    """
+    def __init__(self, backlog=128, nodelay=True, sndbuf=None, rcvbuf=None, cork=True, keepalive=True,
+                 keepidle=None, keepintvl=None, keepcnt=None):
+        self.backlog = backlog
+        self.nodelay = nodelay
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.cork = cork and hasattr(socket, 'MSG_MORE')
+        self.keepalive = keepalive
+        self.keepidle = keepidle
+        self.keepintvl = keepintvl
+        self.keepcnt = keepcnt
+
+    @property
+    def more_flag(self):
+        """ The flag for sends that will be followed by more data. """
+        return socket.MSG_MORE if self.cork else 0
+
+    def _set(self, sock, level, name, value):
+        opt = getattr(socket, name, None)
+        if opt is None or value is None:
+            return
+        try:
+            sock.setsockopt(level, opt, value)
+        except (OSError, socket.error):
+            pass
+
+    def _buffers(self, sock):
+        self._set(sock, socket.SOL_SOCKET, 'SO_SNDBUF', self.sndbuf)
+        self._set(sock, socket.SOL_SOCKET, 'SO_RCVBUF', self.rcvbuf)
+
+    def listener(self, sock):
+        """ Set the options for a listening socket, before it's bound. Buffer sizes are set
+            here too, as they must be set before a connection is established to be used for
+            the TCP window.
+        """
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._buffers(sock)
+
+    def connection(self, sock, connected=True):
+        """ Set the options for a connected socket, or one about to connect.
+        :param connected: False when the socket has yet to connect, so the buffers can be set.
+        """
+        if not connected:
+            self._buffers(sock)
+        self._set(sock, socket.IPPROTO_TCP, 'TCP_NODELAY', 1 if self.nodelay else 0)
+        if self.keepalive:
+            self._set(sock, socket.SOL_SOCKET, 'SO_KEEPALIVE', 1)
+            self._set(sock, socket.IPPROTO_TCP, 'TCP_KEEPIDLE', self.keepidle)
+            self._set(sock, socket.IPPROTO_TCP, 'TCP_KEEPINTVL', self.keepintvl)
+            self._set(sock, socket.IPPROTO_TCP, 'TCP_KEEPCNT', self.keepcnt)
+
+
+DEFAULT_OPTIONS = SocketOptions()
@@ -0,0 +1,14 @@
+""" The HLSServer served from an asyncio event loop. This is kept apart from atavism.http, as
+    the asyncio server requires Python 3.7 or later.
+"""
+from atavism.http11.aio import AsyncHttpServer
+from atavism.http import HLSServer
+
+
+class AsyncHLSServer(AsyncHttpServer, HLSServer):
+    """ An HLSServer that serves connections from an asyncio event loop.
+    """
+    def __init__(self, video=None, loop=None, **kwargs):
+        HLSServer.__init__(self, video, **kwargs)
+        self.loop = loop
+        self.check_options()
@@ -7,6 +7,8 @@ from tempfile import mkdtemp
 import re
 import math
 
+from atavism.http11.cache import DirectoryIndex
+
 
 def find_ffmpeg(binary_name='ffmpeg', skip_list=None, paths=None, silent=False):
     """ Function to find and return the full path to a suitable ffmpeg binary.
@@ -81,17 +83,29 @@ class BaseVideo(object):
         self.info = {}
         self.streams = []
         self.video_stream = None
+        self._index = None
         self.get_video_information()
 
     @property
     def url(self):
         return "/{}".format(os.path.basename(self.source))
 
+    @property
+    def index(self):
+        """ The DirectoryIndex of the files that can be served. """
+        if self._index is None or self._index.directory != self.directory:
+            self._index = DirectoryIndex(self.directory)
+        return self._index
+
     def find_file(self, url):
-        poss_fn = path.join(self.directory, url[1:] if url.startswith('/') else url)
-        if not os.path.exists(poss_fn):
-            return None
-        return poss_fn
+        info = self.file_info(url)
+        return info.filename if info is not None else None
+
+    def file_info(self, url):
+        """ Get the details of the file for a URL, which can't be outside the directory.
+        :return: FileInfo or None.
+        """
+        return self.index.lookup(url)
 
     def _execute_ffmpeg(self, *args):
         cmd_args = [self.ffmpeg, '-i', self.source]
@@ -103,10 +117,14 @@ class BaseVideo(object):
         ignored, data = self._execute_ffmpeg([])
         for input in data.split(b'\nInput')[1:]:
             for l in [ln.strip() for ln in input.split(b'\n')]:
-                if l.startswith('Duration'):
-                    dur, ignored = l[10:].split(',', 1)
-                    parts = [float(p) for p in dur.split(':')]
-                    self.info['duration'] = parts[0] * 3600 + parts[1] * 60 + parts[2]
+                if l.startswith(b'Duration'):
+                    dur, ignored = l[10:].split(b',', 1)
+                    if b':' in dur:
+                        parts = [float(p) for p in dur.split(b':')]
+                        self.info['duration'] = parts[0] * 3600 + parts[1] * 60 + parts[2]
+                    br = re.search(b'bitrate: ([0-9]+) kb/s', l)
+                    if br is not None:
+                        self.info['bitrate'] = int(br.group(1)) * 1000
 
                 if not l.startswith(b'Stream'):
                     continue
@@ -128,6 +146,11 @@ class BaseVideo(object):
                             sinfo['height'] = int(sz.group(2))
                 self.streams.append(sinfo)
 
+    @property
+    def bitrate(self):
+        """ The overall bitrate of the video in bits per second, or None if it's unknown. """
+        return self.info.get('bitrate')
+
     def video_width(self):
         if self.video_stream is None:
             return -1.0
@@ -164,6 +187,8 @@ class HLSVideo(BaseVideo):
         return "/{}".format(self.fn)
 
     def __del__(self):
+        if self._index is not None:
+            self._index.close()
         if self.cleanup:
 #            print("Removing directory {}".format(self.directory))
             for f in os.listdir(self.directory):
@@ -176,7 +201,8 @@ class HLSVideo(BaseVideo):
             opts.extend(['-vf', 'scale={}:{}'.format(*self._resized(max_width, max_height))])
 
         output, err = self._hls_command(opts)
-        self.segments = len(os.listdir(self.directory)) - 1
+        self.index.refresh()
+        self.segments = len(self.index) - 1
         if self.segments > 0:
             return True
         print(output)
@@ -0,0 +1,238 @@
+""" Load test an HLSServer over the loopback interface.
+
+    Synthetic segment files are served to a number of concurrent keep-alive clients, for each
+    scenario in turn, and the results are printed and saved as JSON. Giving a previous results
+    file with --compare shows how the runs differ.
+
+    $ python benchmarks/loopback.py --clients 16 --duration 5 --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from atavism import __version__
+from atavism.http import HLSServer
+from atavism.http11.buffers import ReceiveBuffer
+from atavism.http11.client import HttpClient
+from atavism.http11.objects import HttpRequest, HttpResponse
+from atavism.video import BaseVideo
+
+SCENARIOS = ('get', 'range', 'multirange', 'head', 'pipeline')
+
+
+class SyntheticVideo(object):
+    """ Just enough of a BaseVideo to serve a playlist and segments of random data. """
+    find_file = BaseVideo.find_file
+    file_info = BaseVideo.file_info
+    index = BaseVideo.index
+    _index = None
+
+    def __init__(self, segments, size):
+        self.directory = tempfile.mkdtemp(prefix='atavism-bench-')
+        self.url = '/video.m3u8'
+        self.segments = segments
+        self.size = size
+        data = os.urandom(size)
+        for n in range(segments):
+            with open(os.path.join(self.directory, 'segment{}.ts'.format(n)), 'wb') as fh:
+                fh.write(data)
+        with open(os.path.join(self.directory, 'video.m3u8'), 'w') as fh:
+            fh.write('#EXTM3U\n')
+            for n in range(segments):
+                fh.write('#EXTINF:10.0,\nsegment{}.ts\n'.format(n))
+
+    def cleanup(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+
+class Results(object):
+    """ Latencies and bytes received by the clients for one scenario. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+
+    def add(self, latencies, nbytes, errors):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.bytes += nbytes
+            self.errors += errors
+
+    def summary(self, elapsed):
+        lat = sorted(self.latencies)
+
+        def percentile(p):
+            return round(lat[int(p * (len(lat) - 1))] * 1000, 3) if lat else None
+
+        return {'requests': len(lat),
+                'errors': self.errors,
+                'requests_per_sec': round(len(lat) / elapsed, 1),
+                'mb_per_sec': round(self.bytes / elapsed / (1024 * 1024), 2),
+                'p50_ms': percentile(0.5),
+                'p99_ms': percentile(0.99)}
+
+
+def make_request(scenario, video):
+    req = HttpRequest(method='HEAD' if scenario == 'head' else 'GET',
+                      path='/segment{}.ts'.format(random.randrange(video.segments)))
+    if scenario == 'range':
+        start = random.randrange(video.size // 2)
+        req.add_range(start, start + 65535)
+    elif scenario == 'multirange':
+        req.add_range(0, 4095)
+        req.add_range(video.size // 2, video.size // 2 + 4095)
+        req.add_range(end=-4096)
+    return req
+
+
+def run_client(srv, video, scenario, depth, finish, results):
+    """ Make requests on one keep-alive connection until finish. """
+    latencies = []
+    nbytes = errors = 0
+    if scenario == 'pipeline':
+        sock = socket.create_connection(('127.0.0.1', srv.port))
+        buf = ReceiveBuffer()
+        batch = ''.join('GET /segment{}.ts HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'.format(
+            random.randrange(video.segments)) for n in range(depth)).encode()
+        try:
+            while time.time() < finish:
+                started = time.time()
+                sock.sendall(batch)
+                for n in range(depth):
+                    resp = HttpResponse()
+                    buf.consume(resp.read_content(buf.view()))
+                    while not resp.is_complete():
+                        if buf.recv(sock) == 0:
+                            raise socket.error("Connection closed by the server.")
+                        buf.consume(resp.read_content(buf.view()))
+                    latencies.append(time.time() - started)
+                    nbytes += len(resp)
+        except socket.error:
+            errors += 1
+        finally:
+            sock.close()
+    else:
+        http = HttpClient('127.0.0.1', srv.port)
+        while time.time() < finish:
+            started = time.time()
+            try:
+                resp = http.send_request(make_request(scenario, video))
+            except Exception:
+                errors += 1
+                http._close_socket()
+                continue
+            latencies.append(time.time() - started)
+            nbytes += len(resp)
+        http._close_socket()
+    results.add(latencies, nbytes, errors)
+
+
+def run_scenario(srv, video, scenario, args):
+    results = Results()
+    finish = time.time() + args.duration
+    clients = [threading.Thread(target=run_client, args=(srv, video, scenario, args.depth, finish, results))
+               for n in range(args.clients)]
+    base_threads = threading.active_count()
+    peak = [0]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.05):
+            # The clients and this thread aren't part of the server.
+            peak[0] = max(peak[0], threading.active_count() - len(clients) - 1)
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    started = time.time()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.time() - started
+    done.set()
+    sampler.join()
+
+    rv = results.summary(elapsed)
+    rv['threads'] = max(peak[0], base_threads)
+    rv['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+    return rv
+
+
+def compare(previous, current):
+    print("\nChange from {}:".format(previous.get('timestamp')))
+    for name, res in current['scenarios'].items():
+        old = previous.get('scenarios', {}).get(name)
+        if old is None:
+            continue
+        changes = []
+        for k in ('requests_per_sec', 'mb_per_sec', 'p50_ms', 'p99_ms'):
+            if old.get(k) and res.get(k) is not None:
+                changes.append('{} {:+.1f}%'.format(k, (res[k] - old[k]) * 100.0 / old[k]))
+        print("  {:<12} {}".format(name, ', '.join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loopback benchmark for the atavism HTTP server')
+    parser.add_argument('--clients', type=int, default=8, help='Number of concurrent connections')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds to run each scenario for')
+    parser.add_argument('--segments', type=int, default=10, help='Number of segment files')
+    parser.add_argument('--segment-size', type=int, default=1024 * 1024, help='Bytes in each segment')
+    parser.add_argument('--depth', type=int, default=8, help='Requests sent at once when pipelining')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='Scenario to run, may be repeated (default is all)')
+    parser.add_argument('--loop-threads', type=int, default=0, help='Serve connections from event loop threads')
+    parser.add_argument('--asyncio', action='store_true', help='Use the asyncio server')
+    parser.add_argument('--mmap', action='store_true', help='Serve files from shared memory maps')
+    parser.add_argument('--cache-size', type=int, default=0, help='Megabytes of segment cache')
+    parser.add_argument('--output', help='File to save the results into, as JSON')
+    parser.add_argument('--compare', help='Results from an earlier run to compare with')
+    args = parser.parse_args()
+
+    video = SyntheticVideo(args.segments, args.segment_size)
+    options = {'host': '127.0.0.1', 'use_mmap': args.mmap, 'cache_size': args.cache_size * 1024 * 1024,
+               'max_pipeline': max(args.depth, HLSServer.MAX_PIPELINE)}
+    if args.asyncio:
+        from atavism.http_aio import AsyncHLSServer
+        srv = AsyncHLSServer(video, **options)
+    else:
+        srv = HLSServer(video, loop_threads=args.loop_threads, **options)
+    srv.start()
+
+    results = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'version': __version__,
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'options': vars(args),
+               'scenarios': {}}
+    try:
+        for scenario in args.scenario or SCENARIOS:
+            res = results['scenarios'][scenario] = run_scenario(srv, video, scenario, args)
+            print("{:<12} {requests_per_sec:>10} req/s {mb_per_sec:>9} MB/s  p50 {p50_ms} ms  p99 {p99_ms} ms  "
+                  "threads {threads}  rss {peak_rss_mb} MB  errors {errors}".format(scenario, **res))
+    finally:
+        srv.stop()
+        video.cleanup()
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(json.load(fh), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -32,7 +32,8 @@ setup(
     packages=find_packages(exclude=['tests']),
     test_suite='tests',
     install_requires=[
-        'ipaddress'
+        'ipaddress',
+        'futures; python_version < "3.2"'
     ],
     entry_points={
         'console_scripts': ['atavism=atavism.command_line:main']
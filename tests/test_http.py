@@ -1,12 +1,34 @@
 import os
+import asyncio
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 from datetime import datetime
+from mimetypes import guess_type
 
+from atavism.http import HLSServer, HLSServerError
+from atavism.http_aio import AsyncHLSServer
+from atavism.http11.access import AccessLog, AccessRecord
+from atavism.http11.aio import AsyncHttpServer, _Descriptor
+from atavism.http11.buffers import ReceiveBuffer
+from atavism.http11.cache import DirectoryIndex, SegmentCache
 from atavism.http11.client import HttpClient
-from atavism.http11.content import Content, FileContent
+from atavism.http11.compression import CompressionPolicy, accepted_encoding
+from atavism.http11.content import Content, FileContent, FileHandle, FileMapping, MappedFileContent, StreamContent
 from atavism.http11.cookies import CookieJar
-from atavism.http11.headers import Headers
-from atavism.http11.objects import HttpRequest
+from atavism.http11.headers import HeaderBlock, HeaderError, Headers, http_date
+from atavism.http11.metrics import Counter, Histogram, Metrics
+from atavism.http11.objects import HttpRequest, HttpResponse
+from atavism.http11.pacing import Pacer, TokenBucket, rate_for_bitrate
+from atavism.http11.range import Range
+from atavism.http11.readahead import Readahead, can_advise, parse_playlist
+from atavism.http11.server import HttpServer, HttpServerError, blocking
+from atavism.http11.sockets import SocketOptions
+from atavism.video import BaseVideo
 
 
 class TestHeaders(unittest.TestCase):
@@ -52,6 +74,61 @@ class TestHeaders(unittest.TestCase):
         self.assertEqual(len(hdr_str.split("\r\n")), 6)
         self.assertIn("Accept-Encoding: identity\r\n", hdr_str)
 
+    def test_004_index(self):
+        hb = Headers(status_line='HTTP/1.1 200 OK')
+        hb.add_header('content-length', '10')
+        hb.add_header('Content-Length', '20')
+        self.assertEqual(len(hb.headers), 1)
+        self.assertEqual(hb.get('CONTENT-LENGTH'), 20)
+        self.assertIsNone(hb.get('content-type'))
+
+        block = HeaderBlock({'Server': 'test/1.0', 'Accept-Ranges': 'bytes'})
+        hb.add_headers(block)
+        self.assertEqual(hb.get('server'), 'test/1.0')
+        hb.add_header('server', 'other')
+        data = hb.encode()
+        self.assertIsInstance(data, bytes)
+        lines = data.split(b'\r\n')
+        self.assertEqual(lines[0], b'HTTP/1.1 200 OK')
+        self.assertEqual(lines[1], 'Date: {}'.format(http_date()).encode())
+        self.assertIn(b'server: other', lines)
+        self.assertIn(b'Accept-Ranges: bytes', lines)
+        self.assertNotIn(b'Server: test/1.0', lines)
+        self.assertTrue(data.endswith(b'\r\n\r\n'))
+
+    def test_005_incremental(self):
+        data = b'\r\nGET /x HTTP/1.1\r\nHost: a\r\nX-Long:  folded\r\n  value\r\nBad line\r\n\r\nbody'
+        hb = Headers()
+        used = 0
+        for n in range(len(data)):
+            used += hb.read_content(data[n:n + 1])
+            if hb.finished:
+                break
+        self.assertEqual(used, len(data) - 4)
+        self.assertEqual(hb.status_line, 'GET /x HTTP/1.1')
+        self.assertEqual(hb.get('x-long'), 'folded value')
+        self.assertEqual(len(hb.headers), 2)
+
+        strict = Headers(strict=True)
+        with self.assertRaises(HeaderError) as cm:
+            strict.read_content(data)
+        self.assertEqual(cm.exception.code, 400)
+
+    def test_006_limits(self):
+        hb = Headers()
+        with self.assertRaises(HeaderError) as cm:
+            for n in range(Headers.MAX_LINES + 1):
+                hb.read_content('X-Header-{}: value\r\n'.format(n).encode())
+        self.assertEqual(cm.exception.code, 431)
+
+        hb = Headers()
+        hb.read_content(b'GET / HTTP/1.1\r\nX-Big: ')
+        with self.assertRaises(HeaderError) as cm:
+            for n in range(20):
+                hb.read_content(b'x' * 1024)
+        self.assertEqual(cm.exception.code, 431)
+        self.assertLessEqual(len(hb.buffer), Headers.MAX_SIZE + 4)
+
 
 class TestContent(unittest.TestCase):
     def test_001_creation(self):
@@ -85,6 +162,26 @@ class TestContent(unittest.TestCase):
         self.assertEqual(len(ct), 21)
         self.assertEqual(ct[0:2], b'01')
 
+    def test_004_ranges(self):
+        ct = Content(data=b'0123456789', content_type='text/plain')
+        hdrs = ct.create_ranged_output([Range(('2', '5'))])
+        self.assertEqual(hdrs['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(len(ct), 4)
+        self.assertEqual(ct.content, b'2345')
+
+        ct = Content(data=b'0123456789', content_type='text/plain')
+        ct.create_ranged_output([Range(('0', '1')), Range((None, '3'))])
+        self.assertEqual(len(ct), len(ct.content))
+        body = ct.content.decode()
+        self.assertIn("Content-Range: bytes 0-1/10\r\n\r\n01\r\n", body)
+        self.assertIn("Content-Range: bytes 7-9/10\r\n\r\n789\r\n", body)
+        self.assertTrue(body.endswith("--\r\n"))
+
+        ct = Content(data=b'0123456789', content_type='text/plain')
+        hdrs = ct.create_ranged_output([Range((None, '5000'))])
+        self.assertEqual(hdrs['Content-Range'], 'bytes 0-9/10')
+        self.assertEqual(ct.content, b'0123456789')
+
 
 class TestFileContent(unittest.TestCase):
     def test_001(self):
@@ -105,6 +202,91 @@ class TestFileContent(unittest.TestCase):
         self.assertEqual(os.path.getsize(fn), 12)
 
 
+class TestMappedFileContent(unittest.TestCase):
+    def test_001(self):
+        with open('tests/test_http.py', 'rb') as fh:
+            data = fh.read()
+        fc = MappedFileContent('tests/test_http.py')
+        fc2 = MappedFileContent('tests/test_http.py')
+        self.assertEqual(len(fc), len(data))
+        chunk = fc[0:10]
+        self.assertIsInstance(chunk, memoryview)
+        self.assertEqual(chunk, b'import os\n')
+        self.assertEqual(fc2[100:200], data[100:200])
+        self.assertIs(fc.mapping, fc2.mapping)
+        self.assertEqual(fc.mapping.refs, 2)
+        mapping = fc.mapping
+        chunk.release()
+        fc.close()
+        fc2.close()
+        self.assertEqual(mapping.refs, 0)
+        self.assertTrue(mapping.map.closed)
+
+    def test_002_ranges(self):
+        with open('tests/test_http.py', 'rb') as fh:
+            data = fh.read()
+        fc = MappedFileContent('tests/test_http.py')
+        fc.create_ranged_output([Range(('0', '9')), Range(('20', '29'))])
+        body = fc.content
+        self.assertIn(b"\r\n\r\n" + data[0:10] + b"\r\n", body)
+        self.assertIn(b"\r\n\r\n" + data[20:30] + b"\r\n", body)
+        fc.close()
+
+    def test_003_server(self):
+        video = SegmentDirectory()
+        srv = HLSServer(video, use_mmap=True)
+        srv.start()
+        try:
+            http = HttpClient(srv.host, srv.port)
+            data = video.data['/segment2.ts']
+            for n in range(2):
+                req = HttpRequest(path='/segment2.ts')
+                req.add_range(10, 19)
+                req.add_range(end=-5)
+                parts = http.send_request(req).decoded_content()
+                self.assertEqual([p['content'] for p in parts], [data[10:20], data[-5:]])
+        finally:
+            srv.stop()
+            video.cleanup()
+        self.assertEqual(len(FileMapping._mappings), 0)
+
+
+class TestReceiveBuffer(unittest.TestCase):
+    def test_001_recv(self):
+        a, b = socket.socketpair()
+        try:
+            buf = ReceiveBuffer(16)
+            a.sendall(b'0123456789')
+            self.assertEqual(buf.recv(b), 10)
+            self.assertEqual(buf.view(), b'0123456789')
+            buf.consume(4)
+            self.assertEqual(len(buf), 6)
+            # Needs the space used by the consumed data, then more than the buffer holds.
+            a.sendall(b'abcdefghij' * 4)
+            self.assertEqual(buf.recv(b), 16)
+            self.assertEqual(buf.view(), b'456789' + b'abcdefghijabcdef')
+            buf.append(b'XYZ')
+            self.assertEqual(bytes(buf.view()[-5:]), b'efXYZ')
+            buf.consume(len(buf))
+            self.assertEqual(len(buf), 0)
+            self.assertEqual(buf.start, 0)
+        finally:
+            a.close()
+            b.close()
+
+    def test_002_parse(self):
+        data = b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n5;x=1\r\nHello\r\n6\r\n World\r\n0\r\n\r\n'
+        buf = ReceiveBuffer(8)
+        resp = HttpResponse()
+        for n in range(0, len(data), 8):
+            buf.append(data[n:n + 8])
+            buf.consume(resp.read_content(buf.view()))
+        self.assertTrue(resp.is_complete())
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(resp.content, b'Hello World')
+        self.assertIsInstance(resp.content, bytes)
+
+
 class TestCookies(unittest.TestCase):
     def test_001(self):
         cj = CookieJar()
@@ -130,6 +312,1115 @@ class TestCookies(unittest.TestCase):
         self.assertEqual(c.expires, datetime(2016, 4, 20, 18, 51, 30))
 
 
+def hello_handler(request):
+    resp = request.make_response()
+    resp.set_content_type('text/plain')
+    resp.add_content("Hello {}".format(request.path))
+    return resp
+
+
+@blocking
+def blocking_handler(request):
+    if request.path.startswith('/fail'):
+        raise ValueError(request.path)
+    if request.path.startswith('/slow'):
+        time.sleep(0.5)
+    return hello_handler(request)
+
+
+def file_handler(request):
+    resp = request.make_response()
+    resp.set_content(FileContent('tests/test_http.py'))
+    # Not compressed, so it's sent using sendfile.
+    resp.set_compression(None)
+    return resp
+
+
+def text_handler(request):
+    resp = request.make_response()
+    resp.set_content_type('text/plain')
+    resp.add_content(TEXT_DATA)
+    return resp
+
+
+TEXT_DATA = ''.join('Line {} of some text\n'.format(n) for n in range(20000))
+
+
+def big_handler(request):
+    resp = request.make_response()
+    resp.set_content(Content(data=BIG_DATA, content_type='application/octet-stream'))
+    return resp
+
+
+BIG_DATA = bytes(bytearray(n % 251 for n in range(1024 * 1024)))
+
+
+class TestHttpServer(unittest.TestCase):
+    def check_server(self, srv, requests=3):
+        srv.start()
+        try:
+            http = HttpClient('127.0.0.1', srv.port)
+            for n in range(requests):
+                resp = http.request('/test/{}'.format(n))
+                self.assertEqual(resp.code, 200)
+                self.assertEqual(resp.decoded_content(), 'Hello /test/{}'.format(n))
+        finally:
+            srv.stop()
+
+    def test_001_threaded(self):
+        self.check_server(HttpServer('127.0.0.1', 0, hello_handler))
+
+    def test_002_selector(self):
+        srv = HttpServer('127.0.0.1', 0, hello_handler, loop_threads=1)
+        self.check_server(srv)
+        self.assertEqual(len(srv.connections), 0)
+
+    def test_003_selector_pool(self):
+        srv = HttpServer('127.0.0.1', 0, hello_handler, loop_threads=2)
+        srv.start()
+        try:
+            clients = [HttpClient('127.0.0.1', srv.port) for n in range(4)]
+            for c in clients:
+                self.assertEqual(c.request('/pool').decoded_content(), 'Hello /pool')
+            self.assertEqual(len(srv.connections), 4)
+        finally:
+            srv.stop()
+
+    def test_004_sendfile(self):
+        with open('tests/test_http.py', 'rb') as fh:
+            data = fh.read()
+        for n in (0, 1):
+            srv = HttpServer('127.0.0.1', 0, file_handler, loop_threads=n)
+            srv.start()
+            try:
+                http = HttpClient('127.0.0.1', srv.port)
+                resp = http.request('/file')
+                self.assertEqual(resp.code, 200)
+                self.assertEqual(resp.content, data)
+
+                req = HttpRequest(path='/file')
+                req.add_range(100)
+                resp = http.send_request(req)
+                self.assertEqual(resp.code, 206)
+                self.assertEqual(resp.content, data[100:])
+
+                req = HttpRequest(path='/file')
+                req.add_range(0, 8)
+                req.add_range(end=-10)
+                resp = http.send_request(req)
+                self.assertEqual(resp.code, 206)
+                parts = resp.decoded_content()
+                self.assertEqual(len(parts), 2)
+                self.assertEqual(parts[0]['content'], data[:9])
+                self.assertEqual(parts[1]['content'], data[-10:].strip())
+
+                # A suffix longer than the file is the whole of it.
+                req = HttpRequest(path='/file')
+                req.add_range(end=-(len(data) + 5000))
+                resp = http.send_request(req)
+                self.assertEqual(resp.code, 206)
+                self.assertEqual(resp.get('content-range'), 'bytes 0-{}/{}'.format(len(data) - 1, len(data)))
+                self.assertEqual(resp.content, data)
+            finally:
+                srv.stop()
+
+    def test_005_large_response(self):
+        for n in (0, 1):
+            srv = HttpServer('127.0.0.1', 0, big_handler, loop_threads=n)
+            srv.start()
+            try:
+                http = HttpClient('127.0.0.1', srv.port)
+                for i in range(2):
+                    resp = http.request('/big')
+                    self.assertEqual(len(resp), len(BIG_DATA))
+                    self.assertEqual(resp.content, BIG_DATA)
+            finally:
+                srv.stop()
+
+    def test_006_pipelining(self):
+        raw = b''.join('GET /pipe/{} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'.format(n).encode()
+                       for n in range(6))
+        for n, depth in ((0, None), (1, None), (1, 2)):
+            srv = HttpServer('127.0.0.1', 0, hello_handler, loop_threads=n, max_pipeline=depth)
+            srv.start()
+            try:
+                sock = socket.create_connection(('127.0.0.1', srv.port), 5)
+                sock.sendall(raw)
+                data = b''
+                for i in range(6):
+                    resp = HttpResponse()
+                    while not resp.is_complete():
+                        used = resp.read_content(data)
+                        data = data[used:]
+                        if not resp.is_complete():
+                            data += sock.recv(4096)
+                    self.assertEqual(resp.code, 200)
+                    self.assertEqual(resp.decoded_content(), 'Hello /pipe/{}'.format(i))
+                sock.close()
+            finally:
+                srv.stop()
+
+    def test_007_blocking_handler(self):
+        raw = b''.join('GET /{} HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n'.format(p).encode()
+                       for p in ('slow/0', 'fast/1', 'fail/2'))
+        for n in (0, 1):
+            srv = HttpServer('127.0.0.1', 0, blocking_handler, loop_threads=n)
+            srv.start()
+            try:
+                sock = socket.create_connection(('127.0.0.1', srv.port), 5)
+                sock.sendall(raw)
+                # The slow request doesn't hold up other connections on the same loop.
+                started = time.time()
+                self.assertEqual(HttpClient('127.0.0.1', srv.port).request('/other').code, 200)
+                self.assertLess(time.time() - started, 0.4)
+
+                data = b''
+                codes = []
+                for i in range(3):
+                    resp = HttpResponse()
+                    while not resp.is_complete():
+                        used = resp.read_content(data)
+                        data = data[used:]
+                        if not resp.is_complete():
+                            data += sock.recv(4096)
+                    codes.append(resp.code)
+                    if resp.code == 200:
+                        self.assertTrue(resp.decoded_content().endswith('/{}'.format(i)))
+                sock.close()
+                self.assertEqual(codes, [200, 200, 500])
+                stats = srv.stats()
+                self.assertEqual(stats['handler_calls'], 4)
+                self.assertEqual(stats['handler_errors'], 1)
+                self.assertEqual(stats['handler_queue'], 0)
+            finally:
+                srv.stop()
+
+    def test_008_blocking_hls_server(self):
+        video = SegmentDirectory()
+        try:
+            for n in (0, 1):
+                srv = HLSServer(video, host='127.0.0.1', loop_threads=n, blocking_handler=True)
+                srv.start()
+                try:
+                    http = HttpClient('127.0.0.1', srv.port)
+                    self.assertEqual(http.request('/segment1.ts').content, video.data['/segment1.ts'])
+                    self.assertEqual(http.request('/video.m3u8').code, 200)
+                    self.assertEqual(http.request('/missing.ts').code, 404)
+                    self.assertEqual(http.request(HLSServer.METRICS_PATH).code, 200)
+                    # Every request but the metrics went through the handler pool.
+                    self.assertEqual(srv.stats()['handler_calls'], 3)
+                finally:
+                    srv.stop()
+        finally:
+            video.cleanup()
+
+
+class TestHttpServerLimits(unittest.TestCase):
+    def wait_closed(self, sock):
+        sock.settimeout(5)
+        data = b''
+        while True:
+            got = sock.recv(4096)
+            if len(got) == 0:
+                return data
+            data += got
+
+    def check_timeouts(self, srv):
+        srv.start()
+        try:
+            idle = socket.create_connection(('127.0.0.1', srv.port))
+            partial = socket.create_connection(('127.0.0.1', srv.port))
+            partial.sendall(b'GET /slow HTTP/1.1\r\n')
+            start = time.time()
+            self.assertEqual(self.wait_closed(partial), b'')
+            self.assertEqual(self.wait_closed(idle), b'')
+            self.assertLess(time.time() - start, 3)
+            self.assertEqual(srv.stats()['timeouts'], 2)
+
+            http = HttpClient('127.0.0.1', srv.port)
+            self.assertEqual(http.request('/after').decoded_content(), 'Hello /after')
+        finally:
+            srv.stop()
+
+    def test_001_timeouts(self):
+        for n in (0, 1):
+            self.check_timeouts(HttpServer('127.0.0.1', 0, hello_handler, loop_threads=n,
+                                           header_timeout=0.3, idle_timeout=0.5))
+
+    def test_002_async_timeouts(self):
+        self.check_timeouts(AsyncHttpServer('127.0.0.1', 0, hello_handler, header_timeout=0.3, idle_timeout=0.5))
+
+    def test_003_limits(self):
+        for n in (0, 1):
+            srv = HttpServer('127.0.0.1', 0, hello_handler, loop_threads=n, max_per_ip=2)
+            srv.start()
+            try:
+                clients = [HttpClient('127.0.0.1', srv.port) for i in range(2)]
+                for c in clients:
+                    self.assertEqual(c.request('/limit').code, 200)
+                extra = socket.create_connection(('127.0.0.1', srv.port))
+                self.assertTrue(self.wait_closed(extra).startswith(b'HTTP/1.1 503 '))
+                self.assertEqual(srv.stats()['refused'], 1)
+            finally:
+                srv.stop()
+            self.assertEqual(srv.per_ip, {})
+
+    def test_004_bad_requests(self):
+        for srv in (HttpServer('127.0.0.1', 0, hello_handler), HttpServer('127.0.0.1', 0, hello_handler, loop_threads=1),
+                    AsyncHttpServer('127.0.0.1', 0, hello_handler)):
+            srv.start()
+            try:
+                for req, code in ((b'GET / HTTP/1.1\r\nNo colon\r\n\r\n', b'400'),
+                                  (b'NONSENSE\r\n\r\n', b'400'),
+                                  (b'GET / HTTP/1.1\r\nX-Big: ' + b'x' * 20000, b'431')):
+                    sock = socket.create_connection(('127.0.0.1', srv.port))
+                    sock.sendall(req)
+                    self.assertTrue(self.wait_closed(sock).startswith(b'HTTP/1.1 ' + code))
+                    sock.close()
+            finally:
+                srv.stop()
+
+
+class TestSocketOptions(unittest.TestCase):
+    def test_001_options(self):
+        opts = SocketOptions(backlog=64, sndbuf=65536, keepidle=30)
+        srv = HttpServer('127.0.0.1', 0, hello_handler, socket_options=opts)
+        self.assertEqual(srv.backlog, 64)
+        srv.start()
+        try:
+            http = HttpClient('127.0.0.1', srv.port, socket_options=opts)
+            self.assertEqual(http.request('/opts').code, 200)
+            self.assertEqual(http.socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY), 1)
+            conn = srv.connections[0].socket
+            self.assertEqual(conn.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY), 1)
+            self.assertEqual(conn.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE), 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                self.assertEqual(conn.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE), 30)
+            http._close_socket()
+        finally:
+            srv.stop()
+
+
+class TestHttpServerWorkers(unittest.TestCase):
+    def test_001_workers(self):
+        srv = HttpServer('127.0.0.1', 0, hello_handler, workers=2)
+        srv.STATS_INTERVAL = 0.1
+        srv.start()
+        try:
+            port = srv.port
+            for n in range(6):
+                http = HttpClient('127.0.0.1', srv.port)
+                self.assertEqual(http.request('/worker').decoded_content(), 'Hello /worker')
+                http._close_socket()
+            self.assertEqual(srv.port, port)
+            time.sleep(0.5)
+            stats = srv.stats()
+            self.assertEqual(stats['workers'], 2)
+            self.assertEqual(stats['requests'], 6)
+            self.assertEqual(stats['connections'], 6)
+        finally:
+            srv.stop()
+        self.assertEqual(len([p for p in srv.processes if p.is_alive()]), 0)
+
+    def test_002_combined_stats(self):
+        srv = HttpServer('127.0.0.1', 0, hello_handler, workers=2)
+        srv.worker_stats = {0: {'requests': 3, 'open_connections': 2, 'handler_wait_max_ms': 40},
+                            1: {'requests': 4, 'open_connections': 1, 'handler_wait_max_ms': 25}}
+        stats = srv.stats()
+        self.assertEqual(stats['requests'], 7)
+        self.assertEqual(stats['open_connections'], 3)
+        self.assertEqual(stats['handler_wait_max_ms'], 40)
+
+
+async def slow_handler(request):
+    await asyncio.sleep(0.01)
+    return hello_handler(request)
+
+
+def stream_blocks():
+    for n in range(20):
+        if n % 5 == 0:
+            time.sleep(0.05)
+        yield 'Block {}\n'.format(n) * 100
+
+
+STREAM_DATA = b''.join(b.encode() for b in stream_blocks())
+
+
+def failing_blocks():
+    yield b'x' * 100
+    time.sleep(0.1)
+    raise ValueError('The source failed')
+
+
+def stream_handler(request):
+    resp = request.make_response()
+    if request.path == '/pipe':
+        rfd, wfd = os.pipe()
+
+        def writer():
+            with os.fdopen(wfd, 'wb') as fh:
+                for block in stream_blocks():
+                    fh.write(block.encode())
+                    fh.flush()
+        threading.Thread(target=writer).start()
+        resp.set_content(StreamContent(rfd, content_type='application/octet-stream'))
+    elif request.path == '/fail':
+        resp.set_content(StreamContent(failing_blocks(), content_type='application/octet-stream'))
+    else:
+        resp.set_content(StreamContent(stream_blocks(), content_type='text/plain'))
+    return resp
+
+
+class TestStreamContent(unittest.TestCase):
+    def test_001_chunked(self):
+        ct = Content()
+        ct.add_content(b'Hello World')
+        ct.content_sz = 'chunked'
+        self.assertEqual(ct.header_lines()['Transfer-Encoding'], 'chunked')
+        self.assertEqual(ct.next(0, 22), b'6\r\nHello \r\n')
+        self.assertEqual(ct.next(0), b'5\r\nWorld\r\n')
+        self.assertEqual(ct.next(0), b'0\r\n\r\n')
+        self.assertTrue(ct.send_complete)
+
+        rcv = Content(content_sz='chunked')
+        self.assertEqual(rcv.read_content(b'6;ext=1\r\nHello \r\n5\r\nWorld\r\n0\r\n\r\n'), 32)
+        self.assertTrue(rcv.finished)
+        self.assertEqual(rcv.content, b'Hello World')
+
+    def test_002_backpressure(self):
+        produced = []
+
+        def blocks():
+            for n in range(100):
+                produced.append(n)
+                yield b'x' * 100
+
+        ct = StreamContent(blocks(), max_buffer=1000)
+        self.assertTrue(ct.wait_ready(1))
+        time.sleep(0.1)
+        self.assertLessEqual(len(produced), 11)
+        data = b''
+        while not ct.send_complete:
+            ct.wait_ready(1)
+            data += ct.next(0, 4096)
+        rcv = Content(content_sz='chunked')
+        rcv.read_content(data)
+        self.assertEqual(rcv.content, b'x' * 10000)
+        ct.close()
+
+    def test_003_servers(self):
+        for srv in (HttpServer('127.0.0.1', 0, stream_handler), HttpServer('127.0.0.1', 0, stream_handler, loop_threads=1),
+                    AsyncHttpServer('127.0.0.1', 0, stream_handler)):
+            srv.start()
+            try:
+                http = HttpClient('127.0.0.1', srv.port)
+                for path in ('/stream', '/pipe', '/stream'):
+                    resp = http.request(path)
+                    self.assertEqual(resp.get('transfer-encoding'), 'chunked')
+                    self.assertEqual(resp.content, STREAM_DATA)
+                self.assertEqual(resp.get('content-encoding'), 'gzip')
+            finally:
+                srv.stop()
+
+    def test_004_failing_source(self):
+        for n in (0, 1):
+            srv = HttpServer('127.0.0.1', 0, stream_handler, loop_threads=n)
+            srv.start()
+            try:
+                sock = socket.create_connection(('127.0.0.1', srv.port), 5)
+                sock.sendall(b'GET /fail HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n')
+                data = b''
+                while True:
+                    more = sock.recv(4096)
+                    if len(more) == 0:
+                        break
+                    data += more
+                sock.close()
+                # The connection is closed without the last chunk, so the client knows the
+                # content is incomplete, and the server carries on.
+                self.assertTrue(data.startswith(b'HTTP/1.1 200'))
+                self.assertFalse(data.endswith(b'0\r\n\r\n'))
+                http = HttpClient('127.0.0.1', srv.port)
+                self.assertEqual(http.request('/stream').content, STREAM_DATA)
+                http._close_socket()
+                for i in range(50):
+                    if srv.stats()['open_connections'] == 0:
+                        break
+                    time.sleep(0.02)
+                self.assertEqual(srv.stats()['open_connections'], 0, n)
+            finally:
+                srv.stop()
+
+
+class TestCompression(unittest.TestCase):
+    def test_001_accepted_encoding(self):
+        self.assertEqual(accepted_encoding('identity, gzip'), 'gzip')
+        self.assertEqual(accepted_encoding('deflate, gzip;q=0.5'), 'deflate')
+        self.assertEqual(accepted_encoding('gzip;q=0, deflate'), 'deflate')
+        self.assertEqual(accepted_encoding('*'), 'gzip')
+        self.assertIsNone(accepted_encoding('identity'))
+        self.assertIsNone(accepted_encoding(None))
+
+    def test_002_policy(self):
+        policy = CompressionPolicy()
+        self.assertTrue(policy.applies('application/vnd.apple.mpegurl', 1000))
+        self.assertTrue(policy.applies('text/html; charset=utf-8'))
+        self.assertFalse(policy.applies('text/html', 10))
+        self.assertFalse(policy.applies('video/mp2t', 100000))
+        self.assertFalse(policy.applies('video/mp4', 100000))
+        self.assertFalse(CompressionPolicy(level=0).applies('text/html', 1000))
+
+    def test_003_streaming(self):
+        for srv in (HttpServer('127.0.0.1', 0, text_handler), HttpServer('127.0.0.1', 0, text_handler, loop_threads=1),
+                    AsyncHttpServer('127.0.0.1', 0, text_handler, compression=CompressionPolicy(level=1))):
+            srv.start()
+            try:
+                http = HttpClient('127.0.0.1', srv.port)
+                for n in range(2):
+                    resp = http.request('/text')
+                    self.assertEqual(resp.get('content-encoding'), 'gzip')
+                    self.assertEqual(resp.get('transfer-encoding'), 'chunked')
+                    self.assertEqual(resp.decoded_content(), TEXT_DATA)
+                self.assertLess(srv.stats()['bytes_sent'], len(TEXT_DATA))
+            finally:
+                srv.stop()
+
+    def test_004_playlists(self):
+        video = SegmentDirectory(segments=30)
+        srv = HLSServer(video)
+        srv.start()
+        try:
+            for n in range(3):
+                resp = HttpClient(srv.host, srv.port).request('/video.m3u8')
+                self.assertEqual(resp.get('content-encoding'), 'gzip')
+                self.assertIsNotNone(resp.get('content-length'))
+                self.assertEqual(resp.content, video.data['/video.m3u8'])
+            resp = HttpClient(srv.host, srv.port).request('/segment1.ts')
+            self.assertIsNone(resp.get('content-encoding'))
+            self.assertEqual(resp.get('content-type'), 'video/mp2t')
+            stats = srv.stats()
+            self.assertEqual((stats['compressed_hits'], stats['compressed_misses']), (2, 1))
+        finally:
+            srv.stop()
+            video.cleanup()
+
+
+class TestAccessLog(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.filename)
+
+    def read_log(self):
+        with open(self.filename) as fh:
+            return [json.loads(line) for line in fh]
+
+    def test_001_batches(self):
+        log = AccessLog(self.filename, batch=3, interval=30)
+        req = HttpRequest(path='/a')
+        for n in range(2):
+            log.add(AccessRecord(('10.0.0.1', 1234), req))
+        time.sleep(0.1)
+        # Nothing is written until a batch is waiting, or the log is closed.
+        self.assertEqual(self.read_log(), [])
+        log.add(AccessRecord(('10.0.0.1', 1234), req))
+        for n in range(50):
+            if log.stats()['access_logged'] == 3:
+                break
+            time.sleep(0.01)
+        rows = self.read_log()
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]['client'], '10.0.0.1')
+        self.assertEqual(rows[0]['path'], '/a')
+        log.add(AccessRecord(('10.0.0.1', 1234), req))
+        log.close()
+        self.assertEqual(len(self.read_log()), 4)
+
+    def test_002_servers(self):
+        for n, cls in ((0, HttpServer), (1, HttpServer), (0, AsyncHttpServer)):
+            open(self.filename, 'w').close()
+            kwargs = {'loop_threads': n} if cls is HttpServer else {}
+            srv = cls('127.0.0.1', 0, file_handler, access_log=AccessLog(self.filename), **kwargs)
+            srv.start()
+            try:
+                http = HttpClient('127.0.0.1', srv.port)
+                http.request('/file')
+                req = HttpRequest(path='/range')
+                req.add_range(0, 99)
+                http.send_request(req)
+                req = HttpRequest(method='HEAD', path='/head')
+                http.send_request(req)
+            finally:
+                srv.stop()
+            rows = self.read_log()
+            self.assertEqual([r['path'] for r in rows], ['/file', '/range', '/head'], cls)
+            self.assertEqual([r['status'] for r in rows], [200, 206, 200])
+            # The bytes written include the headers, which are the same for GET and HEAD.
+            self.assertEqual(rows[0]['bytes'] - rows[2]['bytes'], os.path.getsize('tests/test_http.py'))
+            self.assertTrue(100 < rows[1]['bytes'] < 600)
+            self.assertEqual(rows[1]['range'], 'bytes=0-99')
+            self.assertFalse(any(r['aborted'] for r in rows))
+            for r in rows:
+                self.assertEqual(r['client'], '127.0.0.1')
+                self.assertLessEqual(r['ttfb_ms'], r['total_ms'])
+                self.assertLess(abs(r['time'] - time.time()), 30)
+
+    def test_003_streams(self):
+        pipes = []
+
+        def handler(request):
+            if request.path == '/hang':
+                # A stream that never finishes, the content closes the read end.
+                rfd, wfd = os.pipe()
+                pipes.append(wfd)
+                os.write(wfd, b'x' * 1000)
+                resp = request.make_response()
+                resp.set_content(StreamContent(rfd, content_type='application/octet-stream'))
+                return resp
+            return stream_handler(request)
+
+        try:
+            for n, cls in ((0, HttpServer), (1, HttpServer), (0, AsyncHttpServer)):
+                open(self.filename, 'w').close()
+                kwargs = {'loop_threads': n} if cls is HttpServer else {}
+                srv = cls('127.0.0.1', 0, handler, access_log=AccessLog(self.filename), idle_timeout=0.3, **kwargs)
+                srv.start()
+                try:
+                    resp = HttpClient('127.0.0.1', srv.port).request('/stream')
+                    self.assertEqual(resp.content, STREAM_DATA)
+                    sock = socket.create_connection(('127.0.0.1', srv.port), 5)
+                    sock.sendall(b'GET /hang HTTP/1.1\r\nHost: 127.0.0.1\r\n\r\n')
+                    self.assertGreater(len(sock.recv(4096)), 0)
+                    sock.close()
+                    time.sleep(0.6)
+                    self.assertEqual(srv.stats()['aborted'], 1, cls)
+                finally:
+                    srv.stop()
+                rows = self.read_log()
+                self.assertEqual([(r['path'], r['aborted']) for r in rows], [('/stream', False), ('/hang', True)])
+                # Chunked (and here compressed) responses are counted as they are written.
+                self.assertGreater(rows[0]['bytes'], 100)
+                self.assertGreater(rows[1]['bytes'], 0)
+                self.assertIsNone(rows[1]['status'])
+        finally:
+            for wfd in pipes:
+                os.close(wfd)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_001_threads(self):
+        counter = Counter('requests', 'Requests.', ('code',))
+        hist = Histogram('latency', 'Latency.', buckets=(0.1, 1.0))
+
+        def record():
+            for n in range(100):
+                counter.inc((200,))
+                hist.observe(0.05)
+            counter.inc((404,), 5)
+            hist.observe(5)
+        threads = [threading.Thread(target=record) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # A new thread folds the shards of those that have finished into the total.
+        record()
+        self.assertEqual(len(counter._shards), 1)
+        self.assertEqual(counter.values(), {(200,): 500, (404,): 25})
+        counts, count, total = hist.totals()
+        self.assertEqual(counts, [500, 0, 5])
+        self.assertEqual(count, 505)
+        self.assertAlmostEqual(total, 50.0)
+        self.assertEqual(list(hist.samples())[:3], [('latency_bucket', {'le': '0.1'}, 500),
+                                                    ('latency_bucket', {'le': '1.0'}, 500),
+                                                    ('latency_bucket', {'le': '+Inf'}, 505)])
+
+    def test_002_render(self):
+        metrics = Metrics()
+        metrics.counter('responses_total', 'Responses.', ('code',)).inc((200,))
+        text = metrics.render({'requests': 3, 'handler_queue': 1, 'title:/film:bytes': 10})
+        lines = text.splitlines()
+        self.assertIn('# TYPE atavism_responses_total counter', lines)
+        self.assertIn('atavism_responses_total{code="200"} 1', lines)
+        self.assertIn('# TYPE atavism_handler_queue gauge', lines)
+        self.assertIn('# TYPE atavism_requests_total counter', lines)
+        self.assertIn('atavism_requests_total 3', lines)
+        self.assertIn('atavism_title_bytes_total{title="/film"} 10', lines)
+        self.assertEqual(Counter('requests', 'Requests.').name, 'requests_total')
+
+    def test_003_servers(self):
+        for n, cls in ((0, HttpServer), (1, HttpServer), (0, AsyncHttpServer)):
+            kwargs = {'loop_threads': n} if cls is HttpServer else {}
+            srv = cls('127.0.0.1', 0, hello_handler, server_timing=True, **kwargs)
+            srv.start()
+            try:
+                http = HttpClient('127.0.0.1', srv.port)
+                resp = http.request('/hello')
+                self.assertTrue(resp.get('server-timing').startswith('handler;dur='))
+                resp = http.request(HttpServer.METRICS_PATH)
+                self.assertEqual(resp.code, 200)
+                self.assertTrue(resp.get('content-type').startswith('text/plain; version=0.0.4'))
+                lines = resp.decoded_content().splitlines()
+                self.assertIn('atavism_responses_total{code="200"} 1', lines, cls)
+                self.assertIn('atavism_request_duration_seconds_count 1', lines)
+                self.assertIn('atavism_open_connections 1', lines)
+                self.assertIn('atavism_requests_total 1', lines)
+            finally:
+                srv.stop()
+
+        srv = HttpServer('127.0.0.1', 0, hello_handler, metrics_path='')
+        srv.start()
+        try:
+            resp = HttpClient('127.0.0.1', srv.port).request(HttpServer.METRICS_PATH)
+            self.assertEqual(resp.decoded_content(), 'Hello ' + HttpServer.METRICS_PATH)
+            self.assertIsNone(resp.get('server-timing'))
+        finally:
+            srv.stop()
+        self.assertEqual(HttpServer('127.0.0.1', 0, hello_handler, workers=2).metrics_path, '')
+
+
+class TestPacing(unittest.TestCase):
+    def test_001_bucket(self):
+        tb = TokenBucket(1000, 500)
+        now = tb.updated
+        self.assertEqual(tb.available(now), 500)
+        tb.take(500, now)
+        self.assertEqual(tb.available(now), 0)
+        self.assertAlmostEqual(tb.delay(250, now), 0.25)
+        self.assertAlmostEqual(tb.available(now + 0.1), 100)
+        self.assertEqual(tb.available(now + 10), 500)
+        self.assertEqual(rate_for_bitrate(8000000, 1.5), 1500000)
+
+        pacer = Pacer()
+        self.assertIsNone(pacer.attach(('127.0.0.1', 1234)))
+        pacer = Pacer(per_ip=100000)
+        b1 = pacer.attach(('127.0.0.1', 1234))
+        b2 = pacer.attach(('127.0.0.1', 1235))
+        self.assertIs(b1[0], b2[0])
+        pacer.consume(b1, 100000)
+        n, delay = pacer.allowance(b2)
+        self.assertEqual(n, 0)
+        self.assertGreater(delay, 0)
+        pacer.detach(('127.0.0.1', 1234))
+        pacer.detach(('127.0.0.1', 1235))
+        self.assertEqual(pacer.addresses, {})
+
+    def test_002_server(self):
+        for n in (0, 1, None):
+            pacer = Pacer(per_connection=2 * 1024 * 1024, per_ip=4 * 1024 * 1024, burst=0.1)
+            if n is None:
+                srv = AsyncHttpServer('127.0.0.1', 0, big_handler, pacing=pacer)
+            else:
+                srv = HttpServer('127.0.0.1', 0, big_handler, loop_threads=n, pacing=pacer)
+            srv.start()
+            try:
+                http = HttpClient('127.0.0.1', srv.port)
+                started = time.time()
+                resp = http.request('/big')
+                # The first 0.1s worth is sent at once, the rest at 2MB/s.
+                self.assertGreater(time.time() - started, 0.3)
+                self.assertEqual(resp.content, BIG_DATA)
+                self.assertGreater(srv.stats()['paced'], 0)
+                http._close_socket()
+            finally:
+                srv.stop()
+            self.assertEqual(pacer.addresses, {})
+
+
+class TestAsyncHttpServer(unittest.TestCase):
+    def test_001_handlers(self):
+        for handler in (hello_handler, slow_handler):
+            srv = AsyncHttpServer('127.0.0.1', 0, handler)
+            srv.start()
+            try:
+                http = HttpClient('127.0.0.1', srv.port)
+                for n in range(3):
+                    resp = http.request('/async/{}'.format(n))
+                    self.assertEqual(resp.code, 200)
+                    self.assertEqual(resp.decoded_content(), 'Hello /async/{}'.format(n))
+            finally:
+                srv.stop()
+            self.assertFalse(srv.running)
+
+    def test_002_blocking_handler(self):
+        srv = AsyncHttpServer('127.0.0.1', 0, blocking_handler)
+        srv.start()
+        try:
+            http = HttpClient('127.0.0.1', srv.port)
+            self.assertEqual(http.request('/slow').decoded_content(), 'Hello /slow')
+            self.assertEqual(http.request('/fail').code, 500)
+            self.assertEqual(srv.stats()['handler_calls'], 2)
+        finally:
+            srv.stop()
+
+    def test_003_sendfile(self):
+        with open('tests/test_http.py', 'rb') as fh:
+            data = fh.read()
+        srv = AsyncHttpServer('127.0.0.1', 0, file_handler)
+        srv.start()
+        try:
+            http = HttpClient('127.0.0.1', srv.port)
+            self.assertEqual(http.request('/file').content, data)
+            req = HttpRequest(path='/file')
+            req.add_range(10, 19)
+            resp = http.send_request(req)
+            self.assertEqual(resp.code, 206)
+            self.assertEqual(resp.content, data[10:20])
+        finally:
+            srv.stop()
+
+    def test_004_descriptor(self):
+        with open('tests/test_http.py', 'rb') as fh:
+            data = fh.read()
+            offset = fh.tell()
+            # Reads through descriptors sharing the fd don't disturb each other, or the fd.
+            first, second = _Descriptor(fh.fileno()), _Descriptor(fh.fileno())
+            first.seek(10)
+            second.seek(100)
+            buf, other = bytearray(20), bytearray(20)
+            self.assertEqual(first.readinto(buf), 20)
+            self.assertEqual(second.readinto(other), 20)
+            self.assertEqual(first.readinto(memoryview(buf)[10:]), 10)
+            self.assertEqual(bytes(buf), data[10:20] + data[30:40])
+            self.assertEqual(bytes(other), data[100:120])
+            self.assertEqual(first.tell(), 40)
+            self.assertEqual(os.lseek(fh.fileno(), 0, os.SEEK_CUR), offset)
+
+    def test_005_options(self):
+        for kwargs in ({'workers': 2}, {'loop_threads': 1}):
+            with self.assertRaises(HttpServerError):
+                AsyncHttpServer('127.0.0.1', 0, hello_handler, **kwargs)
+            with self.assertRaises(HttpServerError):
+                AsyncHLSServer(host='127.0.0.1', **kwargs)
+
+
+class SegmentDirectory(object):
+    """ Just enough of a BaseVideo to serve the files in a directory. """
+    find_file = BaseVideo.find_file
+    file_info = BaseVideo.file_info
+    index = BaseVideo.index
+    _index = None
+
+    def __init__(self, segments=3, size=1000):
+        self.directory = tempfile.mkdtemp()
+        self.url = '/video.m3u8'
+        self.data = {}
+        for n in range(segments):
+            self.write('segment{}.ts'.format(n), bytes(bytearray((n + i) % 256 for i in range(size))))
+        self.write('video.m3u8', b''.join([b'#EXTM3U\n'] + [
+            '#EXTINF:10.0,\nsegment{}.ts\n'.format(n).encode() for n in range(segments)]))
+
+    def write(self, fn, data):
+        with open(os.path.join(self.directory, fn), 'wb') as fh:
+            fh.write(data)
+        self.data['/' + fn] = data
+        self.index.update(fn)
+
+    def cleanup(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+
+class TestSegmentCache(unittest.TestCase):
+    def setUp(self):
+        self.video = SegmentDirectory()
+
+    def tearDown(self):
+        self.video.cleanup()
+
+    def test_001_lru(self):
+        cache = SegmentCache(2500, max_item=1000)
+        fns = [os.path.join(self.video.directory, 'segment{}.ts'.format(n)) for n in range(3)]
+        self.assertEqual(cache.get(fns[0]), self.video.data['/segment0.ts'])
+        self.assertEqual(cache.get(fns[0]), self.video.data['/segment0.ts'])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.get(fns[1])
+        cache.get(fns[0])
+        cache.get(fns[2])
+        # segment1 was the least recently used
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.size, 2000)
+        self.assertEqual(sorted(k[0] for k in cache.entries), [fns[0], fns[2]])
+
+    def test_002_changed_file(self):
+        cache = SegmentCache(10000)
+        fn = os.path.join(self.video.directory, 'segment0.ts')
+        cache.get(fn)
+        self.video.write('segment0.ts', b'changed')
+        self.assertEqual(cache.get(fn), b'changed')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, 7)
+
+    def test_003_server(self):
+        srv = HLSServer(self.video, cache_size=100000)
+        srv.start()
+        try:
+            for n in range(2):
+                http = HttpClient(srv.host, srv.port)
+                for path in ('/video.m3u8', '/segment1.ts'):
+                    self.assertEqual(http.request(path).content, self.video.data[path])
+            stats = srv.stats()
+            self.assertEqual(stats['cache_hits'], 2)
+            self.assertEqual(stats['cache_misses'], 2)
+        finally:
+            srv.stop()
+
+
+class TestDirectoryIndex(unittest.TestCase):
+    def setUp(self):
+        self.video = SegmentDirectory()
+
+    def tearDown(self):
+        self.video.cleanup()
+
+    def test_001_lookup(self):
+        index = DirectoryIndex(self.video.directory, ttl=0)
+        info = index.lookup('/segment1.ts')
+        self.assertEqual(info.filename, os.path.join(self.video.directory, 'segment1.ts'))
+        self.assertEqual(info.size, 1000)
+        self.assertEqual(info.content_type, 'video/mp2t')
+        self.assertIs(index.lookup('segment1.ts?x=1'), info)
+        self.assertIs(index.lookup('/%73egment1.ts'), info)
+        self.assertIn(info.filename, [k[0] for k in FileHandle._handles])
+
+        outside = tempfile.NamedTemporaryFile()
+        os.symlink(outside.name, os.path.join(self.video.directory, 'link.ts'))
+        index.refresh()
+        for path in ('/../segment1.ts', '/x/../segment1.ts', '/%2e%2e/etc/passwd', '/..', '/link.ts',
+                     '/' + os.path.basename(self.video.directory) + '/segment1.ts', '/missing.ts'):
+            self.assertIsNone(index.lookup(path), path)
+        outside.close()
+
+        # New files are found once the directory has changed, changes in place once the
+        # details are older than ttl, or after update()
+        self.video.write('segment9.ts', b'new')
+        self.assertEqual(index.lookup('/segment9.ts').size, 3)
+        with open(info.filename, 'wb') as fh:
+            fh.write(b'changed')
+        self.assertEqual(index.lookup('/segment1.ts').size, 7)
+        with open(info.filename, 'wb') as fh:
+            fh.write(b'changed again')
+        index.update(info.filename)
+        self.assertEqual(index.lookup('/segment1.ts').size, 13)
+        os.unlink(info.filename)
+        index.update('segment1.ts')
+        self.assertIsNone(index.lookup('/segment1.ts'))
+        index.close()
+        self.assertEqual(len(index.handles), 0)
+
+    def test_002_subdirectories(self):
+        sub = os.path.join(self.video.directory, '720p')
+        os.mkdir(sub)
+        with open(os.path.join(sub, 'segment0.ts'), 'wb') as fh:
+            fh.write(b'720p')
+        index = DirectoryIndex(self.video.directory, ttl=0)
+        info = index.lookup('/720p/segment0.ts')
+        self.assertEqual(info.filename, os.path.join(sub, 'segment0.ts'))
+        self.assertEqual(info.size, 4)
+        self.assertIs(index.lookup('720p/./segment0.ts'), info)
+        for path in ('/720p', '/720p/../segment1.ts', '/720p/missing.ts', '/1080p/segment0.ts'):
+            self.assertIsNone(index.lookup(path), path)
+
+        # A subdirectory that has been removed is forgotten.
+        os.unlink(info.filename)
+        os.rmdir(sub)
+        self.assertIsNone(index.lookup('/720p/segment0.ts'))
+        self.assertEqual(len(index.indexes), 0)
+        index.close()
+
+
+class TestReadahead(unittest.TestCase):
+    def test_001_parse_playlist(self):
+        data = b'#EXTM3U\n#EXTINF:10.0,\nseg0.ts\n\n#EXTINF:10.0,\nsub/seg1.ts?x=1\n' \
+               b'#EXTINF:10.0,\n/abs/seg2.ts\n#EXTINF:10.0,\nhttp://elsewhere/seg3.ts\n#EXT-X-ENDLIST\n'
+        self.assertEqual(parse_playlist('/film/video.m3u8', data),
+                         ['/film/seg0.ts', '/film/sub/seg1.ts', '/abs/seg2.ts'])
+
+    @unittest.skipUnless(can_advise(), 'posix_fadvise is not available')
+    def test_002_advise(self):
+        video = SegmentDirectory(segments=5)
+        try:
+            ra = Readahead(video.find_file, ahead=2, behind=1)
+            playlist = os.path.join(video.directory, 'video.m3u8')
+            ra.load(video.url, playlist, os.stat(playlist))
+            self.assertEqual(len(ra.segments), 5)
+            self.assertFalse(ra.requested('/video.m3u8'))
+            self.assertTrue(ra.requested('/segment0.ts'))
+            self.assertEqual(ra.stats(), {'readahead_hints': 2, 'readahead_drops': 0})
+            # Only the segment not already hinted is read ahead.
+            ra.requested('/segment1.ts')
+            self.assertEqual(ra.stats(), {'readahead_hints': 3, 'readahead_drops': 0})
+
+            # Once no client has asked for them recently, played segments are dropped.
+            ra.CLIENT_TTL = 0.05
+            time.sleep(0.1)
+            ra.requested('/segment3.ts')
+            self.assertEqual(ra.stats(), {'readahead_hints': 4, 'readahead_drops': 2})
+
+            # A segment that doesn't exist yet is tried again.
+            os.unlink(os.path.join(video.directory, 'segment4.ts'))
+            video.index.update('segment4.ts')
+            ra.hinted.discard(4)
+            ra.requested('/segment3.ts')
+            self.assertNotIn(4, ra.hinted)
+        finally:
+            video.cleanup()
+
+    @unittest.skipUnless(can_advise(), 'posix_fadvise is not available')
+    def test_003_server(self):
+        video = SegmentDirectory(segments=4)
+        srv = HLSServer(video, host='127.0.0.1')
+        srv.start()
+        try:
+            http = HttpClient('127.0.0.1', srv.port)
+            for n in range(2):
+                self.assertEqual(http.request('/segment{}.ts'.format(n)).code, 200)
+            self.assertEqual(srv.stats()['readahead_hints'], 3)
+        finally:
+            srv.stop()
+            video.cleanup()
+
+
+class TestConditionalGet(unittest.TestCase):
+    def setUp(self):
+        self.video = SegmentDirectory()
+        self.srv = HLSServer(self.video)
+        self.srv.start()
+        self.http = HttpClient(self.srv.host, self.srv.port)
+
+    def tearDown(self):
+        self.srv.stop()
+        self.video.cleanup()
+
+    def test_001_validators(self):
+        resp = self.http.request('/video.m3u8')
+        etag = resp.get('etag')
+        self.assertTrue(etag.startswith('"'))
+        self.assertIsNotNone(resp.get('last-modified'))
+
+        for hdrs in ({'If-None-Match': etag}, {'If-None-Match': 'W/"x", ' + etag},
+                     {'If-Modified-Since': resp.get('last-modified')}):
+            req = HttpRequest(path='/video.m3u8')
+            req.add_headers(hdrs)
+            resp = self.http.send_request(req)
+            self.assertEqual(resp.code, 304)
+            self.assertEqual(resp.content, b'')
+        self.assertEqual(self.srv.stats()['not_modified'], 3)
+
+        req = HttpRequest(path='/video.m3u8')
+        req.add_header('If-None-Match', '"other"')
+        self.assertEqual(self.http.send_request(req).code, 200)
+
+        req = HttpRequest(method='HEAD', path='/video.m3u8')
+        resp = self.http.send_request(req)
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(int(resp.get('content-length')), len(self.video.data['/video.m3u8']))
+
+    def test_002_if_range(self):
+        data = self.video.data['/segment0.ts']
+        etag = self.http.request('/segment0.ts').get('etag')
+        for validator, code, content in ((etag, 206, data[10:20]), ('"old"', 200, data)):
+            req = HttpRequest(path='/segment0.ts')
+            req.add_range(10, 19)
+            req.add_header('If-Range', validator)
+            resp = self.http.send_request(req)
+            self.assertEqual(resp.code, code)
+            self.assertEqual(resp.content, content)
+
+    def test_003_client(self):
+        first = self.http.request('/video.m3u8')
+        self.assertIs(self.http.request('/video.m3u8'), first)
+        self.assertEqual(self.srv.stats()['not_modified'], 1)
+
+        self.video.write('video.m3u8', b'#EXTM3U\n')
+        self.srv.files.clear()
+        resp = self.http.request('/video.m3u8')
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(resp.content, b'#EXTM3U\n')
+
+    def test_004_codings(self):
+        def fetch(coding, tag=None):
+            sock = socket.create_connection(('127.0.0.1', srv.port), 5)
+            sock.sendall('GET /video.m3u8 HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n'
+                         'Accept-Encoding: {}\r\n{}\r\n'.format(
+                             coding, 'If-None-Match: {}\r\n'.format(tag) if tag else '').encode())
+            resp = HttpResponse()
+            data = sock.recv(65536)
+            while data:
+                resp.read_content(data)
+                data = sock.recv(65536)
+            sock.close()
+            return resp
+
+        srv = HLSServer(SegmentDirectory(segments=20), host='127.0.0.1', compression=CompressionPolicy(min_size=0))
+        srv.start()
+        try:
+            tags = {}
+            for coding in ('identity', 'gzip'):
+                resp = fetch(coding)
+                self.assertEqual(resp.get('content-encoding') or 'identity', coding)
+                tags[coding] = resp.get('etag')
+            self.assertEqual(tags['gzip'], tags['identity'][:-1] + '-gzip"')
+
+            # Each coding is only validated by it's own tag.
+            for coding, tag, code in (('identity', tags['identity'], 304), ('identity', tags['gzip'], 200),
+                                      ('gzip', tags['gzip'], 304), ('gzip', tags['identity'], 200)):
+                resp = fetch(coding, tag)
+                self.assertEqual(resp.code, code)
+                self.assertEqual(resp.get('etag'), tags[coding])
+        finally:
+            srv.stop()
+            srv.video.cleanup()
+
+
+class TestTitles(unittest.TestCase):
+    def setUp(self):
+        self.videos = [SegmentDirectory(size=100 * (n + 1)) for n in range(3)]
+        self.srv = HLSServer(self.videos[0])
+        self.srv.add_title('/two', self.videos[1])
+        self.srv.start()
+        self.http = HttpClient(self.srv.host, self.srv.port)
+
+    def tearDown(self):
+        self.srv.stop()
+        for v in self.videos:
+            v.cleanup()
+
+    def test_001_routing(self):
+        self.assertTrue(self.srv.title_url('/two').endswith('/two/video.m3u8'))
+        for prefix, video in (('', self.videos[0]), ('/two', self.videos[1])):
+            self.assertEqual(self.http.request(prefix + '/segment1.ts').content, video.data['/segment1.ts'])
+        self.assertEqual(self.http.request('/three/segment1.ts').code, 404)
+
+        self.srv.add_title('three/', self.videos[2])
+        self.assertEqual(self.http.request('/three/segment1.ts').content, self.videos[2].data['/segment1.ts'])
+        self.assertIsNotNone(self.srv.remove_title('/two'))
+        self.assertEqual(self.http.request('/two/segment1.ts').code, 404)
+
+        stats = self.srv.stats()
+        self.assertEqual(stats['title:/:requests'], 1)
+        self.assertEqual(stats['title:/:bytes'], 100)
+        self.assertEqual(stats['title:/three:bytes'], 300)
+        self.assertNotIn('title:/two:requests', stats)
+
+    def test_002_root_title(self):
+        self.assertTrue(self.srv.url.endswith(':{}/video.m3u8'.format(self.srv.port)))
+        self.assertEqual(self.srv.content_type, guess_type('video.m3u8')[0])
+        self.srv.add_title('/', self.videos[1])
+        self.assertIs(self.srv.video, self.videos[1])
+        resp = self.http.request(self.srv.url[self.srv.url.index('/', 7):])
+        self.assertEqual(resp.content, self.videos[1].data['/video.m3u8'])
+
+        self.srv.remove_title('')
+        self.assertIsNone(self.srv.video)
+        for attr in ('url', 'content_type'):
+            with self.assertRaises(HLSServerError):
+                getattr(self.srv, attr)
+
+
 class HttpbinTest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):